@@ -0,0 +1,98 @@
+"""
+Micro-benchmark for parser.clean_subject().
+
+Compares the old implementation (re.sub with string patterns) with the
+precompiled one, without cache and with a cold / warm LRU cache, on a
+synthetic corpus shaped like the mailbox: many threads, each subject seen
+several times as "Re: ...", "Fwd: ..." etc., some with trailing dates.
+
+Run: python benchmarks/bench_clean_subject.py [--subjects 50000] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import parser  # noqa: E402
+
+TOPICS = [
+    'Заказ №{n}', 'Возврат товара по заказу {n}', 'Доставка заказа {n}',
+    'Претензия {n}', 'Счет на оплату {n}', 'Акт сверки', 'Гарантийный ремонт {n}',
+    'Order {n} status', 'Недовложение в заказе {n}', 'Обмен товара',
+]
+PREFIXES = ['Re: ', 'Re: ', 'RE: ', 'Fwd: ', 'FW: ', 'Отв: ', 'Re: Re: ', 'Fwd: Re: ', 'Re:Fwd:']
+DATES = ['', '', '', ' 16.08.2025', ' 22-23.08', ' 01.02', ' 03/04/2025', ' 12.10.2025 13.10.2025']
+
+
+def clean_subject_legacy(subject):
+    """clean_subject() as it was before precompiled patterns and caching."""
+    if not subject: return ""
+    s = subject.strip()
+    while True:
+        new_s = re.sub(r'^(Re:|Fwd:|FW:|Отв:)\s*', '', s, flags=re.IGNORECASE).strip()
+        date_pattern = r'\s+\d+[-./]\d+([-./]\d+)?\s*$'
+        new_s = re.sub(date_pattern, '', new_s).strip()
+        if new_s == s: break
+        s = new_s
+    return s
+
+
+def make_corpus(count, seed=42):
+    """~4 messages per thread: the original subject, then replies/forwards of it."""
+    rnd = random.Random(seed)
+    corpus = []
+    n = 0
+    while len(corpus) < count:
+        base = TOPICS[n % len(TOPICS)].format(n=10000 + n) + rnd.choice(DATES)
+        corpus.append(base)
+        for _ in range(rnd.randint(1, 6)):
+            corpus.append(rnd.choice(PREFIXES) + base)
+        n += 1
+    del corpus[count:]
+    rnd.shuffle(corpus)
+    return corpus
+
+
+def bench(name, func, corpus, repeat, warm=False):
+    best = None
+    for _ in range(repeat):
+        if hasattr(func, 'cache_clear'):
+            func.cache_clear()
+            if warm:
+                for subject in corpus:
+                    func(subject)
+        start = time.perf_counter()
+        for subject in corpus:
+            func(subject)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:<28} {best * 1000:9.1f} ms  {len(corpus) / best:12,.0f} subjects/s")
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument('--subjects', type=int, default=50000)
+    ap.add_argument('--repeat', type=int, default=5)
+    args = ap.parse_args()
+
+    corpus = make_corpus(args.subjects)
+    mismatches = [s for s in corpus if clean_subject_legacy(s) != parser.clean_subject(s)]
+    if mismatches:
+        print(f"MISMATCH on {len(mismatches)} subjects, e.g. {mismatches[:3]!r}")
+        sys.exit(1)
+
+    print(f"{len(corpus)} subjects, {len(set(corpus))} unique, best of {args.repeat}")
+    legacy = bench('legacy (re.sub loop)', clean_subject_legacy, corpus, args.repeat)
+    compiled = bench('compiled, no cache', parser.clean_subject.__wrapped__, corpus, args.repeat)
+    cold = bench('compiled + LRU (cold)', parser.clean_subject, corpus, args.repeat)
+    warm = bench('compiled + LRU (warm)', parser.clean_subject, corpus, args.repeat, warm=True)
+    print(f"speedup vs legacy: {legacy / compiled:.1f}x compiled, "
+          f"{legacy / cold:.1f}x cold cache, {legacy / warm:.1f}x warm cache")
+
+
+if __name__ == '__main__':
+    main()
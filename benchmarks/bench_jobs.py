@@ -0,0 +1,234 @@
+"""
+Job benchmark: sync_emails, log_operator_activity, log_overdue_emails and
+archive_inactive_threads against a synthetic mailbox.
+
+Each mailbox size runs in its own subprocess and temp directory (local stores
+start empty) and goes through two runs, like two cron invocations:
+  run 1 (cold): full sync of the whole mailbox, operators, overdue, archive
+  run 2 (warm): ~1% new messages, incremental sync, operators, overdue
+IMAP and Google Sheets are replaced through RunContext(client=, mailbox_factory=)
+by the in-memory stand-ins from fake_backends.py.
+
+Per job it reports wall time, peak RSS of the process so far, Sheets API
+requests (reads/writes), IMAP commands and header bytes fetched.
+
+Run: python benchmarks/bench_jobs.py [--sizes 1000,10000,100000] [--imap-latency 0.02] [--json out.json]
+"""
+import argparse
+import contextlib
+import datetime
+import email.header
+import email.utils
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import parser  # noqa: E402
+from fake_backends import FakeClient, FakeMailServer  # noqa: E402
+
+BOT_EMAIL = 'support@21vek.by'
+OPERATORS = [f'operator{i}@21vek.by' for i in range(1, 9)]
+SENT_FOLDER = 'Sent'
+DAYS = 200  # mailbox history; threads older than INACTIVE_MONTHS are archived
+TOPICS = [
+    'Заказ №{n}', 'Возврат товара по заказу {n}', 'Доставка заказа {n}',
+    'Претензия {n}', 'Счет на оплату {n}', 'Гарантийный ремонт {n}',
+    'Order {n} status', 'Недовложение в заказе {n}', 'Обмен товара {n}',
+]
+REPLY_PREFIXES = ['Re: ', 'Re: ', 'Re: ', 'RE: ', 'Re: Re: ', 'Отв: ']
+
+
+def raw_headers(msg_id, subject, sender, date, parent=None, refs=()):
+    lines = [
+        f"Message-ID: <{msg_id}>",
+        f"Subject: {email.header.Header(subject, 'utf-8').encode()}",
+        f"From: {sender}",
+        f"Date: {email.utils.format_datetime(date)}",
+    ]
+    if parent:
+        lines.append(f"In-Reply-To: <{parent}>")
+    if refs:
+        lines.append("References: " + " ".join(f"<{r}>" for r in refs))
+    return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+
+class MailboxGenerator:
+    """
+    Reply chains: a customer writes to INBOX, operators answer from Sent, the
+    customer may follow up; ~10% of replies lose their References (matched by
+    subject only), some threads are forwarded. Dates cover DAYS days up to now.
+    """
+
+    def __init__(self, server, seed=42):
+        self.server = server
+        self.rnd = random.Random(seed)
+        self.threads = 0
+        self._batch = []  # (date, folder, raw headers)
+
+    def add_thread(self, start, max_messages):
+        rnd = self.rnd
+        n = self.threads = self.threads + 1
+        base = TOPICS[n % len(TOPICS)].format(n=100000 + n)
+        customer = f"Client {n} <client{n}@example.com>"
+        chain = []
+        date = start
+        count = min(max_messages, rnd.choice([1, 2, 2, 3, 3, 4, 5, 6]))
+        for i in range(count):
+            msg_id = f"{n}.{i}@bench"
+            from_operator = i % 2 == 1
+            subject = base if i == 0 else rnd.choice(REPLY_PREFIXES) + base
+            if i and rnd.random() < 0.05:
+                subject = 'Fwd: ' + base
+            parent, refs = (chain[-1], chain) if chain and rnd.random() > 0.1 else (None, ())
+            if from_operator:
+                sender = rnd.choice(OPERATORS + [BOT_EMAIL])
+                folder = SENT_FOLDER
+            else:
+                sender = customer
+                folder = 'INBOX'
+            self._batch.append((date, folder, raw_headers(msg_id, subject, sender, date, parent, list(refs))))
+            chain.append(msg_id)
+            date += datetime.timedelta(minutes=rnd.randint(5, 60 * 48))
+            if date > datetime.datetime.now(parser.MSK_TZ):
+                break
+        return len(chain)
+
+    def generate(self, total, since, until):
+        """Adds ~`total` messages in threads started between `since` and `until`, in date order."""
+        span = (until - since).total_seconds()
+        # More starts than needed, in random order, so the cap does not cut off recent days
+        starts = [since + datetime.timedelta(seconds=self.rnd.random() * span) for _ in range(max(1, total // 2))]
+        added = 0
+        for start in starts:
+            added += self.add_thread(start, total - added)
+            if added >= total:
+                break
+        # UIDs must grow with arrival time, like on a real server
+        self._batch.sort(key=lambda m: m[0])
+        for date, folder, raw in self._batch:
+            self.server.append(folder, date, raw)
+        self._batch = []
+        return added
+
+
+def make_sheets():
+    client = FakeClient()
+    main = client.add_spreadsheet(parser.GOOGLE_SHEET_URL)
+    main.add(0, 'Emails')
+    main.add(parser.OPERATORS_GID, 'Operators', [[op] for op in OPERATORS])
+    main.add(parser.OPERATOR_LOG_GID, 'OperatorLog', [['ID', 'Sender', 'Subject', 'Time']])
+    main.add(parser.OVERDUE_LOG_GID, 'Overdue', [['ID', 'Subject', 'Sender', 'Time', 'Duration']])
+    archive = client.add_spreadsheet(parser.ARCHIVE_SHEET_URL)
+    archive.add(parser.ARCHIVE_GID, 'Archive', [['id', 'theme_of_mail', 'sender', 'time', 'status_of_reply',
+                                                'type_of_email', 'last_replyer', 'last_activity', 'archived_at']])
+    archive.add(parser.STATS_GID, 'Stats', [['year_month', 'count']])
+    return client
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def run_job(name, func, ctx, client, server, results, quiet):
+    reads, writes = client.calls['read'], client.calls['write']
+    imap_calls, fetched = sum(server.calls.values()), server.bytes_fetched
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull if quiet else sys.stdout):
+        result = func(ctx)
+    results.append({
+        'job': name,
+        'wall_s': round(time.perf_counter() - start, 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'sheets_reads': client.calls['read'] - reads,
+        'sheets_writes': client.calls['write'] - writes,
+        'imap_commands': sum(server.calls.values()) - imap_calls,
+        'imap_kb': round((server.bytes_fetched - fetched) / 1024, 1),
+        'error': result.get('error') if isinstance(result, dict) else None,
+    })
+
+
+def bench_size(size, latency, quiet=True):
+    parser.YANDEX_EMAIL = BOT_EMAIL
+    parser.YANDEX_PASSWORD = 'bench'
+    parser.GOOGLE_SHEET_URL = 'https://docs.google.com/spreadsheets/d/bench'
+    now = datetime.datetime.now(parser.MSK_TZ)
+
+    server = FakeMailServer(latency=latency)
+    server.add_folder('INBOX')
+    server.add_folder(SENT_FOLDER)
+    generator = MailboxGenerator(server)
+    generator.generate(size, now - datetime.timedelta(days=DAYS), now - datetime.timedelta(hours=1))
+    client = make_sheets()
+    jobs = [
+        ('sync', parser.sync_emails),
+        ('operators', lambda ctx: parser.log_operator_activity(ctx, parser.OPERATOR_LOG_GID)),
+        ('overdue', lambda ctx: parser.log_overdue_emails(ctx, parser.OVERDUE_LOG_GID)),
+    ]
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        ctx = parser.RunContext(client=client, mailbox_factory=server.mailbox)
+        for name, func in jobs + [('archive', parser.archive_inactive_threads)]:
+            run_job(f'cold {name}', func, ctx, client, server, results, quiet)
+        ctx.close_mailbox()
+
+        # Second run: new mail arrived since the first one
+        generator.generate(max(1, size // 100), now - datetime.timedelta(minutes=50), now)
+        ctx = parser.RunContext(client=client, mailbox_factory=server.mailbox)
+        for name, func in jobs:
+            run_job(f'warm {name}', func, ctx, client, server, results, quiet)
+        ctx.close_mailbox()
+        os.chdir('/')
+    return results
+
+
+def print_table(size, results):
+    print(f"\n{size} messages")
+    print(f"{'job':<16}{'wall s':>9}{'peak RSS MB':>13}{'Sheets R/W':>12}{'IMAP cmds':>11}{'IMAP KB':>10}")
+    for r in results:
+        line = (f"{r['job']:<16}{r['wall_s']:>9.3f}{r['peak_rss_mb']:>13.1f}"
+                f"{r['sheets_reads']:>6}/{r['sheets_writes']:<5}{r['imap_commands']:>11}{r['imap_kb']:>10.1f}")
+        if r['error']:
+            line += f"  ERROR: {r['error']}"
+        print(line)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument('--sizes', default='1000,10000,100000', help='comma-separated mailbox sizes')
+    ap.add_argument('--imap-latency', type=float, default=0.0, help='seconds slept per IMAP command')
+    ap.add_argument('--json', help='also write results to this file')
+    ap.add_argument('--single', type=int, help=argparse.SUPPRESS)  # child process mode
+    ap.add_argument('--verbose', action='store_true', help='show job output')
+    args = ap.parse_args()
+
+    if args.single:
+        print(json.dumps(bench_size(args.single, args.imap_latency, quiet=not args.verbose)))
+        return
+
+    report = {}
+    for size in [int(s) for s in args.sizes.split(',')]:
+        # Fresh process per size so peak RSS is not inherited from a larger run
+        cmd = [sys.executable, os.path.abspath(__file__), '--single', str(size),
+               '--imap-latency', str(args.imap_latency)]
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        report[size] = json.loads(out.strip().splitlines()[-1])
+        print_table(size, report[size])
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'imap_latency': args.imap_latency, 'results': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
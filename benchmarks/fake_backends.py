@@ -0,0 +1,259 @@
+"""
+In-process stand-ins for the IMAP server and the Google Sheets API, used by the
+job benchmarks. They implement only what parser.py calls, keep everything in
+memory and count calls the way they would be billed:
+
+- FakeClient / FakeSpreadsheet / FakeWorksheet: gspread-compatible; every method
+  that is one Sheets API request increments `client.calls['read' | 'write']`.
+- FakeMailServer / FakeMailBox: imap_tools-compatible (STATUS, SELECT, UID SEARCH
+  with ALL / UID n:* / SINCE, UID FETCH of header fields); every IMAP command
+  increments `server.calls`. `latency` (seconds) is slept per command.
+"""
+import datetime
+import re
+import threading
+import time
+from collections import Counter
+
+A1_RE = re.compile(r'^([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?$')
+RANGE_RE = re.compile(r'^([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?$')  # open-ended too: 'A2:A', 'E2:H'
+MONTHS = {m: i + 1 for i, m in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])}
+
+
+def col_index(letters):
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+    return n - 1
+
+
+def cell_str(value):
+    """Sheets returns every cell as a formatted string."""
+    return '' if value is None else str(value)
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, gid, title, rows=None):
+        self.spreadsheet = spreadsheet
+        self.id = gid
+        self.title = title
+        self.rows = [[cell_str(v) for v in row] for row in (rows or [])]
+
+    def _count(self, kind):
+        self.spreadsheet.client.calls[kind] += 1
+
+    def get_all_values(self, *args, **kwargs):
+        self._count('read')
+        return [list(row) for row in self.rows]
+
+    def get_all_records(self, *args, **kwargs):
+        self._count('read')
+        if not self.rows:
+            return []
+        header = self.rows[0]
+        return [dict(zip(header, row + [''] * (len(header) - len(row)))) for row in self.rows[1:]]
+
+    def col_values(self, col, *args, **kwargs):
+        self._count('read')
+        values = [row[col - 1] if len(row) >= col else '' for row in self.rows]
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def batch_get(self, ranges, *args, **kwargs):
+        self._count('read')
+        return [self._get_range(a1) for a1 in ranges]
+
+    def append_row(self, values, *args, **kwargs):
+        self.append_rows([values])
+
+    def append_rows(self, values, *args, **kwargs):
+        self._count('write')
+        self.rows.extend([cell_str(v) for v in row] for row in values)
+
+    def batch_update(self, data, *args, **kwargs):
+        self._count('write')
+        for item in data:
+            self._set_range(item['range'], item['values'])
+
+    def update(self, values, range_name=None, *args, **kwargs):
+        self._count('write')
+        self._set_range(range_name, values)
+
+    def delete_rows(self, start_index, end_index=None):
+        self._count('write')
+        del self.rows[start_index - 1:end_index or start_index]
+
+    def _get_range(self, a1):
+        """Values of an A1 range like the API returns them: trailing empty cells and rows dropped."""
+        m = RANGE_RE.match(a1.split('!')[-1])
+        col0 = col_index(m.group(1))
+        col1 = col_index(m.group(3)) if m.group(3) else col0
+        row0 = int(m.group(2) or 1) - 1
+        row1 = int(m.group(4)) if m.group(4) else len(self.rows)
+        values = []
+        for row in self.rows[row0:row1]:
+            cells = row[col0:col1 + 1]
+            while cells and not cells[-1]:
+                cells.pop()
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def _set_range(self, a1, values):
+        m = A1_RE.match(a1.split('!')[-1])
+        col0, row0 = col_index(m.group(1)), int(m.group(2)) - 1
+        for i, values_row in enumerate(values):
+            while len(self.rows) <= row0 + i:
+                self.rows.append([])
+            row = self.rows[row0 + i]
+            for j, value in enumerate(values_row):
+                while len(row) <= col0 + j:
+                    row.append('')
+                row[col0 + j] = cell_str(value)
+
+
+class FakeSpreadsheet:
+    def __init__(self, client, url):
+        self.client = client
+        self.url = url
+        self._worksheets = []
+
+    def add(self, gid, title, rows=None):
+        """Test setup helper (not an API call)."""
+        ws = FakeWorksheet(self, gid, title, rows)
+        self._worksheets.append(ws)
+        return ws
+
+    def worksheets(self, *args, **kwargs):
+        self.client.calls['read'] += 1
+        return list(self._worksheets)
+
+    def add_worksheet(self, title, rows=100, cols=26, *args, **kwargs):
+        self.client.calls['write'] += 1
+        gid = max([ws.id for ws in self._worksheets] + [0]) + 1
+        return self.add(gid, title)
+
+    def batch_update(self, body):
+        self.client.calls['write'] += 1
+        for request in body.get('requests', []):
+            dim = request['deleteDimension']['range']
+            ws = next(w for w in self._worksheets if w.id == dim['sheetId'])
+            del ws.rows[dim['startIndex']:dim['endIndex']]
+        return {}
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = Counter()
+        self.spreadsheets = {}
+
+    def add_spreadsheet(self, url):
+        self.spreadsheets[url] = FakeSpreadsheet(self, url)
+        return self.spreadsheets[url]
+
+    def open_by_url(self, url):
+        self.calls['read'] += 1
+        return self.spreadsheets[url]
+
+
+class FakeMailServer:
+    """Folders of {uid: (aware datetime, raw header bytes)}."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.folders = {}
+        self.uidvalidity = {}
+        self.calls = Counter()
+        self.bytes_fetched = 0
+        self._lock = threading.Lock()
+
+    def add_folder(self, name, uidvalidity=1):
+        self.folders[name] = {}
+        self.uidvalidity[name] = uidvalidity
+
+    def append(self, folder, date, raw_headers):
+        messages = self.folders[folder]
+        uid = max(messages, default=0) + 1
+        messages[uid] = (date, raw_headers)
+        return uid
+
+    def command(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def mailbox(self):
+        """mailbox_factory for parser.RunContext."""
+        self.command('login')
+        return FakeMailBox(self)
+
+
+class FakeFolderManager:
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+
+    def exists(self, folder):
+        self.mailbox.server.command('list')
+        return folder in self.mailbox.server.folders
+
+    def set(self, folder, readonly=False):
+        self.mailbox.server.command('select')
+        self.mailbox.selected = folder
+
+    def status(self, folder=None, options=None):
+        server = self.mailbox.server
+        server.command('status')
+        messages = server.folders[folder or self.mailbox.selected]
+        return {
+            'MESSAGES': len(messages),
+            'UIDNEXT': max(messages, default=0) + 1,
+            'UIDVALIDITY': server.uidvalidity[folder or self.mailbox.selected],
+        }
+
+
+class FakeIMAPClient:
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+
+    def uid(self, command, uid_set, message_parts):
+        server = self.mailbox.server
+        server.command('fetch')
+        messages = server.folders[self.mailbox.selected]
+        data = []
+        for n, uid in enumerate(uid_set.split(',')):
+            raw = messages[int(uid)][1]
+            server.bytes_fetched += len(raw)
+            data.append((f'{n + 1} (UID {uid} BODY[HEADER.FIELDS] {{{len(raw)}}}'.encode(), raw))
+            data.append(b')')
+        return 'OK', data
+
+
+class FakeMailBox:
+    def __init__(self, server):
+        self.server = server
+        self.selected = None
+        self.folder = FakeFolderManager(self)
+        self.client = FakeIMAPClient(self)
+
+    def uids(self, criteria='ALL', *args, **kwargs):
+        self.server.command('search')
+        messages = self.server.folders[self.selected]
+        criteria = str(criteria)
+        uids = sorted(messages)
+        m = re.search(r'UID (\d+):\*', criteria)
+        if m:
+            low = int(m.group(1))
+            # Like a real server, "N:*" returns the last message even if its UID < N
+            uids = [uid for uid in uids if uid >= low] or uids[-1:]
+        m = re.search(r'SINCE (\d+)-(\w+)-(\d+)', criteria)
+        if m:
+            since = datetime.date(int(m.group(3)), MONTHS[m.group(2)], int(m.group(1)))
+            uids = [uid for uid in uids if messages[uid][0].date() >= since]
+        return [str(uid) for uid in uids]
+
+    def logout(self):
+        self.server.command('logout')
@@ -0,0 +1,409 @@
+"""
+Plan (dry-run) mode: python parser.py plan [--plan-cache DIR] [--plan-out FILE]
+(or the old flag form: python parser.py --plan ...)
+
+Runs sync_emails(), log_operator_activity(), log_overdue_emails() and
+archive_inactive_threads() exactly as a normal run, but:
+- every Sheets write (append_row(s), batch_update, update, delete_rows,
+  add_worksheet, spreadsheet batchUpdate) is recorded instead of sent;
+- local state (.threads.db, .operator_stats.db, .sync_state.json, .last_sync)
+  is copied to a temp directory first, so the real checkpoints don't move.
+The recorded operations are printed (or written to --plan-out) as JSON.
+
+--plan-cache DIR makes the inputs reproducible: the first run records the IMAP
+responses, Sheets reads and the local state files (DIR/state) into DIR, later
+runs replay them without network against that same state, not the current one.
+Delete DIR to record again. Planned writes are applied to a local copy of the
+sheet, so later jobs in the same plan read the result (a written sheet costs one
+extra get_all_values when recording).
+"""
+import base64
+import datetime
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+import parser
+from parser import (
+    ARCHIVE_DIR, LAST_SYNC_FILE, MSK_TZ, OPERATOR_LOG_GID, OPERATOR_STATS_DB_FILE,
+    OPERATORS_CACHE_FILE, OVERDUE_LOG_GID, RunContext, SYNC_STATE_FILE, THREADS_DB_FILE,
+)
+
+STATE_FILES = [THREADS_DB_FILE, OPERATOR_STATS_DB_FILE, SYNC_STATE_FILE, LAST_SYNC_FILE, OPERATORS_CACHE_FILE]
+IMAP_CACHE_FILE = 'imap.json'
+SHEETS_CACHE_FILE = 'sheets.json'
+STATE_CACHE_DIR = 'state'  # STATE_FILES and ARCHIVE_DIR as they were when the cache was recorded
+
+FETCH_UID_RE = re.compile(rb'UID (\d+)')
+
+
+class InputCache:
+    """JSON file of recorded responses: {key: value}. `replay` is True if the file existed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.replay = bool(path) and os.path.exists(path)
+        self.data = {}
+        if self.replay:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.data = json.load(f)
+
+    def get(self, key, load):
+        """
+        Recorded value for `key`; when recording, calls load() and stores the result.
+        Returns a JSON round-tripped copy, so callers may modify it and recorded and
+        replayed runs see the same types.
+        """
+        if self.replay:
+            if key not in self.data:
+                raise KeyError(f"{key} is not in {self.path}; delete the cache to record again")
+        else:
+            self.data[key] = load()
+        return json.loads(json.dumps(self.data[key]))
+
+    def save(self):
+        if self.path and not self.replay:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(self.data, f, ensure_ascii=False)
+
+
+# --- Sheets -----------------------------------------------------------------
+
+A1_RE = re.compile(r'^([A-Z]+)(\d+)')
+RANGE_RE = re.compile(r'^([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?$')
+
+
+def col_index(letters):
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+    return n - 1
+
+
+def cell_str(value):
+    return '' if value is None else str(value)
+
+
+class PlanWorksheet:
+    """
+    Worksheet whose reads go to the real one (or the cache) and whose writes are recorded.
+    Once a write is planned, later reads are served from a local copy of the sheet with
+    the planned writes applied, so jobs later in the run see them (e.g. archive after sync).
+    """
+
+    def __init__(self, spreadsheet, gid, title, inner=None):
+        self.spreadsheet = spreadsheet
+        self.id = gid
+        self.title = title
+        self._inner = inner
+        self._rows = [] if gid is None else None  # local copy after the first planned write
+
+    def _read(self, method, *args):
+        key = json.dumps([self.spreadsheet.url, self.id, method, args])
+        return self.spreadsheet.client.cache.get(key, lambda: getattr(self._inner, method)(*args))
+
+    def _record(self, op, **details):
+        self.spreadsheet.client.record(op, self.spreadsheet.url, self, **details)
+        if self._rows is None:
+            self._rows = self._read('get_all_values')
+
+    def get_all_values(self):
+        if self._rows is None:
+            return self._read('get_all_values')
+        return [list(row) for row in self._rows]
+
+    def get_all_records(self):
+        if self._rows is None:
+            return self._read('get_all_records')
+        header = self._rows[0] if self._rows else []
+        return [dict(zip(header, row + [''] * (len(header) - len(row)))) for row in self._rows[1:]]
+
+    def col_values(self, col):
+        if self._rows is None:
+            return self._read('col_values', col)
+        values = [row[col - 1] if len(row) >= col else '' for row in self._rows]
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def batch_get(self, ranges):
+        if self._rows is None:
+            return self._read('batch_get', list(ranges))
+        return [self._get_range(a1) for a1 in ranges]
+
+    def append_row(self, values, **kwargs):
+        self.append_rows([values])
+
+    def append_rows(self, values, **kwargs):
+        rows = [list(row) for row in values]
+        self._record('append_rows', rows=rows)
+        self._rows.extend([cell_str(v) for v in row] for row in rows)
+
+    def batch_update(self, data, **kwargs):
+        ranges = [{'range': d['range'], 'values': d['values']} for d in data]
+        self._record('update', ranges=ranges)
+        for r in ranges:
+            self._apply_update(r['range'], r['values'])
+
+    def update(self, values, range_name=None, **kwargs):
+        self.batch_update([{'range': range_name, 'values': values}])
+
+    def delete_rows(self, start_index, end_index=None):
+        self._record('delete_rows', ranges=[[start_index, end_index or start_index]])
+        self.apply_delete(start_index, end_index or start_index)
+
+    def apply_delete(self, first, last):
+        if self._rows is None:
+            self._rows = self._read('get_all_values')
+        del self._rows[first - 1:last]
+
+    def _get_range(self, a1):
+        """Values of an A1 range ('A2:A', 'E2:H') from the local copy, trimmed like the API does."""
+        m = RANGE_RE.match(a1.split('!')[-1])
+        col0 = col_index(m.group(1))
+        col1 = col_index(m.group(3)) if m.group(3) else col0
+        row0 = int(m.group(2) or 1) - 1
+        row1 = int(m.group(4)) if m.group(4) else len(self._rows)
+        values = []
+        for row in self._rows[row0:row1]:
+            cells = row[col0:col1 + 1]
+            while cells and not cells[-1]:
+                cells.pop()
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def _apply_update(self, a1, values):
+        m = A1_RE.match(a1.split('!')[-1])
+        col0, row0 = col_index(m.group(1)), int(m.group(2)) - 1
+        for i, values_row in enumerate(values):
+            while len(self._rows) <= row0 + i:
+                self._rows.append([])
+            row = self._rows[row0 + i]
+            for j, value in enumerate(values_row):
+                while len(row) <= col0 + j:
+                    row.append('')
+                row[col0 + j] = cell_str(value)
+
+
+class PlanSpreadsheet:
+    def __init__(self, client, url, inner=None):
+        self.client = client
+        self.url = url
+        self._inner = inner
+        self._worksheets = None
+
+    def worksheets(self):
+        if self._worksheets is None:
+            inner = {ws.id: ws for ws in self._inner.worksheets()} if self._inner is not None else {}
+            meta = self.client.cache.get(json.dumps([self.url, 'worksheets']),
+                                         lambda: [[ws.id, ws.title] for ws in inner.values()])
+            self._worksheets = [PlanWorksheet(self, gid, title, inner.get(gid)) for gid, title in meta]
+        return list(self._worksheets)
+
+    def add_worksheet(self, title, rows=100, cols=26, **kwargs):
+        ws = PlanWorksheet(self, None, title)
+        self.client.record('add_worksheet', self.url, ws, rows=rows, cols=cols)
+        self.worksheets()
+        self._worksheets.append(ws)
+        return ws
+
+    def batch_update(self, body):
+        for request in body.get('requests', []):
+            dim = request['deleteDimension']['range']
+            ws = next((w for w in self.worksheets() if w.id == dim['sheetId']), None)
+            # deleteDimension indices are 0-based, end exclusive -> 1-based inclusive rows
+            first, last = dim['startIndex'] + 1, dim['endIndex']
+            self.client.record('delete_rows', self.url, ws, ranges=[[first, last]])
+            if ws is not None:
+                ws.apply_delete(first, last)
+        return {}
+
+
+class PlanClient:
+    """gspread-compatible client that records writes in `operations` (`inner` may be None when replaying)."""
+
+    def __init__(self, inner, cache):
+        self._inner = inner
+        self.cache = cache
+        self._spreadsheets = {}
+        self.operations = []
+
+    def open_by_url(self, url):
+        if url not in self._spreadsheets:
+            inner = self._inner.open_by_url(url) if self._inner is not None else None
+            self._spreadsheets[url] = PlanSpreadsheet(self, url, inner)
+        return self._spreadsheets[url]
+
+    def record(self, op, url, ws, **details):
+        self.operations.append(dict({'op': op, 'spreadsheet': url,
+                                     'gid': ws.id if ws else None, 'sheet': ws.title if ws else None}, **details))
+
+
+# --- IMAP -------------------------------------------------------------------
+
+class _Folders:
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+
+    def exists(self, folder):
+        return self.mailbox._cached(['exists', folder], lambda: self.mailbox._inner.folder.exists(folder))
+
+    def set(self, folder, readonly=False):
+        self.mailbox.selected = folder
+        if self.mailbox._inner is not None:
+            self.mailbox._inner.folder.set(folder)
+
+    def status(self, folder=None, options=None):
+        folder = folder or self.mailbox.selected
+        return self.mailbox._cached(['status', folder],
+                                    lambda: dict(self.mailbox._inner.folder.status(folder, options)))
+
+
+class _Client:
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+
+    def uid(self, command, uid_set, message_parts):
+        mailbox = self.mailbox
+        headers = mailbox.cache.data.setdefault('headers', {}).setdefault(mailbox.selected, {})
+        if not mailbox.cache.replay:
+            status, data = mailbox._inner.client.uid(command, uid_set, message_parts)
+            if status != 'OK':
+                return status, data
+            for fetch_item in parser.fetch_items(data):
+                # UID is in the tuple's first part or, on some servers, in the item after it
+                uid = FETCH_UID_RE.search(b' '.join([fetch_item[0][0]] + fetch_item[1:])).group(1).decode()
+                headers[uid] = base64.b64encode(fetch_item[0][1]).decode()
+            return status, data
+        data = []
+        for n, uid in enumerate(uid_set.split(',')):
+            if uid not in headers:
+                raise KeyError(f"UID {uid} in {mailbox.selected} is not in {mailbox.cache.path}")
+            raw = base64.b64decode(headers[uid])
+            data.append((f'{n + 1} (UID {uid} BODY[HEADER.FIELDS] {{{len(raw)}}}'.encode(), raw))
+            data.append(b')')
+        return 'OK', data
+
+
+class CachingMailBox:
+    """MailBox stand-in: records STATUS / SEARCH / FETCH of `inner` into the cache, or replays them."""
+
+    def __init__(self, inner, cache):
+        self._inner = inner
+        self.cache = cache
+        self.selected = None
+        self.folder = _Folders(self)
+        self.client = _Client(self)
+
+    def _cached(self, key, load):
+        return self.cache.get(json.dumps(key), load)
+
+    def uids(self, criteria='ALL', *args, **kwargs):
+        return self._cached(['uids', self.selected, str(criteria)], lambda: self._inner.uids(criteria))
+
+    def logout(self):
+        if self._inner is not None:
+            self._inner.logout()
+
+
+# --- Run --------------------------------------------------------------------
+
+def summarize(operations):
+    summary = {'appended_rows': 0, 'updated_cells': 0, 'deleted_rows': 0, 'new_worksheets': 0}
+    for op in operations:
+        if op['op'] == 'append_rows':
+            summary['appended_rows'] += len(op['rows'])
+        elif op['op'] == 'update':
+            summary['updated_cells'] += sum(len(row) for r in op['ranges'] for row in r['values'])
+        elif op['op'] == 'delete_rows':
+            summary['deleted_rows'] += sum(last - first + 1 for first, last in op['ranges'])
+        elif op['op'] == 'add_worksheet':
+            summary['new_worksheets'] += 1
+    return summary
+
+
+def copy_state(src_dir, dst_dir):
+    """Copies STATE_FILES and ARCHIVE_DIR that exist in `src_dir` into `dst_dir`."""
+    os.makedirs(dst_dir, exist_ok=True)
+    for name in STATE_FILES:
+        if os.path.exists(os.path.join(src_dir, name)):
+            shutil.copy2(os.path.join(src_dir, name), os.path.join(dst_dir, name))
+    if os.path.isdir(os.path.join(src_dir, ARCHIVE_DIR)):
+        shutil.copytree(os.path.join(src_dir, ARCHIVE_DIR), os.path.join(dst_dir, ARCHIVE_DIR))
+
+
+def run_plan(cache_dir=None, out_file=None):
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    imap_cache = InputCache(os.path.join(cache_dir, IMAP_CACHE_FILE) if cache_dir else None)
+    sheets_cache = InputCache(os.path.join(cache_dir, SHEETS_CACHE_FILE) if cache_dir else None)
+
+    # Jobs print progress; keep stdout for the JSON plan
+    real_stdout, sys.stdout = sys.stdout, sys.stderr
+    state_dir = tempfile.mkdtemp(prefix='parser-plan-')
+    try:
+        # Replayed inputs only make sense against the checkpoints and mirrors they were recorded with
+        state_source = os.curdir
+        if cache_dir:
+            cached_state = os.path.join(cache_dir, STATE_CACHE_DIR)
+            if not (imap_cache.replay or sheets_cache.replay):
+                shutil.rmtree(cached_state, ignore_errors=True)
+                copy_state(os.curdir, cached_state)
+            elif os.path.isdir(cached_state):
+                state_source = cached_state
+            else:
+                print(f"No recorded state in {cached_state}, replaying against the current state files")
+        copy_state(state_source, state_dir)
+
+        inner_client = None if sheets_cache.replay else parser.RunContext().client
+        client = PlanClient(inner_client, sheets_cache)
+        if imap_cache.replay:
+            mailbox_factory = lambda: CachingMailBox(None, imap_cache)
+        else:
+            mailbox_factory = lambda: CachingMailBox(parser.open_mailbox(), imap_cache)
+        if imap_cache.replay or sheets_cache.replay:
+            # Replayed inputs need credentials only to pass the checks in the jobs
+            parser.YANDEX_EMAIL = parser.YANDEX_EMAIL or 'replay'
+            parser.YANDEX_PASSWORD = parser.YANDEX_PASSWORD or 'replay'
+
+        ctx = RunContext(client=client, mailbox_factory=mailbox_factory, state_dir=state_dir)
+        jobs = {}
+        with ctx.metrics.phase('sync'):
+            jobs['sync'] = parser.sync_emails(ctx)
+        with ctx.metrics.phase('operators'):
+            jobs['operators'] = parser.log_operator_activity(ctx, OPERATOR_LOG_GID)
+        with ctx.metrics.phase('overdue'):
+            jobs['overdue'] = parser.log_overdue_emails(ctx, OVERDUE_LOG_GID)
+        with ctx.metrics.phase('archive'):
+            jobs['archive'] = parser.archive_inactive_threads(ctx)
+        ctx.close_mailbox()
+        imap_cache.save()
+        sheets_cache.save()
+    finally:
+        sys.stdout = real_stdout
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+    plan = {
+        'generated_at': datetime.datetime.now(MSK_TZ).isoformat(),
+        'inputs': {
+            'imap': 'replay' if imap_cache.replay else 'live',
+            'sheets': 'replay' if sheets_cache.replay else 'live',
+        },
+        'jobs': jobs,
+        'timings': {name: p['seconds'] for name, p in ctx.metrics.report()['phases'].items()},
+        'summary': summarize(client.operations),
+        'operations': client.operations,
+    }
+    text = json.dumps(plan, ensure_ascii=False, indent=2)
+    if out_file:
+        with open(out_file, 'w', encoding='utf-8') as f:
+            f.write(text)
+        print(f"Plan written to {out_file}: {plan['summary']}")
+    else:
+        print(text)
+    return plan
@@ -0,0 +1,88 @@
+/**
+ * Thread state transitions from the parser's event stream (GET /events on PARSER_API_URL,
+ * see read_api.py): thread_new, status_changed, thread_updated, overdue, archived, closed.
+ * Reconnects after errors and resumes after the last received event id.
+ */
+
+const RECONNECT_DELAY_MS = 5000;
+
+/**
+ * Parse one SSE message block ("id: ..\nevent: ..\ndata: ..") into { id, type, data }
+ */
+function parseEvent(block) {
+    const event = { id: null, type: 'message', data: '' };
+    for (const line of block.split('\n')) {
+        if (!line || line.startsWith(':')) continue; // comment / keep-alive
+        const sep = line.indexOf(':');
+        const field = sep === -1 ? line : line.slice(0, sep);
+        const value = sep === -1 ? '' : line.slice(sep + 1).replace(/^ /, '');
+        if (field === 'id') event.id = value;
+        else if (field === 'event') event.type = value;
+        else if (field === 'data') event.data += (event.data ? '\n' : '') + value;
+    }
+    if (!event.data) return null;
+    try {
+        event.data = JSON.parse(event.data);
+    } catch (e) {
+        return null;
+    }
+    return event;
+}
+
+/**
+ * Subscribe to thread events. onEvent({ id, type, data }) is called for every event,
+ * onStatus(connected) when the stream connects or drops.
+ * Returns a function that stops the subscription.
+ */
+function subscribeThreadEvents(onEvent, onStatus = () => {}) {
+    const baseUrl = process.env.PARSER_API_URL;
+    if (!baseUrl) return () => {};
+
+    let lastEventId = null;
+    let stopped = false;
+    let controller = null;
+
+    async function connect() {
+        while (!stopped) {
+            controller = new AbortController();
+            try {
+                const headers = lastEventId ? { 'Last-Event-ID': lastEventId } : {};
+                const response = await fetch(new URL('/events', baseUrl), { headers, signal: controller.signal });
+                if (!response.ok) {
+                    throw new Error(`Parser API responded with HTTP ${response.status}`);
+                }
+                onStatus(true);
+
+                const decoder = new TextDecoder();
+                let buffer = '';
+                for await (const chunk of response.body) {
+                    buffer += decoder.decode(chunk, { stream: true });
+                    let end;
+                    while ((end = buffer.indexOf('\n\n')) !== -1) {
+                        const event = parseEvent(buffer.slice(0, end));
+                        buffer = buffer.slice(end + 2);
+                        if (event) {
+                            if (event.id) lastEventId = event.id;
+                            onEvent(event);
+                        }
+                    }
+                }
+            } catch (error) {
+                if (!stopped) console.error('Event stream error:', error.message);
+            }
+            if (stopped) break;
+            onStatus(false);
+            await new Promise(resolve => setTimeout(resolve, RECONNECT_DELAY_MS));
+        }
+    }
+
+    connect();
+    return () => {
+        stopped = true;
+        if (controller) controller.abort();
+    };
+}
+
+module.exports = {
+    subscribeThreadEvents
+};
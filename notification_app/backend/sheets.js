@@ -17,6 +17,9 @@ const SCOPES = ['https://www.googleapis.com/auth/spreadsheets'];
 
 let sheetsClient = null;
 
+// Local copy of the table from the parser's read API (python parser.py serve)
+let apiCache = { version: null, rows: new Map() };
+
 /**
  * Initialize Google Sheets API client
  */
@@ -51,11 +54,79 @@ function extractSpreadsheetId(url) {
     return match ? match[1] : null;
 }
 
+/**
+ * Map a sheet row (A:H values) to an email object
+ */
+function rowToEmail(row, rowIndex) {
+    return {
+        id: row[0] || '',
+        subject: row[1] || '',
+        sender: row[2] || '',
+        time: row[3] || '',
+        status: row[4] || '',
+        type: row[5] || '',
+        lastReplyer: row[6] || '',
+        reminderStatus: row[7] || '',
+        rowIndex // For reference (1-indexed, after header)
+    };
+}
+
+/**
+ * Map a parser event payload (see parser.thread_event_data) to an email object
+ */
+function eventToEmail(data) {
+    return rowToEmail([
+        data.id, data.subject, data.sender, data.time, data.status,
+        data.type, data.last_replyer, data.last_activity
+    ], data.row);
+}
+
+/**
+ * Fetch emails from the parser's local read API (PARSER_API_URL).
+ * The first call downloads the whole table, later calls send the known version
+ * (If-None-Match / ?since=) and only apply changed and deleted rows.
+ */
+async function getEmailsFromParserApi() {
+    const url = new URL('/threads', process.env.PARSER_API_URL);
+    const headers = {};
+    if (apiCache.version !== null) {
+        url.searchParams.set('since', apiCache.version);
+        headers['If-None-Match'] = `"${apiCache.version}"`;
+    }
+
+    const response = await fetch(url, { headers });
+    if (response.status !== 304) {
+        if (!response.ok) {
+            throw new Error(`Parser API responded with HTTP ${response.status}`);
+        }
+        const body = await response.json();
+        if (body.full) {
+            apiCache.rows = new Map();
+        }
+        body.deleted.forEach(key => apiCache.rows.delete(key));
+        body.rows.forEach(row => apiCache.rows.set(row.key, row));
+        apiCache.version = body.version;
+    }
+
+    return [...apiCache.rows.values()]
+        .sort((a, b) => a.row - b.row)
+        .map(row => rowToEmail(row.values, row.row));
+}
+
 /**
  * Fetch all emails from Google Sheet
  * Returns array of objects with: id, subject, sender, time, status, type, lastReplyer
+ * Uses the parser's read API instead when PARSER_API_URL is set (falls back to Sheets on error)
  */
 async function getEmails() {
+    if (process.env.PARSER_API_URL) {
+        try {
+            return await getEmailsFromParserApi();
+        } catch (error) {
+            console.error('Parser API unavailable, reading Google Sheets:', error.message);
+        }
+    }
+
     try {
         const client = await initClient();
         const sheetUrl = process.env.GOOGLE_SHEET_URL;
@@ -88,17 +159,7 @@ async function getEmails() {
         }
 
         // Skip header row
-        const emails = rows.slice(1).map((row, index) => ({
-            id: row[0] || '',
-            subject: row[1] || '',
-            sender: row[2] || '',
-            time: row[3] || '',
-            status: row[4] || '',
-            type: row[5] || '',
-            lastReplyer: row[6] || '',
-            reminderStatus: row[7] || '',
-            rowIndex: index + 2 // For reference (1-indexed, after header)
-        }));
+        const emails = rows.slice(1).map((row, index) => rowToEmail(row, index + 2));
 
         return emails;
     } catch (error) {
@@ -227,9 +288,51 @@ async function getOperators() {
 }
 
 /**
- * Update reminder status for an email row
+ * Close a reminder through the parser's read API (POST /threads/close): the parser writes
+ * 'закрыт' to the sheet, its mirror and the snapshot, so the next getEmails() already
+ * returns the closed row. Sends PARSER_API_TOKEN (the server's READ_API_TOKEN) if set.
+ * Returns false if the API is unreachable or does not accept writes.
+ */
+async function closeReminderViaParserApi(id) {
+    const headers = { 'Content-Type': 'application/json' };
+    if (process.env.PARSER_API_TOKEN) {
+        headers.Authorization = `Bearer ${process.env.PARSER_API_TOKEN}`;
+    }
+    let response;
+    try {
+        response = await fetch(new URL('/threads/close', process.env.PARSER_API_URL), {
+            method: 'POST',
+            headers,
+            body: JSON.stringify({ id })
+        });
+    } catch (error) {
+        console.error('Parser API unavailable, writing to Google Sheets:', error.message);
+        return false;
+    }
+    if (response.status === 404 && !(await response.clone().json().catch(() => ({}))).not_found) {
+        // Writes are disabled on this server (bound to the network without READ_API_TOKEN)
+        console.error('Parser API does not accept closes, writing to Google Sheets');
+        return false;
+    }
+    if (!response.ok) {
+        const body = await response.json().catch(() => ({}));
+        throw new Error(body.error || `Parser API responded with HTTP ${response.status}`);
+    }
+    return true;
+}
+
+/**
+ * Update reminder status for an email row.
+ * With PARSER_API_URL a close goes through the parser (the table is read from its snapshot,
+ * a direct sheet write would show up there only after the next sync)
  */
-async function updateReminderStatus(rowIndex, status) {
+async function updateReminderStatus(rowIndex, status, id = null) {
+    if (process.env.PARSER_API_URL && status === 'закрыт' && id) {
+        if (await closeReminderViaParserApi(id)) {
+            return { success: true };
+        }
+    }
+
     try {
         const client = await initClient();
         const sheetUrl = process.env.GOOGLE_SHEET_URL;
@@ -288,6 +391,7 @@ module.exports = {
     getOverdueEmails,
     isOverdue,
     checkNotificationCriteria, // Exported
+    eventToEmail,
     getOperators,
     updateReminderStatus,
     test
@@ -1,6 +1,7 @@
 const { app, BrowserWindow, Tray, Menu, nativeImage, ipcMain, Notification } = require('electron');
 const path = require('path');
 const sheets = require('./backend/sheets');
+const events = require('./backend/events');
 
 // Keep references to prevent garbage collection
 let mainWindow = null;
@@ -170,9 +171,9 @@ ipcMain.handle('get-operators', async () => {
     }
 });
 
-ipcMain.handle('close-reminder', async (event, rowIndex) => {
+ipcMain.handle('close-reminder', async (event, rowIndex, id) => {
     try {
-        await sheets.updateReminderStatus(rowIndex, 'закрыт');
+        await sheets.updateReminderStatus(rowIndex, 'закрыт', id);
         return { success: true };
     } catch (error) {
         console.error('Error closing reminder:', error);
@@ -255,6 +256,11 @@ ipcMain.handle('get-test-emails', async () => {
     return { success: true, data: enriched };
 });
 
+// Re-evaluate notification timers for emails the renderer already has (no network)
+ipcMain.handle('check-notifications', async (event, emailList) => {
+    return { success: true, data: emailList.map(email => sheets.checkNotificationCriteria(email)) };
+});
+
 ipcMain.handle('clear-test-emails', async () => {
     testEmails = [];
     return { success: true };
@@ -264,6 +270,19 @@ ipcMain.handle('clear-test-emails', async () => {
 app.whenReady().then(() => {
     createWindow();
     createTray();
+
+    // Parser event stream (PARSER_API_URL): forward thread state transitions to the renderer,
+    // with the changed row as an email object ready to be applied
+    events.subscribeThreadEvents(event => {
+        if (!mainWindow) return;
+        const email = sheets.eventToEmail(event.data);
+        mainWindow.webContents.send('thread-event', {
+            ...event,
+            email: { ...email, notificationCheck: sheets.checkNotificationCriteria(email) }
+        });
+    }, connected => {
+        if (mainWindow) mainWindow.webContents.send('thread-events-status', connected);
+    });
 });
 
 app.on('window-all-closed', () => {
@@ -20,7 +20,7 @@ contextBridge.exposeInMainWorld('api', {
 
     // Reminder system API
     getOperators: () => ipcRenderer.invoke('get-operators'),
-    closeReminder: (rowIndex) => ipcRenderer.invoke('close-reminder', rowIndex),
+    closeReminder: (rowIndex, id) => ipcRenderer.invoke('close-reminder', rowIndex, id),
 
 
     // Listen for new overdue emails (from main process)
@@ -31,5 +31,18 @@ contextBridge.exposeInMainWorld('api', {
     // Remove listener
     removeOverdueListener: () => {
         ipcRenderer.removeAllListeners('new-overdue-emails');
+    },
+
+    // Re-evaluate notification criteria for already loaded emails
+    checkNotifications: (emails) => ipcRenderer.invoke('check-notifications', emails),
+
+    // Thread state transitions from the parser's event stream ({ id, type, data, email })
+    onThreadEvent: (callback) => {
+        ipcRenderer.on('thread-event', (event, threadEvent) => callback(threadEvent));
+    },
+
+    // Event stream connected (true) or dropped (false)
+    onThreadEventsStatus: (callback) => {
+        ipcRenderer.on('thread-events-status', (event, connected) => callback(connected));
     }
 });
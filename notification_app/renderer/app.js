@@ -10,6 +10,8 @@ let currentFilter = 'all';
 let searchQuery = '';
 let previousOverdueIds = new Set();
 let isFirstLoad = true;
+let lastLoadTime = 0; // Date.now() of the last successful full load
+let eventStreamConnected = false;
 
 // Pagination State
 let currentPage = 1;
@@ -17,6 +19,8 @@ const itemsPerPage = 10;
 
 // Constants
 const REFRESH_INTERVAL = 30000; // 30 seconds
+const FALLBACK_REFRESH_INTERVAL = 5 * 60 * 1000; // full reload while parser events arrive
+const EVENT_APPLY_DELAY = 500; // ms to collect a burst of parser events before re-rendering
 const OVERDUE_HOURS = 6;
 const REMINDER_HOURS = 3; // Hours after external reply to trigger reminder
 
@@ -59,6 +63,7 @@ document.addEventListener('DOMContentLoaded', () => {
     loadOperators(); // Load operators for reminder system
     loadEmails();
     startAutoRefresh();
+    subscribeThreadEvents();
 });
 
 function initTitlebarButtons() {
@@ -172,6 +177,7 @@ async function loadEmails() {
 
         if (result.success) {
             emails = result.data.map(processEmail);
+            lastLoadTime = Date.now();
             applyFilters();
             renderTable();
             updateStats();
@@ -550,10 +556,10 @@ function showAwaitingReplyNotification(awaitingEmails) {
  */
 async function closeReminder(rowIndex) {
     try {
-        const result = await window.api.closeReminder(rowIndex);
+        const email = emails.find(e => e.rowIndex === rowIndex);
+        const result = await window.api.closeReminder(rowIndex, email ? email.id : null);
         if (result.success) {
             // Update local state
-            const email = emails.find(e => e.rowIndex === rowIndex);
             if (email) {
                 email.reminderStatus = 'закрыт';
                 notifiedReminderIds.delete(email.id);
@@ -661,12 +667,85 @@ function setConnectionStatus(connected) {
 // ========================================
 // Auto Refresh
 // ========================================
+// Every REFRESH_INTERVAL: a full reload, or, while the parser event stream keeps the list
+// current, only a local re-check of the time-based criteria (full reload as a slow fallback)
 function startAutoRefresh() {
     setInterval(() => {
-        loadEmails();
+        const interval = eventStreamConnected ? FALLBACK_REFRESH_INTERVAL : REFRESH_INTERVAL;
+        if (Date.now() - lastLoadTime >= interval) {
+            loadEmails();
+        } else {
+            recheckEmails();
+        }
     }, REFRESH_INTERVAL);
 }
 
+/**
+ * Re-evaluate overdue / reminder timers of the loaded emails without fetching them
+ */
+async function recheckEmails() {
+    try {
+        const result = await window.api.checkNotifications(emails);
+        if (!result.success) return;
+        emails = emails.map((email, i) => processEmail({ ...email, notificationCheck: result.data[i] }));
+        applyFilters();
+        renderTable();
+        updateStats();
+        checkForNewOverdueEmails();
+        checkForAwaitingReplyEmails();
+    } catch (error) {
+        console.error('Failed to re-check emails:', error);
+    }
+}
+
+/**
+ * Apply parser events (new thread, status change, overdue, archived, closed) to the
+ * list directly: each carries the changed row. A burst of events from one parser run
+ * is rendered once. Archiving shifts sheet rows, so it also triggers a full reload.
+ */
+function subscribeThreadEvents() {
+    if (!window.api.onThreadEvent) return;
+    let pending = [];
+    let applyTimer = null;
+
+    window.api.onThreadEventsStatus?.(connected => {
+        eventStreamConnected = connected;
+    });
+
+    window.api.onThreadEvent(event => {
+        eventStreamConnected = true;
+        pending.push(event);
+        clearTimeout(applyTimer);
+        applyTimer = setTimeout(() => {
+            const batch = pending;
+            pending = [];
+            applyThreadEvents(batch);
+        }, EVENT_APPLY_DELAY);
+    });
+}
+
+function applyThreadEvents(batch) {
+    let reload = false;
+    for (const event of batch) {
+        const index = emails.findIndex(e => e.id === event.data.id);
+        if (event.type === 'archived') {
+            if (index !== -1) emails.splice(index, 1);
+            reload = true;
+        } else if (index !== -1) {
+            emails[index] = processEmail(event.email);
+        } else {
+            emails.push(processEmail(event.email));
+        }
+    }
+
+    applyFilters();
+    renderTable();
+    updateStats();
+    checkForNewOverdueEmails();
+    checkForAwaitingReplyEmails();
+    if (reload) loadEmails();
+}
+
 // ========================================
 // Utilities
 // ========================================
@@ -803,6 +882,7 @@ loadEmails = async function () {
 
             emails = [...realEmails, ...testEmailsProcessed];
             testEmails = testResult.data || [];
+            lastLoadTime = Date.now();
 
             applyFilters();
             renderTable();
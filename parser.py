@@ -1,13 +1,23 @@
 import os
+import sys
+import time
 import datetime
 import re
 from datetime import timedelta
 from dotenv import load_dotenv
-from imap_tools import MailBox, AND
-import gspread
-from google.oauth2.service_account import Credentials
 import email.utils
 import json
+import heapq
+import sqlite3
+import gzip
+import hashlib
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from collections import namedtuple
+from operator import attrgetter
+from functools import lru_cache
 
 # Load environment variables
 load_dotenv()
@@ -17,11 +27,22 @@ YANDEX_PASSWORD = os.getenv('YANDEX_PASSWORD')
 GOOGLE_SHEET_URL = os.getenv('GOOGLE_SHEET_URL')
 CREDENTIALS_FILE = 'credentials.json'
 
+IMAP_HOST = 'mail.21vek.tech'
+IMAP_PORT = 993
+
 SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets',
     'https://www.googleapis.com/auth/drive'
 ]
 
+# Only these headers are fetched from IMAP (no bodies/attachments)
+HEADER_FIELDS = ('MESSAGE-ID', 'IN-REPLY-TO', 'REFERENCES', 'SUBJECT', 'FROM', 'DATE')
+FETCH_BULK_SIZE = 200  # UIDs per FETCH command
+IMAP_POOL_SIZE = int(os.getenv('IMAP_POOL_SIZE', '3'))  # parallel IMAP connections for folder scans
+IMAP_SCAN_CHUNK = 1000  # UIDs per parallel fetch task within one folder
+# How far Date headers may run behind arrival (UID) order in a folder, see MailTimeline
+IMAP_STREAM_SLACK = datetime.timedelta(minutes=int(os.getenv('IMAP_STREAM_SLACK_MINUTES', '60')))
+
 SENT_FOLDER_NAMES = ['&BB4EQgQ,BEAEMAQyBDsENQQ9BD0ESwQ1-', 'Sent', 'Send', 'Отправленные', 'Sent Items']
 
 # Archive settings
@@ -29,15 +50,68 @@ ARCHIVE_SHEET_URL = "https://docs.google.com/spreadsheets/d/1mv3pbNrGThHexCoHFxK
 ARCHIVE_GID = 0  # Main archive sheet
 STATS_GID = 96142908  # Statistics sheet
 INACTIVE_MONTHS = 3  # Months of inactivity before archiving
+ARCHIVE_DIR = '.archive'  # local archive store: <year-month>.jsonl.gz partitions + index.db
+ARCHIVE_SHEET_MAX_ROWS = int(os.getenv('ARCHIVE_SHEET_MAX_ROWS', '0'))  # keep only the newest N rows in the archive sheet, 0 = all
+# Trimmed rows live only in ARCHIVE_DIR: under CI (its cache can be evicted) trimming also needs this set to 1
+ARCHIVE_DIR_PERSISTENT = os.getenv('ARCHIVE_DIR_PERSISTENT', '') == '1'
 
 # Timezone (UTC+3 for Moscow)
 MSK_TZ = datetime.timezone(datetime.timedelta(hours=3))
 
 # Operators sheet GID
 OPERATORS_GID = 2115150025
+# Cached operator list (column A of OPERATORS_GID), see OperatorDirectory
+OPERATORS_CACHE_FILE = '.operators.json'
+OPERATORS_CACHE_TTL = int(os.getenv('OPERATORS_CACHE_TTL', str(15 * 60)))  # seconds to trust the cached list
+
+# Lightweight message record used by the sync timeline (no MailMessage kept)
+MailRecord = namedtuple('MailRecord', ['date', 'uid', 'msg_id', 'refs', 'subject', 'from_', 'email_type'])
+
+# Target log sheets (GIDs in GOOGLE_SHEET_URL)
+OPERATOR_LOG_GID = 1286665239
+OVERDUE_LOG_GID = 148916183
+
+# Daemon mode (python parser.py --daemon)
+DAEMON_IDLE_TIMEOUT = 60  # seconds per IDLE wait (RFC 2177 asks to re-issue IDLE before 29 min)
+DAEMON_JOB_INTERVALS = {  # seconds between timer-driven jobs
+    'operators': 10 * 60,
+    'overdue': 5 * 60,
+    'archive': 24 * 60 * 60,
+}
+DAEMON_WORKSHEET_TTL = 30 * 60  # seconds to trust cached worksheet metadata
+DAEMON_RETRY_MIN = 5  # reconnect backoff, seconds
+DAEMON_RETRY_MAX = 300
+
+# Run metrics (see RunMetrics): JSON report and Prometheus textfile (node_exporter)
+METRICS_REPORT_FILE = os.getenv('METRICS_REPORT_FILE', 'run_report.json')
+METRICS_PROM_FILE = os.getenv('METRICS_PROM_FILE', 'parser.prom')
+RUN_SCHEDULE_INTERVAL = 10 * 60  # seconds between scheduled runs (see deploy.yml)
+RUN_DURATION_WARN_RATIO = 0.8  # warn when a run takes this share of the interval
 
 # Sync state file
 LAST_SYNC_FILE = '.last_sync'
+# Per-folder UID checkpoints: {folder: {"uidvalidity": int, "last_uid": int}}
+SYNC_STATE_FILE = '.sync_state.json'
+
+# Local SQLite mirror of the main threads sheet (GID=0)
+THREADS_DB_FILE = '.threads.db'
+THREADS_RECONCILE_INTERVAL = 60 * 60  # seconds between full sheet downloads
+THREADS_VERIFY_INTERVAL = 60  # seconds to trust the column A check
+# Main sheet records as of the last sync/archive, for local readers (see write_threads_snapshot)
+THREADS_SNAPSHOT_FILE = os.getenv('THREADS_SNAPSHOT_FILE', 'threads_snapshot.json')
+SNAPSHOT_TOMBSTONE_VERSIONS = 1000  # snapshot versions a deleted row is remembered for (delta readers)
+EVENTS_RETENTION_DAYS = 7  # thread state transitions kept for the event stream (read_api /events)
+
+# Overdue log (GID OVERDUE_LOG_GID): unanswered threads older than OVERDUE_AFTER
+OVERDUE_STATUS = 'ответа нет'
+OVERDUE_AFTER = timedelta(hours=3)
+OVERDUE_DURATION_REFRESH_INTERVAL = 60 * 60  # seconds between duration (col E) rewrites
+OVERDUE_LOG_RECONCILE_INTERVAL = 24 * 60 * 60  # seconds between full reads of the overdue log
+
+# Local counters behind the OperatorStats sheet and the ids already in the operator log
+OPERATOR_STATS_DB_FILE = '.operator_stats.db'
+OPERATOR_STATS_RECONCILE_INTERVAL = 24 * 60 * 60  # seconds between full recounts from the log
+OPERATOR_LOG_ID_RETENTION_DAYS = 7  # logged ids kept for dedup (the scan window is 24h)
 
 def get_credentials():
     """
@@ -45,6 +119,8 @@ def get_credentials():
     Tries to load from GCP_CREDENTIALS_JSON env var first,
     then falls back to CREDENTIALS_FILE.
     """
+    from google.oauth2.service_account import Credentials
+
     if os.getenv('GCP_CREDENTIALS_JSON'):
         try:
             info = json.loads(os.getenv('GCP_CREDENTIALS_JSON'))
@@ -58,68 +134,1048 @@ def get_credentials():
     
     raise FileNotFoundError(f"Credentials not found (Env var GCP_CREDENTIALS_JSON or file '{CREDENTIALS_FILE}')")
 
-def get_sheet():
-    creds = get_credentials()
-    client = gspread.authorize(creds)
+class RunMetrics:
+    """
+    Per-run instrumentation: phase durations, counters and Sheets request counts.
+    - phase(name): context manager, adds wall time and the Sheets reads/writes made
+      inside it to phases[name] (phases nest: 'sync' includes 'sync.write'); requests
+      are counted per thread, so phases of concurrent pipeline lanes don't mix
+    - record(name, seconds): adds time measured by the caller (e.g. in pool threads)
+    - count(name, n): counters such as messages_fetched or imap_bytes_fetched
+    write() saves a JSON report and a Prometheus textfile, both replaced atomically.
+    reset() starts a new run on the same object (one daemon cycle = one run).
+    """
+
+    def __init__(self, sheets_stats=None, sheets_thread_stats=None):
+        self._sheets_stats = sheets_stats or (lambda: {})
+        self._sheets_thread_stats = sheets_thread_stats or self._sheets_stats
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clears phases and counters and restarts the clock; Sheets totals count from here."""
+        with self._lock:
+            self.started_at = time.time()
+            self._started = time.monotonic()
+            self._sheets_base = dict(self._sheets_stats())
+            self.phases = {}  # name -> {'seconds', 'calls', 'sheets_reads', 'sheets_writes'}
+            self.counters = {}
+
+    def _phase(self, name):
+        return self.phases.setdefault(name, {'seconds': 0.0, 'calls': 0, 'sheets_reads': 0, 'sheets_writes': 0})
+
+    @contextmanager
+    def phase(self, name):
+        before = dict(self._sheets_thread_stats())
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            after = self._sheets_thread_stats()
+            with self._lock:
+                phase = self._phase(name)
+                phase['seconds'] += elapsed
+                phase['calls'] += 1
+                phase['sheets_reads'] += after.get('reads', 0) - before.get('reads', 0)
+                phase['sheets_writes'] += after.get('writes', 0) - before.get('writes', 0)
+
+    def record(self, name, seconds):
+        with self._lock:
+            phase = self._phase(name)
+            phase['seconds'] += seconds
+            phase['calls'] += 1
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        return {
+            'started_at': datetime.datetime.fromtimestamp(self.started_at, MSK_TZ).isoformat(),
+            'duration_seconds': round(time.monotonic() - self._started, 3),
+            'schedule_interval_seconds': RUN_SCHEDULE_INTERVAL,
+            'phases': {name: dict(p, seconds=round(p['seconds'], 3)) for name, p in sorted(self.phases.items())},
+            'counters': dict(sorted(self.counters.items())),
+            'sheets': {name: round(value - self._sheets_base.get(name, 0), 3)
+                       for name, value in self._sheets_stats().items()},
+        }
+
+    def prometheus(self, report):
+        """Prometheus text exposition format (for node_exporter's textfile collector)."""
+        lines = [
+            '# HELP parser_run_duration_seconds Wall time of the last run.',
+            '# TYPE parser_run_duration_seconds gauge',
+            f"parser_run_duration_seconds {report['duration_seconds']}",
+            '# HELP parser_run_timestamp_seconds Start time of the last run (unix).',
+            '# TYPE parser_run_timestamp_seconds gauge',
+            f"parser_run_timestamp_seconds {self.started_at:.0f}",
+            '# HELP parser_schedule_interval_seconds Interval between scheduled runs.',
+            '# TYPE parser_schedule_interval_seconds gauge',
+            f"parser_schedule_interval_seconds {RUN_SCHEDULE_INTERVAL}",
+            '# HELP parser_phase_duration_seconds Wall time spent in a phase.',
+            '# TYPE parser_phase_duration_seconds gauge',
+        ]
+        lines += [f'parser_phase_duration_seconds{{phase="{name}"}} {p["seconds"]}'
+                  for name, p in report['phases'].items()]
+        lines += ['# HELP parser_phase_sheets_requests Sheets API requests made in a phase.',
+                  '# TYPE parser_phase_sheets_requests gauge']
+        for name, p in report['phases'].items():
+            lines.append(f'parser_phase_sheets_requests{{phase="{name}",kind="read"}} {p["sheets_reads"]}')
+            lines.append(f'parser_phase_sheets_requests{{phase="{name}",kind="write"}} {p["sheets_writes"]}')
+        lines += ['# HELP parser_count Per-run counters (messages, bytes, rows).',
+                  '# TYPE parser_count gauge']
+        lines += [f'parser_count{{name="{name}"}} {value}' for name, value in report['counters'].items()]
+        lines += ['# HELP parser_sheets SheetsGateway totals for the run.',
+                  '# TYPE parser_sheets gauge']
+        lines += [f'parser_sheets{{name="{name}"}} {value}' for name, value in report['sheets'].items()]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, report_file=None, prom_file=None):
+        """Writes the JSON report and the Prometheus textfile. Returns the report."""
+        report = self.report()
+        outputs = [(report_file or METRICS_REPORT_FILE, json.dumps(report, ensure_ascii=False, indent=2)),
+                   (prom_file or METRICS_PROM_FILE, self.prometheus(report))]
+        for path, content in outputs:
+            tmp_file = path + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp_file, path)
+        if report['duration_seconds'] > RUN_SCHEDULE_INTERVAL * RUN_DURATION_WARN_RATIO:
+            print(f"Warning: run took {report['duration_seconds']:.0f}s of the {RUN_SCHEDULE_INTERVAL}s schedule interval")
+        return report
+
+class RunContext:
+    """
+    Resources shared by all jobs of one run (or of the whole daemon lifetime):
+    one authorized gspread client, one Spreadsheet handle per URL and one IMAP session.
+    Worksheet metadata is fetched once per spreadsheet (or once per `worksheet_ttl`
+    seconds) and refetched early only when a requested GID/title is missing.
+    `records` holds the MailRecords fetched by sync_emails() so that
+    log_operator_activity() can reuse them instead of scanning IMAP again;
+    `records_checkpoints` = (checkpoints before, checkpoints after) the fetch tells
+    which part of the mailbox they cover.
+    `client` (gspread-compatible) and `mailbox_factory` (returns a logged-in
+    MailBox-compatible object) replace the real backends, e.g. in benchmarks.
+    `metrics` (RunMetrics) collects phase timings for the run report.
+    Local state files (stores, checkpoints) live in `state_dir` (default: current directory).
+    Caches are filled under one lock, so jobs running in different threads (pipeline.py
+    lanes) share them; each SQLite store is then used only by the thread that opened it.
+    """
+
+    def __init__(self, worksheet_ttl=None, client=None, mailbox_factory=None, state_dir=None):
+        self._client = client
+        self.state_dir = state_dir
+        self.mailbox_factory = mailbox_factory or open_mailbox
+        self.metrics = RunMetrics(lambda: self.sheets_stats, lambda: self.sheets_thread_stats)
+        self._lock = threading.RLock()
+        self._spreadsheets = {}  # url -> gspread.Spreadsheet
+        self._worksheets = {}  # url -> (fetched_at, {gid: Worksheet})
+        self.worksheet_ttl = worksheet_ttl
+        self._mailbox = None
+        self._mailbox_pool = None
+        self._threads = None
+        self._operator_stats = None
+        self._archive = None
+        self._operators = None
+        self.records = None
+        self.records_checkpoints = None
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                with self.metrics.phase('credentials'):
+                    import gspread
+                    from sheets_gateway import SheetsGateway
+                    self._client = gspread.authorize(get_credentials(), http_client=SheetsGateway)
+            return self._client
+
+    @property
+    def sheets_stats(self):
+        """SheetsGateway counters (empty until the client is created)."""
+        http_client = getattr(self._client, 'http_client', None)
+        return getattr(http_client, 'stats', {})
+
+    @property
+    def sheets_thread_stats(self):
+        """SheetsGateway reads/writes of the calling thread (all threads without a gateway)."""
+        http_client = getattr(self._client, 'http_client', None)
+        return getattr(http_client, 'thread_stats', self.sheets_stats)
+
+    def spreadsheet(self, url):
+        with self._lock:
+            if url not in self._spreadsheets:
+                self._spreadsheets[url] = self.client.open_by_url(url)
+            return self._spreadsheets[url]
+
+    def worksheets(self, url, refresh=False):
+        """Returns {gid: Worksheet} for `url` from the metadata cache."""
+        with self._lock:
+            cached = self._worksheets.get(url)
+            expired = cached is not None and self.worksheet_ttl is not None and \
+                time.monotonic() - cached[0] > self.worksheet_ttl
+            if refresh or cached is None or expired:
+                cached = (time.monotonic(), {ws.id: ws for ws in self.spreadsheet(url).worksheets()})
+                self._worksheets[url] = cached
+            return cached[1]
+
+    def worksheet(self, url, gid):
+        """Returns worksheet by GID. Raises ValueError if it is missing even after a refetch."""
+        gid = int(gid)
+        ws = self.worksheets(url).get(gid)
+        if ws is None:
+            ws = self.worksheets(url, refresh=True).get(gid)
+        if ws is None:
+            available = [f"{w.title} (GID: {w.id})" for w in self.worksheets(url).values()]
+            raise ValueError(f"Worksheet with GID {gid} not found. Available: {', '.join(available)}")
+        return ws
+
+    def worksheet_by_title(self, url, title):
+        """Returns worksheet by title or None (refetches metadata once on a miss)."""
+        for refresh in (False, True):
+            for ws in self.worksheets(url, refresh=refresh).values():
+                if ws.title == title:
+                    return ws
+        return None
+
+    @property
+    def mailbox(self):
+        """Logged-in MailBox, opened on first use."""
+        if self._mailbox is None:
+            self._mailbox = self.open_mailbox()
+        return self._mailbox
+
+    def open_mailbox(self):
+        """New logged-in session from mailbox_factory, timed as the 'imap_login' phase."""
+        with self.metrics.phase('imap_login'):
+            return self.mailbox_factory()
+
+    @property
+    def mailbox_pool(self):
+        """MailboxPool for parallel folder scans, connections are opened on demand."""
+        with self._lock:
+            if self._mailbox_pool is None:
+                self._mailbox_pool = MailboxPool(IMAP_POOL_SIZE, self.open_mailbox)
+            return self._mailbox_pool
+
+    def close_mailbox(self):
+        """Logs out the main IMAP session and all pooled connections."""
+        if self._mailbox is not None:
+            try:
+                self._mailbox.logout()
+            except Exception as e:
+                print(f"IMAP logout error: {e}")
+            self._mailbox = None
+        if self._mailbox_pool is not None:
+            self._mailbox_pool.close()
+
+    def state_path(self, name):
+        return os.path.join(self.state_dir, name) if self.state_dir else name
+
+    @property
+    def threads(self):
+        """Local ThreadStore mirror of the main sheet, opened on first use."""
+        with self._lock:
+            if self._threads is None:
+                self._threads = ThreadStore(self.state_path(THREADS_DB_FILE))
+            return self._threads
+
+    @property
+    def operator_stats(self):
+        """Local OperatorStatsStore, opened on first use."""
+        with self._lock:
+            if self._operator_stats is None:
+                self._operator_stats = OperatorStatsStore(self.state_path(OPERATOR_STATS_DB_FILE))
+            return self._operator_stats
+
+    @property
+    def operators(self):
+        """OperatorDirectory backed by OPERATORS_CACHE_FILE, opened on first use."""
+        with self._lock:
+            if self._operators is None:
+                self._operators = OperatorDirectory(self.state_path(OPERATORS_CACHE_FILE))
+            return self._operators
+
+    @property
+    def archive(self):
+        """Local ArchiveStore, opened on first use."""
+        with self._lock:
+            if self._archive is None:
+                self._archive = ArchiveStore(self.state_path(ARCHIVE_DIR))
+            return self._archive
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_mailbox()
+
+class ThreadStore:
+    """
+    Local SQLite mirror of the main threads sheet (GID=0).
+    row_idx is the 1-based sheet row number (header is row 1, not stored as a row).
+    Each row is kept as-is in `row_json`; id, clean subject, status and last_activity
+    are duplicated into indexed columns for lookups.
+
+    The sheet stays the source of truth: ensure_fresh() re-downloads it every
+    THREADS_RECONCILE_INTERVAL or when columns A and E:H (id, status, type, last
+    replyer, last activity) no longer match the mirror, e.g. after rows were
+    inserted/deleted by hand or a thread was closed in the app.
+    Changes are staged in a transaction: commit() after the sheet writes succeed,
+    rollback() + invalidate() if they fail.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS threads (
+                row_idx INTEGER PRIMARY KEY,
+                id TEXT NOT NULL DEFAULT '',
+                clean_subject TEXT NOT NULL DEFAULT '',
+                status TEXT NOT NULL DEFAULT '',
+                last_activity TEXT NOT NULL DEFAULT '',
+                row_json TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS threads_id ON threads(id);
+            CREATE INDEX IF NOT EXISTS threads_clean_subject ON threads(clean_subject);
+            CREATE INDEX IF NOT EXISTS threads_status ON threads(status);
+            CREATE INDEX IF NOT EXISTS threads_last_activity ON threads(last_activity);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            -- Thread index: union-find forest over every message id ever seen,
+            -- roots are thread ids (column A). Survives reconcile().
+            CREATE TABLE IF NOT EXISTS thread_index (
+                msg_id TEXT PRIMARY KEY,
+                parent TEXT NOT NULL
+            );
+            -- Ids already written to the overdue log sheet and their row there.
+            CREATE TABLE IF NOT EXISTS overdue_log (
+                msg_id TEXT PRIMARY KEY,
+                row_idx INTEGER NOT NULL
+            );
+            -- Snapshot version in which each row (by key, see snapshot_keys) last changed;
+            -- deleted rows stay as tombstones with an empty digest.
+            CREATE TABLE IF NOT EXISTS snapshot_rows (
+                key TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                digest TEXT NOT NULL
+            );
+            -- Thread state transitions (thread_new, status_changed, thread_updated, overdue, archived, closed),
+            -- staged in the same transaction as the row changes that caused them.
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                at TEXT NOT NULL,
+                type TEXT NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS events_at ON events(at);
+        """)
+        # Messages without ids used to be linked under one '' root: forget them, real ids relink
+        self.db.execute("DELETE FROM thread_index WHERE msg_id = '' OR parent = ''")
+        self.db.commit()
+        self._verified_at = None
+        self._overdue = None
+
+    def _get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def ensure_fresh(self, ws, verify=False):
+        """
+        Syncs the mirror with `ws` if needed. Returns True if the whole sheet was downloaded.
+        verify=True always re-checks the probe columns (use before deleting rows by index).
+        """
+        reconciled_at = self._get_meta('reconciled_at', 0)
+        if time.time() - reconciled_at < THREADS_RECONCILE_INTERVAL:
+            if not verify and self._verified_at and time.monotonic() - self._verified_at < THREADS_VERIFY_INTERVAL:
+                return False
+            # One values:batchGet; B:D (subject, sender, time) are never edited after the row is added
+            ids, states = ws.batch_get(['A2:A', 'E2:H'])
+            sheet_rows = [(a[:1] or ['']) + ['', '', ''] + list(e)
+                          for a, e in itertools.zip_longest(ids, states, fillvalue=[])]
+            local_rows = [json.loads(r[0]) for r in self.db.execute("SELECT row_json FROM threads ORDER BY row_idx")]
+            if probe_columns(sheet_rows) == probe_columns(local_rows):
+                self._verified_at = time.monotonic()
+                return False
+            print("Local thread store is out of sync with the sheet, reloading...")
+        print("Downloading main sheet into local thread store...")
+        self.reconcile(ws.get_all_values())
+        return True
+
+    def reconcile(self, all_values):
+        """Replaces the mirror with `all_values` (result of get_all_values())."""
+        self.db.execute("DELETE FROM threads")
+        self._set_meta('header', all_values[0] if all_values else None)
+        self._overdue = None
+        for i, row in enumerate(all_values[1:]):
+            self.put(i + 2, row)
+        self._set_meta('reconciled_at', time.time())
+        self.db.commit()
+        self._verified_at = time.monotonic()
+
+    def invalidate(self):
+        """Forces a full download on the next ensure_fresh()."""
+        self._set_meta('reconciled_at', 0)
+        self.db.commit()
+        self._verified_at = None
+
+    def header(self):
+        return self._get_meta('header')
+
+    def set_header(self, header):
+        self._set_meta('header', header)
+
+    def last_row(self):
+        """Last sheet row number covered by the mirror (1 = header only)."""
+        row = self.db.execute("SELECT MAX(row_idx) FROM threads").fetchone()
+        return row[0] or 1
+
+    def get(self, row_idx):
+        row = self.db.execute("SELECT row_json FROM threads WHERE row_idx = ?", (row_idx,)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def put(self, row_idx, row):
+        row = list(row)
+        if row and row[0]:
+            self.db.execute("INSERT OR IGNORE INTO thread_index (msg_id, parent) VALUES (?, ?)", (row[0], row[0]))
+        self.db.execute(
+            "INSERT OR REPLACE INTO threads (row_idx, id, clean_subject, status, last_activity, row_json) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (row_idx,
+             row[0] if len(row) > 0 else '',
+             clean_subject(row[1]) if len(row) > 1 else '',
+             row[4].strip().lower() if len(row) > 4 else '',
+             row[7] if len(row) > 7 else '',
+             json.dumps(row, ensure_ascii=False)))
+        if self._overdue is not None and row and row[0]:
+            self._overdue.update(row)
+
+    def find_by_id(self, msg_id):
+        """Row of the thread whose id is `msg_id` (last one wins, like a dict rebuild)."""
+        if not msg_id: return None
+        row = self.db.execute(
+            "SELECT row_idx FROM threads WHERE id = ? ORDER BY row_idx DESC LIMIT 1", (msg_id,)).fetchone()
+        return row[0] if row else None
+
+    def find_root(self, msg_id):
+        """Thread root of `msg_id` in the thread index (with path compression), None if unseen or empty."""
+        if not msg_id: return None
+        path = []
+        node = msg_id
+        while True:
+            row = self.db.execute("SELECT parent FROM thread_index WHERE msg_id = ?", (node,)).fetchone()
+            if not row:
+                return None if not path else node
+            if row[0] == node:
+                break
+            path.append(node)
+            node = row[0]
+        if len(path) > 1:
+            self.db.executemany("UPDATE thread_index SET parent = ? WHERE msg_id = ?", [(node, p) for p in path[:-1]])
+        return node
+
+    def link(self, msg_ids, thread_id):
+        """
+        Unions `msg_ids` into the thread rooted at `thread_id`.
+        Sets already rooted at another live thread (a different sheet row) are not merged.
+        Empty ids (messages without Message-ID / References) are never linked.
+        """
+        if not thread_id: return
+        root = self.find_root(thread_id)
+        if root is None:
+            root = thread_id
+            self.db.execute("INSERT INTO thread_index (msg_id, parent) VALUES (?, ?)", (root, root))
+        for msg_id in msg_ids:
+            if not msg_id: continue
+            other = self.find_root(msg_id)
+            if other is None:
+                self.db.execute("INSERT INTO thread_index (msg_id, parent) VALUES (?, ?)", (msg_id, root))
+            elif other != root and not self.find_by_id(other):
+                self.db.execute("UPDATE thread_index SET parent = ? WHERE msg_id = ?", (root, other))
+
+    def find_thread(self, refs):
+        """Row of the thread any of `refs` belongs to: via the thread index, then by raw row id."""
+        for ref in refs:
+            root = self.find_root(ref)
+            row_idx = self.find_by_id(root) if root else None
+            if row_idx:
+                return row_idx
+        for ref in refs:
+            row_idx = self.find_by_id(ref)
+            if row_idx:
+                return row_idx
+        return None
+
+    def find_by_subject(self, subj):
+        if not subj: return None
+        row = self.db.execute(
+            "SELECT row_idx FROM threads WHERE clean_subject = ? ORDER BY row_idx DESC LIMIT 1", (subj,)).fetchone()
+        return row[0] if row else None
+
+    def rows(self, status=None):
+        """Yields (row_idx, row) in sheet order, optionally only rows with this (lowercase) status."""
+        if status is None:
+            cur = self.db.execute("SELECT row_idx, row_json FROM threads ORDER BY row_idx")
+        else:
+            cur = self.db.execute("SELECT row_idx, row_json FROM threads WHERE status = ? ORDER BY row_idx", (status,))
+        for row_idx, row_json in cur.fetchall():
+            yield row_idx, json.loads(row_json)
+
+    def delete_rows(self, row_idxs):
+        """Deletes sheet rows and shifts the rows below up, like Worksheet.delete_rows()."""
+        deleted = sorted(set(row_idxs))
+        if not deleted: return
+        self.db.executemany("DELETE FROM threads WHERE row_idx = ?", [(i,) for i in deleted])
+        shift = 0
+        remaining = [r[0] for r in self.db.execute(
+            "SELECT row_idx FROM threads WHERE row_idx > ? ORDER BY row_idx", (deleted[0],))]
+        for row_idx in remaining:
+            while shift < len(deleted) and deleted[shift] < row_idx:
+                shift += 1
+            self.db.execute("UPDATE threads SET row_idx = ? WHERE row_idx = ?", (row_idx - shift, row_idx))
+        self._overdue = None
+
+    @property
+    def overdue(self):
+        """OverdueScheduler over the unanswered threads, built on first use and kept current by put()."""
+        if self._overdue is None:
+            self._overdue = OverdueScheduler()
+            for _, row in self.rows(status=OVERDUE_STATUS):
+                self._overdue.update(row)
+        return self._overdue
+
+    def overdue_log_stale(self):
+        return time.time() - self._get_meta('overdue_log_reconciled_at', 0) >= OVERDUE_LOG_RECONCILE_INTERVAL
+
+    def reset_overdue_log(self, all_values):
+        """Replaces the overdue log index with `all_values` of the overdue log sheet."""
+        self.db.execute("DELETE FROM overdue_log")
+        for i, row in enumerate(all_values[1:]):
+            if row and row[0]:
+                self.set_overdue_logged(row[0], i + 2)
+        self._set_meta('overdue_log_last_row', max(len(all_values), 1))
+        self._set_meta('overdue_log_reconciled_at', time.time())
+        self.db.commit()
+
+    def invalidate_overdue_log(self):
+        self._set_meta('overdue_log_reconciled_at', 0)
+        self.db.commit()
+
+    def overdue_log_matches(self, ids):
+        """True if `ids` (column A of the overdue log from row 2) has every logged id at its stored row."""
+        for msg_id, row_idx in self.db.execute("SELECT msg_id, row_idx FROM overdue_log"):
+            if row_idx - 2 >= len(ids) or ids[row_idx - 2] != msg_id:
+                return False
+        return True
+
+    def overdue_logged(self, msg_id):
+        """Row of `msg_id` in the overdue log sheet or None."""
+        row = self.db.execute("SELECT row_idx FROM overdue_log WHERE msg_id = ?", (msg_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_overdue_logged(self, msg_id, row_idx):
+        self.db.execute("INSERT OR REPLACE INTO overdue_log (msg_id, row_idx) VALUES (?, ?)", (msg_id, row_idx))
+
+    def overdue_log_last_row(self):
+        return self._get_meta('overdue_log_last_row', 1)
+
+    def set_overdue_log_last_row(self, last_row):
+        self._set_meta('overdue_log_last_row', last_row)
+
+    def overdue_refreshed_at(self):
+        return self._get_meta('overdue_refreshed_at', 0)
+
+    def set_overdue_refreshed_at(self, ts):
+        self._set_meta('overdue_refreshed_at', ts)
+
+    def snapshot_state(self):
+        """(version, digest) of the last written snapshot."""
+        return self._get_meta('snapshot_version', 0), self._get_meta('snapshot_digest')
+
+    def set_snapshot_state(self, version, digest):
+        self._set_meta('snapshot_version', version)
+        self._set_meta('snapshot_digest', digest)
+
+    def snapshot_rows(self):
+        """{key: (version, digest)} including tombstones (digest '')."""
+        return {key: (version, digest) for key, version, digest in
+                self.db.execute("SELECT key, version, digest FROM snapshot_rows")}
+
+    def set_snapshot_row(self, key, version, digest):
+        self.db.execute("INSERT OR REPLACE INTO snapshot_rows (key, version, digest) VALUES (?, ?, ?)",
+                        (key, version, digest))
+
+    def prune_snapshot_tombstones(self, before_version):
+        """Forgets rows deleted before `before_version`; older `since` values then get the full table."""
+        if before_version <= self.snapshot_min_since():
+            return
+        self.db.execute("DELETE FROM snapshot_rows WHERE digest = '' AND version < ?", (before_version,))
+        self._set_meta('snapshot_min_since', before_version)
+
+    def snapshot_min_since(self):
+        """Oldest version a delta can be computed from."""
+        return self._get_meta('snapshot_min_since', 0)
+
+    def add_event(self, event_type, row_idx, row, **extra):
+        """Stages a thread state transition (see thread_event_data); committed with the row changes."""
+        data = dict(thread_event_data(row_idx, row), **extra)
+        self.db.execute("INSERT INTO events (at, type, data) VALUES (?, ?, ?)", (
+            datetime.datetime.now(MSK_TZ).isoformat(timespec='seconds'), event_type,
+            json.dumps(data, ensure_ascii=False)))
+
+    def prune_events(self):
+        cutoff = (datetime.datetime.now(MSK_TZ) - timedelta(days=EVENTS_RETENTION_DAYS)).isoformat(timespec='seconds')
+        self.db.execute("DELETE FROM events WHERE at < ?", (cutoff,))
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+        self._overdue = None
+
+def probe_columns(rows):
+    """Columns A and E:H of `rows` as ThreadStore.ensure_fresh() compares them (trailing blanks dropped)."""
+    probe = []
+    for row in rows:
+        cells = [row[i] if len(row) > i else '' for i in (0, 4, 5, 6, 7)]
+        while cells and not cells[-1]: cells.pop()
+        probe.append(cells)
+    while probe and not probe[-1]: probe.pop()
+    return probe
+
+def thread_event_data(row_idx, row):
+    """Event payload for a main sheet row: {id, row, subject, sender, time, status, type, last_replyer, last_activity}."""
+    row = list(row) + [''] * (8 - len(row))
+    return {
+        'id': row[0], 'row': row_idx, 'subject': row[1], 'sender': row[2], 'time': row[3],
+        'status': row[4], 'type': row[5], 'last_replyer': row[6], 'last_activity': row[7],
+    }
+
+def overdue_deadline(time_str):
+    """Deadline (aware, MSK) of a thread started at `time_str` (col D) or None if unparsable."""
+    try:
+        dt = datetime.datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+    # Stored dates are MSK without tzinfo
+    return dt.replace(tzinfo=MSK_TZ) + OVERDUE_AFTER
+
+class OverdueScheduler:
+    """
+    Min-heap of unanswered threads keyed by their overdue deadline.
+    update(row) (re)schedules or cancels a thread from its main sheet row; cancelled
+    and rescheduled entries are dropped lazily when they reach the top of the heap.
+    pop_due(now) returns ids whose deadline has passed, each once; they stay in
+    `overdue` until their status changes.
+    """
+
+    def __init__(self):
+        self._heap = []  # (deadline, msg_id)
+        self._pending = {}  # msg_id -> deadline
+        self.overdue = {}  # msg_id -> deadline
+
+    def update(self, row):
+        msg_id = row[0]
+        status = row[4].strip().lower() if len(row) > 4 else ''
+        deadline = overdue_deadline(row[3]) if status == OVERDUE_STATUS and len(row) > 3 else None
+        if deadline is None:
+            self._pending.pop(msg_id, None)
+            self.overdue.pop(msg_id, None)
+        elif self._pending.get(msg_id, self.overdue.get(msg_id)) != deadline:
+            self.overdue.pop(msg_id, None)
+            self._pending[msg_id] = deadline
+            heapq.heappush(self._heap, (deadline, msg_id))
+
+    def pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, msg_id = heapq.heappop(self._heap)
+            if self._pending.get(msg_id) != deadline:
+                continue
+            del self._pending[msg_id]
+            self.overdue[msg_id] = deadline
+            due.append(msg_id)
+        return due
+
+    def __len__(self):
+        return len(self._pending)
+
+class OperatorStatsStore:
+    """
+    Local SQLite state for log_operator_activity():
+    - logged: message ids already appended to the operator log (with their date),
+      pruned after OPERATOR_LOG_ID_RETENTION_DAYS;
+    - counts: (date, operator) -> count and its 1-based row in the OperatorStats sheet.
+
+    With it a run only applies the new log rows as deltas and writes the touched cells.
+    Both sheets are re-read and the counts recomputed every OPERATOR_STATS_RECONCILE_INTERVAL,
+    when the store is missing, after invalidate() (a failed write), or when a stats row
+    about to be written no longer holds its (date, operator) (see apply_daily_stats_delta).
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS logged (
+                msg_id TEXT PRIMARY KEY,
+                date TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS logged_date ON logged(date);
+            CREATE TABLE IF NOT EXISTS counts (
+                date TEXT NOT NULL,
+                operator TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                row_idx INTEGER NOT NULL,
+                PRIMARY KEY (date, operator)
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+
+    def _get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def needs_reconcile(self):
+        return time.time() - self._get_meta('reconciled_at', 0) >= OPERATOR_STATS_RECONCILE_INTERVAL
+
+    def covered_checkpoints(self):
+        """Sync UID checkpoints up to which the operator log is complete (None: unknown)."""
+        return self._get_meta('covered_checkpoints')
+
+    def set_covered_checkpoints(self, checkpoints):
+        self._set_meta('covered_checkpoints', checkpoints)
+
+    def reconcile(self, logged, counts, last_row):
+        """
+        Replaces the store. logged: {msg_id: date_str}, counts: {(date, operator): (count, row_idx)},
+        last_row: last used row of the OperatorStats sheet.
+        """
+        self.db.execute("DELETE FROM logged")
+        self.db.execute("DELETE FROM counts")
+        for msg_id, date_str in logged.items():
+            self.mark_logged(msg_id, date_str)
+        for (date_str, op), (count, row_idx) in counts.items():
+            self.set_count(date_str, op, count, row_idx)
+        self.prune_logged()
+        self._set_meta('last_row', last_row)
+        self._set_meta('reconciled_at', time.time())
+        self.db.commit()
+
+    def invalidate(self):
+        """Forces a full recount on the next run."""
+        self._set_meta('reconciled_at', 0)
+        self.db.commit()
+
+    def is_logged(self, msg_id):
+        return self.db.execute("SELECT 1 FROM logged WHERE msg_id = ?", (msg_id,)).fetchone() is not None
+
+    def mark_logged(self, msg_id, date_str):
+        self.db.execute("INSERT OR REPLACE INTO logged (msg_id, date) VALUES (?, ?)", (msg_id, date_str))
+
+    def prune_logged(self):
+        cutoff = (datetime.datetime.now(MSK_TZ) - timedelta(days=OPERATOR_LOG_ID_RETENTION_DAYS)).strftime('%Y-%m-%d')
+        self.db.execute("DELETE FROM logged WHERE date < ?", (cutoff,))
+
+    def get_count(self, date_str, op):
+        """(count, row_idx) or None if the pair has no stats row yet."""
+        return self.db.execute(
+            "SELECT count, row_idx FROM counts WHERE date = ? AND operator = ?", (date_str, op)).fetchone()
+
+    def set_count(self, date_str, op, count, row_idx):
+        self.db.execute(
+            "INSERT OR REPLACE INTO counts (date, operator, count, row_idx) VALUES (?, ?, ?, ?)",
+            (date_str, op, count, row_idx))
+
+    def last_row(self):
+        return self._get_meta('last_row', 1)
+
+    def set_last_row(self, last_row):
+        self._set_meta('last_row', last_row)
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+class ArchiveStore:
+    """
+    Local append-only store of archived threads, the full history behind the archive sheet.
+    Rows (main sheet row + archived_at) are appended as JSON lines to gzip files
+    partitioned by the month of the thread time (col D, the stats key), e.g. 2026-02.jsonl.gz.
+    index.db maps every archived message id to its partition, so get() reads one file
+    and month_counts() needs no file at all.
+
+    A thread archived again after new activity gets a new line; the index points to
+    the latest one. Re-appending a row with the same last_activity (a retried run) is a no-op.
+    `fresh` is True if the store was created or imported by this process: it may be the
+    only copy of the sheet's history on a throwaway machine, so nothing is trimmed then.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.fresh = not os.path.exists(os.path.join(path, 'index.db'))
+        self.db = sqlite3.connect(os.path.join(path, 'index.db'))
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS archived (
+                msg_id TEXT PRIMARY KEY,
+                month TEXT NOT NULL,
+                last_activity TEXT NOT NULL,
+                archived_at TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS archived_month ON archived(month);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+
+    def _get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+        self.db.commit()
+
+    def partition_path(self, month):
+        return os.path.join(self.path, f"{month}.jsonl.gz")
+
+    @staticmethod
+    def row_month(row):
+        """year-month of the thread time (col D), else of archived_at (last column)."""
+        for value in (row[3] if len(row) > 3 else '', row[-1] if row else ''):
+            if re.match(r'^\d{4}-\d{2}', str(value)):
+                return str(value)[:7]
+        return datetime.datetime.now(MSK_TZ).strftime('%Y-%m')
+
+    def append(self, rows):
+        """Appends archived rows, skipping ones already stored. Returns the number written."""
+        by_month = {}
+        for row in rows:
+            msg_id = row[0] if row else ''
+            last_activity = row[7] if len(row) > 8 else ''
+            stored = self.db.execute("SELECT last_activity FROM archived WHERE msg_id = ?", (msg_id,)).fetchone()
+            if msg_id and stored and stored[0] == last_activity:
+                continue
+            by_month.setdefault(self.row_month(row), []).append(row)
+
+        written = 0
+        for month, month_rows in sorted(by_month.items()):
+            # gzip members can be concatenated: each append adds one member
+            with gzip.open(self.partition_path(month), 'at', encoding='utf-8') as f:
+                for row in month_rows:
+                    f.write(json.dumps(row, ensure_ascii=False) + '\n')
+            for row in month_rows:
+                if row and row[0]:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO archived (msg_id, month, last_activity, archived_at) VALUES (?, ?, ?, ?)",
+                        (row[0], month, row[7] if len(row) > 8 else '', row[-1]))
+            written += len(month_rows)
+        self.db.commit()
+        return written
+
+    def months(self):
+        return sorted(name[:-len('.jsonl.gz')] for name in os.listdir(self.path) if name.endswith('.jsonl.gz'))
+
+    def rows(self, month=None):
+        """Yields stored rows of one month or of all months, oldest partition first."""
+        for m in ([month] if month else self.months()):
+            path = self.partition_path(m)
+            if not os.path.exists(path):
+                continue
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    yield json.loads(line)
+
+    def get(self, msg_id):
+        """Latest archived row of thread `msg_id` or None."""
+        found = self.db.execute("SELECT month FROM archived WHERE msg_id = ?", (msg_id,)).fetchone()
+        if not found:
+            return None
+        match = None
+        for row in self.rows(found[0]):
+            if row and row[0] == msg_id:
+                match = row
+        return match
+
+    def month_counts(self):
+        """{year_month: archived threads} from the index."""
+        return dict(self.db.execute("SELECT month, COUNT(*) FROM archived GROUP BY month ORDER BY month"))
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM archived").fetchone()[0]
+
+    @property
+    def imported(self):
+        """True once the rows of the archive sheet were copied in (see import_archive_sheet)."""
+        return self._get_meta('imported', False)
+
+    def set_imported(self):
+        self._set_meta('imported', True)
+        self.fresh = True
+
+    def sheet_rows(self):
+        """Rows in the archive sheet including the header, as last seen/written by us."""
+        return self._get_meta('sheet_rows', 1)
+
+    def set_sheet_rows(self, count):
+        self._set_meta('sheet_rows', count)
+
+def open_mailbox():
+    """Opens and logs in a new IMAP session (use as a context manager)."""
+    from imap_tools import MailBox
+    return MailBox(IMAP_HOST, port=IMAP_PORT).login(YANDEX_EMAIL, YANDEX_PASSWORD)
+
+class MailboxPool:
+    """
+    At most `size` logged-in IMAP connections shared by scan threads.
+    connection() hands out an idle connection (opening a new one if none is idle)
+    and takes it back afterwards; a connection that raised is logged out and dropped.
+    """
+
+    def __init__(self, size, mailbox_factory=None):
+        self.size = max(1, size)
+        self.mailbox_factory = mailbox_factory or open_mailbox
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    @contextmanager
+    def connection(self):
+        with self._slots:
+            with self._lock:
+                mailbox = self._idle.pop() if self._idle else None
+            if mailbox is None:
+                mailbox = self.mailbox_factory()
+            try:
+                yield mailbox
+            except BaseException:
+                try:
+                    mailbox.logout()
+                except Exception:
+                    pass
+                raise
+            with self._lock:
+                self._idle.append(mailbox)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for mailbox in idle:
+            try:
+                mailbox.logout()
+            except Exception as e:
+                print(f"IMAP logout error: {e}")
+
+def find_sent_folder(mailbox):
+    """Returns the first existing folder from SENT_FOLDER_NAMES, or None."""
+    for name in SENT_FOLDER_NAMES:
+        if mailbox.folder.exists(name):
+            return name
+    return None
+
+def get_sheet(ctx):
     try:
-        sheet = client.open_by_url(GOOGLE_SHEET_URL)
         # Get worksheet by GID=0 (main emails sheet)
-        for ws in sheet.worksheets():
-            if ws.id == 0:
-                return ws
+        return ctx.worksheet(GOOGLE_SHEET_URL, 0)
+    except ValueError:
         # Fallback to sheet1 if GID=0 not found
-        return sheet.sheet1 
+        return next(iter(ctx.worksheets(GOOGLE_SHEET_URL).values()))
     except Exception as e:
         print(f"Error opening sheet: {e}")
         raise
 
-def get_log_sheet(client, gid_str):
+def get_log_sheet(ctx, gid_str):
     """Retrieves a specific worksheet by GID."""
     try:
-        sheet = client.open_by_url(GOOGLE_SHEET_URL)
-        for ws in sheet.worksheets():
-            if str(ws.id) == str(gid_str):
-                return ws
-        
-        # If not found, list available GIDs for debugging
-        available_gids = [f"{ws.title} (GID: {ws.id})" for ws in sheet.worksheets()]
-        raise ValueError(f"Worksheet with GID {gid_str} not found. Available: {', '.join(available_gids)}")
+        # ValueError lists available GIDs for debugging
+        return ctx.worksheet(GOOGLE_SHEET_URL, gid_str)
     except Exception as e:
         print(f"Error opening log sheet: {e}")
         raise
 
-def get_operator_emails(client):
+class OperatorDirectory:
     """
-    Загружает список email операторов из листа GID=OPERATORS_GID.
-    Возвращает set() email-адресов в lowercase.
-    При ошибке логирует и возвращает пустой set.
+    Operator emails (column A of OPERATORS_GID) cached in memory and in OPERATORS_CACHE_FILE:
+    {"fetched_at", "digest", "changed_at", "emails"}.
+    Within OPERATORS_CACHE_TTL the list is served without any Sheets request, after that
+    column A is read again and compared by digest; a changed list is logged.
+    If the sheet cannot be read, the cached list is kept (however old).
+    emails() is serialized: concurrent jobs wait for one read instead of each refreshing.
     """
-    try:
-        sheet = client.open_by_url(GOOGLE_SHEET_URL)
-        ws = None
-        for worksheet in sheet.worksheets():
-            if worksheet.id == OPERATORS_GID:
-                ws = worksheet
-                break
-        
-        if not ws:
-            print(f"Warning: Operators sheet (GID={OPERATORS_GID}) not found.")
-            return set()
-        
-        # Читаем столбец A
-        values = ws.col_values(1)
-        # Нормализуем к lowercase, пропускаем пустые
-        operators = set()
-        for v in values:
-            if v and v.strip():
-                operators.add(v.strip().lower())
-        
-        print(f"Loaded {len(operators)} operator emails from GID={OPERATORS_GID}")
-        return operators
-        
-    except Exception as e:
-        print(f"Error loading operator emails: {e}")
-        return set()
+
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = OPERATORS_CACHE_TTL if ttl is None else ttl
+        self.state = self._load()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            return state if isinstance(state, dict) and isinstance(state.get('emails'), list) else {}
+        except (OSError, ValueError) as e:
+            print(f"Error reading {self.path}: {e}")
+            return {}
+
+    def _save(self):
+        tmp_file = self.path + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self.path)
+
+    @property
+    def fresh(self):
+        return bool(self.state) and time.time() - self.state.get('fetched_at', 0) < self.ttl
+
+    def emails(self, ctx, refresh=False):
+        """frozenset of lowercase operator emails; reads the sheet only if the cache is stale."""
+        with self._lock:
+            if self.fresh and not refresh:
+                return frozenset(self.state['emails'])
+            try:
+                ws = ctx.worksheets(GOOGLE_SHEET_URL).get(OPERATORS_GID)
+                if not ws:
+                    ws = ctx.worksheets(GOOGLE_SHEET_URL, refresh=True).get(OPERATORS_GID)
+                if not ws:
+                    print(f"Warning: Operators sheet (GID={OPERATORS_GID}) not found.")
+                    return frozenset(self.state.get('emails', []))
+                emails = sorted({v.strip().lower() for v in ws.col_values(1) if v and v.strip()})
+            except Exception as e:
+                print(f"Error loading operator emails: {e}")
+                return frozenset(self.state.get('emails', []))
+
+            digest = hashlib.sha1('\n'.join(emails).encode('utf-8')).hexdigest()
+            if digest != self.state.get('digest'):
+                if self.state:
+                    old = set(self.state.get('emails', []))
+                    added, removed = sorted(set(emails) - old), sorted(old - set(emails))
+                    print(f"Operator list changed: added {', '.join(added) or '-'}; removed {', '.join(removed) or '-'}")
+                self.state.update(digest=digest, changed_at=time.time(), emails=emails)
+                print(f"Loaded {len(emails)} operator emails from GID={OPERATORS_GID}")
+            self.state['fetched_at'] = time.time()
+            try:
+                self._save()
+            except OSError as e:
+                print(f"Error writing {self.path}: {e}")
+            return frozenset(emails)
+
+def get_operator_emails(ctx, refresh=False):
+    """
+    Список email операторов (lowercase) из листа GID=OPERATORS_GID через кэш ctx.operators.
+    Лист читается не чаще раза в OPERATORS_CACHE_TTL (refresh=True — сразу).
+    Возвращает новый set(); при ошибке — последний сохранённый список или пустой set.
+    """
+    return set(ctx.operators.emails(ctx, refresh=refresh))
 
 def normalize_date(date_obj):
     # Ensure we use MSK timezone
@@ -138,316 +1194,786 @@ def extract_email(sender_str):
     name, addr = email.utils.parseaddr(sender_str)
     return addr.lower()
 
+# Standard Re/Fwd prefix
+SUBJECT_PREFIX_RE = re.compile(r'^(Re:|Fwd:|FW:|Отв:)\s*', re.IGNORECASE)
+# Date at end of string: DD.MM.YYYY, DD.MM, etc.
+# Matches: " 16.08.2025", " 22-23.08" (space + digits/separators at end)
+SUBJECT_DATE_RE = re.compile(r'\s+\d+[-./]\d+([-./]\d+)?\s*$')
+CLEAN_SUBJECT_CACHE_SIZE = 65536
+
+@lru_cache(maxsize=CLEAN_SUBJECT_CACHE_SIZE)
 def clean_subject(subject):
-    """Removes Re:, Fwd: prefixes for soft matching."""
+    """Removes Re:, Fwd: prefixes and trailing dates for soft matching (memoized)."""
     if not subject: return ""
     s = subject.strip()
+    # Fast path: nothing to strip (no prefix, no trailing digit)
+    if not SUBJECT_PREFIX_RE.match(s) and not s[-1:].isdigit():
+        return s
+    # One prefix + one date per pass until stable: stripping a date while a
+    # prefix is still in front gives different results than all prefixes first
     while True:
-        # Standard Re/Fwd prefix removal
-        new_s = re.sub(r'^(Re:|Fwd:|FW:|Отв:)\s*', '', s, flags=re.IGNORECASE).strip()
-        
-        # Date pattern removal at end of string: DD.MM.YYYY, DD.MM, etc.
-        # Matches: " 16.08.2025", " 03-04.09.2025", " 22-23.08"
-        # Logic: space + digits/separators at end
-        # Regex: \s+\d+[-./]\d+([-./]\d+)?\s*$
-        date_pattern = r'\s+\d+[-./]\d+([-./]\d+)?\s*$'
-        new_s = re.sub(date_pattern, '', new_s).strip()
-        
-        if new_s == s: break
+        new_s = SUBJECT_DATE_RE.sub('', SUBJECT_PREFIX_RE.sub('', s, count=1).strip(), count=1).strip()
+        if new_s == s: return s
         s = new_s
-    return s
+
+def col_letter(col_idx):
+    """0-based column index -> sheet letter (0 -> 'A', 26 -> 'AA')."""
+    letters = ''
+    col_idx += 1
+    while col_idx:
+        col_idx, rem = divmod(col_idx - 1, 26)
+        letters = chr(ord('A') + rem) + letters
+    return letters
+
+def plan_cell_updates(changes, current_rows=None):
+    """
+    Turns pending cell changes into a compact batch_update payload.
+    changes: {row_idx: {col_idx: value}} (1-based sheet rows, 0-based columns)
+    current_rows: {row_idx: [values]} as they are in the sheet now (optional)
+    - values equal to the current cell are dropped
+    - gaps between changed cells of a known row are filled with its current
+      values, so E, G, H become one E:H block
+    - consecutive rows with the same column span are merged (E5:H9)
+    """
+    current_rows = current_rows or {}
+    spans = []  # (row_idx, first_col, values)
+    for row_idx in sorted(changes):
+        if row_idx < 1: continue
+        current = current_rows.get(row_idx)
+        cells = {}
+        for col, value in changes[row_idx].items():
+            current_value = current[col] if current is not None and col < len(current) else None
+            if current is not None and str(current_value if current_value is not None else '') == str(value):
+                continue
+            cells[col] = value
+        if not cells: continue
+
+        cols = sorted(cells)
+        if current is not None:
+            # One block per row, gap cells keep their current value
+            spans.append((row_idx, cols[0], [
+                cells[c] if c in cells else (current[c] if c < len(current) else '')
+                for c in range(cols[0], cols[-1] + 1)]))
+        else:
+            start = cols[0]
+            for prev, col in zip(cols, cols[1:] + [None]):
+                if col != prev + 1:
+                    spans.append((row_idx, start, [cells[c] for c in range(start, prev + 1)]))
+                    start = col
+
+    updates = []
+    block = None  # [first_row, last_row, first_col, rows_values]
+    spans.sort(key=lambda span: (span[1], len(span[2]), span[0]))
+    for row_idx, first_col, values in spans:
+        if block and row_idx == block[1] + 1 and first_col == block[2] and len(values) == len(block[3][0]):
+            block[1] = row_idx
+            block[3].append(values)
+            continue
+        if block: updates.append(block)
+        block = [row_idx, row_idx, first_col, [values]]
+    if block: updates.append(block)
+
+    return [{
+        'range': f'{col_letter(first_col)}{first_row}:{col_letter(first_col + len(rows[0]) - 1)}{last_row}',
+        'values': rows
+    } for first_row, last_row, first_col, rows in updates]
+
+def row_ranges(row_idxs):
+    """Groups 1-based row numbers into contiguous (first, last) ranges, bottom-up."""
+    ranges = []
+    for row_idx in sorted(set(row_idxs), reverse=True):
+        if ranges and ranges[-1][0] == row_idx + 1:
+            ranges[-1][0] = row_idx
+        else:
+            ranges.append([row_idx, row_idx])
+    return [tuple(r) for r in ranges]
+
+def delete_sheet_rows(ws, row_idxs):
+    """
+    Deletes 1-based rows from `ws` with a single spreadsheets.batchUpdate call:
+    one deleteDimension request per contiguous range, bottom-up so indices stay valid.
+    """
+    requests = [{
+        'deleteDimension': {
+            'range': {
+                'sheetId': ws.id,
+                'dimension': 'ROWS',
+                'startIndex': first - 1,  # 0-based, inclusive
+                'endIndex': last,  # exclusive
+            }
+        }
+    } for first, last in row_ranges(row_idxs)]
+    if requests:
+        ws.spreadsheet.batch_update({'requests': requests})
+    return len(requests)
 
 def get_email_references(msg):
     """Extracts all related IDs (Message-ID, In-Reply-To, References) from a message."""
     refs = set()
     
     # Own ID
-    msg_id = msg.headers.get('message-id', [str(msg.uid)])[0].strip('<> ')
-    refs.add(msg_id)
+    msg_id = msg.headers.get('message-id', [msg.uid or ''])[0].strip('<> ')
+    if msg_id: refs.add(msg_id)
     
-    # In-Reply-To
-    irt = msg.headers.get('in-reply-to', [])
-    if isinstance(irt, str): refs.add(irt.strip('<> '))
-    elif isinstance(irt, list): refs.update(x.strip('<> ') for x in irt)
-    
-    # References
-    r = msg.headers.get('references', [])
-    if isinstance(r, str): refs.add(r.strip('<> '))
-    elif isinstance(r, list): refs.update(x.strip('<> ') for x in r)
+    # In-Reply-To / References: header values are tuples of raw strings,
+    # References holds several "<id>" separated by whitespace
+    for name in ('in-reply-to', 'references'):
+        values = msg.headers.get(name, ())
+        if isinstance(values, str): values = [values]
+        for value in values:
+            refs.update(x.strip('<> ') for x in value.split() if x.strip('<> '))
     
     return refs, msg_id
 
-def sync_emails():
+def fetch_items(data):
+    """
+    Per-message parts of a UID FETCH response: [(b'N (UID x BODY[...] {size}', b'headers'), b')'].
+    Some servers send the UID after the literal (b' UID x)'), so each tuple is kept with
+    the bytes item that follows it, as imap_tools pairs them.
+    """
+    for n, item in enumerate(data):
+        if isinstance(item, tuple):
+            tail = data[n + 1] if n + 1 < len(data) else None
+            yield [item, tail] if isinstance(tail, bytes) else [item]
+
+def fetch_headers(mailbox, criteria='ALL', uids=None, metrics=None):
+    """
+    Fetches only HEADER_FIELDS for messages in the current folder.
+    Uses BODY.PEEK, so messages are not marked as seen.
+    Yields MailMessage objects (subject/from_/date/headers/uid work as usual).
+    Header bytes are counted as 'imap_bytes_fetched' in `metrics` (RunMetrics) if given.
+    """
+    from imap_tools import MailMessage
+
+    if uids is None:
+        uids = mailbox.uids(criteria)
+    message_parts = f"(UID BODY.PEEK[HEADER.FIELDS ({' '.join(HEADER_FIELDS)})])"
+    for i in range(0, len(uids), FETCH_BULK_SIZE):
+        chunk = uids[i:i + FETCH_BULK_SIZE]
+        status, data = mailbox.client.uid('fetch', ','.join(chunk), message_parts)
+        if status != 'OK':
+            raise RuntimeError(f"IMAP FETCH failed: {status} {data}")
+        for fetch_item in fetch_items(data):
+            if metrics is not None:
+                metrics.count('imap_bytes_fetched', len(fetch_item[0][1]))
+            yield MailMessage(fetch_item)
+
+def load_sync_state(path=SYNC_STATE_FILE):
+    """Loads per-folder UID checkpoints from SYNC_STATE_FILE. Returns {} if missing or broken."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except (OSError, ValueError) as e:
+        print(f"Error reading {path}: {e}")
+        return {}
+
+def save_sync_state(state, path=SYNC_STATE_FILE):
+    """Writes UID checkpoints atomically (temp file + rename)."""
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_file, path)
+
+def select_new_uids(mailbox, folder, state, last_sync_date=None):
+    """
+    Selects `folder` and returns (uids, checkpoint): UIDs above the stored checkpoint
+    and the checkpoint to store once they are processed.
+    - Checkpoint exists and UIDVALIDITY matches: only UIDs last_uid+1:*
+    - UIDVALIDITY changed: old UIDs are meaningless, full rescan
+    - No checkpoint yet: legacy date-based search (or full scan without date)
+    `state` is not modified; the caller stores the checkpoint in `state[folder]` and
+    persists it with save_sync_state() after writes succeed.
+    """
+    from imap_tools import AND, U
+
+    status = mailbox.folder.status(folder, ['UIDVALIDITY', 'UIDNEXT'])
+    uidvalidity = status.get('UIDVALIDITY')
+    checkpoint = state.get(folder) or {}
+    last_uid = 0
+    mailbox.folder.set(folder)
+
+    if checkpoint and checkpoint.get('uidvalidity') == uidvalidity:
+        last_uid = int(checkpoint.get('last_uid', 0))
+        uidnext = status.get('UIDNEXT')
+        if uidnext and uidnext <= last_uid + 1:
+            print(f"{folder}: no new messages (last UID {last_uid})")
+            uids = []
+        else:
+            print(f"{folder}: fetching UIDs > {last_uid}")
+            uids = mailbox.uids(AND(uid=U(last_uid + 1, '*')))
+    elif checkpoint:
+        print(f"{folder}: UIDVALIDITY changed ({checkpoint.get('uidvalidity')} -> {uidvalidity}), full rescan")
+        uids = mailbox.uids()
+    elif last_sync_date:
+        uids = mailbox.uids(AND(date_gte=last_sync_date))
+    else:
+        uids = mailbox.uids()
+
+    # "N:*" always returns the newest message, even if its UID is below N
+    uids = [uid for uid in uids if int(uid) > last_uid]
+    max_uid = max([last_uid] + [int(uid) for uid in uids])
+    # Every UID below UIDNEXT existed at STATUS time and was covered by the scan,
+    # so gaps left by deleted/moved messages don't look like "new mail" next time
+    if status.get('UIDNEXT'):
+        max_uid = max(max_uid, status['UIDNEXT'] - 1)
+    return uids, {'uidvalidity': uidvalidity, 'last_uid': max_uid}
+
+def has_new_messages(ctx, mailbox, folder):
+    """Cheap STATUS check: True if `folder` has UIDs above its checkpoint in ctx's state (or no checkpoint)."""
+    checkpoint = load_sync_state(ctx.state_path(SYNC_STATE_FILE)).get(folder)
+    if not checkpoint:
+        return True
+    status = mailbox.folder.status(folder, ['UIDVALIDITY', 'UIDNEXT'])
+    if status.get('UIDVALIDITY') != checkpoint.get('uidvalidity'):
+        return True
+    return status.get('UIDNEXT', 0) > int(checkpoint.get('last_uid', 0)) + 1
+
+def to_mail_record(msg, email_type):
+    """Converts a fetched MailMessage into a MailRecord with an MSK-aware date."""
+    d = msg.date
+    if d.tzinfo is None:
+        d = d.replace(tzinfo=MSK_TZ)
+    refs, msg_id = get_email_references(msg)
+    return MailRecord(d.astimezone(MSK_TZ), msg.uid, msg_id, frozenset(refs), msg.subject, msg.from_, email_type)
+
+def scan_folders(ctx, folders, select, timeline=None):
+    """
+    Scans `folders` [(folder, email_type)] concurrently over ctx.mailbox_pool.
+    select(mailbox, folder) selects the folder and returns the UIDs to fetch; UID lists
+    are split into IMAP_SCAN_CHUNK ranges that are fetched in parallel too.
+    Returns one date-sorted MailRecord list per folder (input for merge_timeline()).
+    With a `timeline` (MailTimeline) each folder's chunks are also added to it in UID
+    order as soon as they are fetched.
+    MailMessage objects are dropped as soon as they are converted.
+    Time spent per folder is summed over tasks into the 'fetch:<folder>' phase.
+    """
+    pool = ctx.mailbox_pool
+    if timeline is not None:
+        timeline.open(len(folders))
+
+    def run_select(folder):
+        with pool.connection() as mailbox:
+            started = time.monotonic()
+            uids = select(mailbox, folder)
+            ctx.metrics.record(f'fetch:{folder}', time.monotonic() - started)
+            return uids
+
+    def fetch_chunk(folder, email_type, uids):
+        with pool.connection() as mailbox:
+            started = time.monotonic()
+            mailbox.folder.set(folder)
+            records = [to_mail_record(msg, email_type)
+                       for msg in fetch_headers(mailbox, uids=uids, metrics=ctx.metrics)]
+            ctx.metrics.record(f'fetch:{folder}', time.monotonic() - started)
+            ctx.metrics.count('messages_fetched', len(records))
+            return records
+
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        uid_lists = list(executor.map(run_select, [folder for folder, _ in folders]))
+        folder_chunks = [
+            [executor.submit(fetch_chunk, folder, email_type, uids[i:i + IMAP_SCAN_CHUNK])
+             for i in range(0, len(uids), IMAP_SCAN_CHUNK)]
+            for (folder, email_type), uids in zip(folders, uid_lists)]
+        if timeline is not None:
+            delivered = [0] * len(folders)
+            for index, chunks in enumerate(folder_chunks):
+                if not chunks:
+                    timeline.add(index, [], done=True)
+            owner = {chunk: index for index, chunks in enumerate(folder_chunks) for chunk in chunks}
+            for future in as_completed(owner):
+                index, chunks = owner[future], folder_chunks[owner[future]]
+                while delivered[index] < len(chunks) and chunks[delivered[index]].done():
+                    delivered[index] += 1
+                    timeline.add(index, chunks[delivered[index] - 1].result(), done=delivered[index] == len(chunks))
+        folder_records = []
+        for chunks in folder_chunks:
+            records = [rec for chunk in chunks for rec in chunk.result()]
+            records.sort(key=attrgetter('date'))
+            folder_records.append(records)
+    return folder_records
+
+def find_scan_folders(ctx):
+    """[(folder, email_type)] to scan: INBOX and the Sent folder if it exists."""
+    folders = [('INBOX', 'received')]
+    with ctx.mailbox_pool.connection() as mailbox:
+        sent_folder = find_sent_folder(mailbox)
+    if sent_folder: folders.append((sent_folder, 'sent'))
+    return folders
+
+def merge_timeline(*folder_records):
+    """K-way merge of per-folder date-sorted records into one date-ordered stream."""
+    return heapq.merge(*folder_records, key=attrgetter('date'))
+
+class MailTimeline:
+    """
+    merge_timeline() for a scan that is still running: scan_folders() adds each folder's
+    records chunk by chunk (in UID order), take() returns the ones that can already be
+    matched, in the order merge_timeline() would give them.
+    UIDs follow arrival order, which is date order give or take IMAP_STREAM_SLACK, so a
+    folder is taken to be complete up to (newest date it delivered - slack); finished
+    folders don't hold anything back. A record that comes in before something already
+    taken sets `out_of_order`: the caller has to match the whole scan again.
+    `notify()` is called (from the scanning thread) after every add().
+    """
+
+    def __init__(self, notify=None, slack=None):
+        self.notify = notify or (lambda: None)
+        self.slack = IMAP_STREAM_SLACK if slack is None else slack
+        self.out_of_order = False
+        self._lock = threading.Lock()
+        self._heap = []  # (date, folder index, seq, MailRecord)
+        self._newest = None  # per folder
+        self._done = None
+        self._seq = 0
+        self._last = None  # heap key of the last record taken
+
+    def open(self, count):
+        with self._lock:
+            self._newest, self._done = [None] * count, [False] * count
+
+    def add(self, index, records, done=False):
+        with self._lock:
+            for rec in records:
+                self._seq += 1
+                key = (rec.date, index, self._seq)
+                if self._last is not None and key < self._last:
+                    self.out_of_order = True
+                heapq.heappush(self._heap, key + (rec,))
+                if self._newest[index] is None or rec.date > self._newest[index]:
+                    self._newest[index] = rec.date
+            self._done[index] = self._done[index] or done
+        self.notify()
+
+    @property
+    def finished(self):
+        return self._done is not None and all(self._done)
+
+    def take(self):
+        """Date-ordered records that no unfinished folder can precede any more."""
+        with self._lock:
+            if self._done is None:
+                return []
+            pending = [newest for newest, done in zip(self._newest, self._done) if not done]
+            if None in pending:
+                return []
+            watermark = min(pending) - self.slack if pending else None
+            records = []
+            while self._heap and (watermark is None or self._heap[0][0] < watermark):
+                item = heapq.heappop(self._heap)
+                self._last = item[:3]
+                records.append(item[3])
+            return records
+
+def snapshot_keys(rows):
+    """Stable row keys for snapshot deltas: the thread id, suffixed '#n' for empty/duplicate ids."""
+    keys, seen = [], {}
+    for _, row in rows:
+        msg_id = row[0] if row else ''
+        n = seen[msg_id] = seen.get(msg_id, 0) + 1
+        keys.append(msg_id if msg_id and n == 1 else f"{msg_id}#{n}")
+    return keys
+
+def write_threads_snapshot(ctx):
+    """
+    Writes the main sheet records from the local mirror to THREADS_SNAPSHOT_FILE:
+    {"version", "generated_at", "header", "records", "rows", "deleted", "min_since"}.
+    The file is replaced atomically and only when the records changed; `version` grows by
+    one each time. rows[i] = [key, row_idx, version the row last changed] for records[i],
+    deleted = {key: version} of removed rows, so readers can serve deltas since any
+    version >= min_since. Returns the version.
+    Takes the store's write lock first: `serve` (close_reminder) writes snapshots too.
+    """
+    threads = ctx.threads
+    if not threads.db.in_transaction:
+        threads.db.execute("BEGIN IMMEDIATE")
+    header = threads.header() or []
+    rows = list(threads.rows())
+    keys = snapshot_keys(rows)
+    row_digests = [hashlib.sha1(json.dumps([row_idx, row], ensure_ascii=False).encode('utf-8')).hexdigest()
+                   for row_idx, row in rows]
+    digest = hashlib.sha1(json.dumps([header, keys, row_digests]).encode('utf-8')).hexdigest()
+    version, last_digest = threads.snapshot_state()
+    path = ctx.state_path(THREADS_SNAPSHOT_FILE)
+    if digest == last_digest and os.path.exists(path):
+        return version
+    if digest != last_digest:
+        version += 1
+        known = threads.snapshot_rows()
+        for key, row_digest in zip(keys, row_digests):
+            if known.get(key, (0, None))[1] != row_digest:
+                threads.set_snapshot_row(key, version, row_digest)
+        for key in set(known) - set(keys):
+            if known[key][1]:
+                threads.set_snapshot_row(key, version, '')
+        threads.prune_snapshot_tombstones(version - SNAPSHOT_TOMBSTONE_VERSIONS)
+    row_versions = threads.snapshot_rows()
+    snapshot = {
+        'version': version,
+        'generated_at': datetime.datetime.now(MSK_TZ).isoformat(),
+        'header': header,
+        # like Worksheet.get_all_records(), but values stay strings
+        'records': [dict(zip(header, row + [''] * (len(header) - len(row)))) for _, row in rows],
+        'rows': [[key, row_idx, row_versions[key][0]] for key, (row_idx, _) in zip(keys, rows)],
+        'deleted': {key: v for key, (v, row_digest) in row_versions.items() if not row_digest},
+        'min_since': threads.snapshot_min_since(),
+    }
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+    os.replace(tmp_file, path)
+    threads.set_snapshot_state(version, digest)
+    threads.commit()
+    return version
+
+def sync_emails(ctx, fetch_final=False):
+    """
+    Syncs new INBOX/Sent messages into the main sheet (GID=0).
+    Fetched records are left in ctx.records for log_operator_activity().
+    The resulting table is written to the local snapshot (write_threads_snapshot);
+    fetch_final=True also re-downloads the sheet and returns it as "data".
+    Runs prepare_sync(), fetch_sync_records() and apply_sync() one after another
+    (pipeline.py overlaps the first two and matches records while they are fetched).
+    """
     if not YANDEX_EMAIL or not YANDEX_PASSWORD:
         return {"error": "Yandex credentials missing in .env"}
 
     print(f"Connecting to IMAP for {YANDEX_EMAIL}...")
-    
+    prepared = prepare_sync(ctx)
+    if "error" in prepared:
+        return prepared
+    fetched = fetch_sync_records(ctx)
+    if "error" in fetched:
+        return fetched
+    return apply_sync(ctx, prepared, fetched, fetch_final)
+
+def prepare_sync(ctx):
+    """
+    Sheets side of sync_emails(): operator list, main sheet and a fresh local mirror.
+    Returns {"worksheet", "operator_emails"} or {"error"}.
+    """
     try:
         # Get sheet and load operator emails
-        creds = get_credentials()
-        client = gspread.authorize(creds)
-        operator_emails = get_operator_emails(client)
+        operator_emails = get_operator_emails(ctx)
         # Add bot email to operators list
         if YANDEX_EMAIL:
             operator_emails.add(YANDEX_EMAIL.lower())
         
-        worksheet = get_sheet()
-        all_values = worksheet.get_all_values()
+        worksheet = get_sheet(ctx)
+        # Local mirror of the sheet: id / clean subject lookups and row data for comparison
+        threads = ctx.threads
+        with ctx.metrics.phase('sync.sheet_read'):
+            threads.ensure_fresh(worksheet)
         
         # Schema: id, theme_of_mail, sender, time, status_of_reply, type_of_email, last_replyer, last_activity
         header = ['id', 'theme_of_mail', 'sender', 'time', 'status_of_reply', 'type_of_email', 'last_replyer', 'last_activity']
         
-        if not all_values:
+        if not threads.header():
             worksheet.append_row(header)
-            all_values = [header] 
-       
-        id_map = {}  # message_id -> row_index
-        subject_map = {}  # clean_subject -> row_index
-        row_data = {}  # row_index -> row values (for comparison)
-        
-        for i, row in enumerate(all_values):
-            if i == 0: continue
-            if row:
-                row_idx = i + 1
-                if len(row) > 0: 
-                    id_map[row[0]] = row_idx
-                    row_data[row_idx] = row  # Store row data for later comparison
-                if len(row) > 1: 
-                    subj = clean_subject(row[1])
-                    if subj: subject_map[subj] = row_idx
-
+            threads.set_header(header)
+            threads.commit()
 
     except Exception as e:
         return {"error": f"Failed to access Google Sheets: {e}"}
+    return {"worksheet": worksheet, "operator_emails": operator_emails}
 
-    # Updates and New Rows
-    updates = []
-    new_rows = []
-    
-    # Incremental sync: read last sync date from file
-    last_sync_date = None
-    if os.path.exists(LAST_SYNC_FILE):
+def read_last_sync_date(ctx):
+    """Date of the last successful sync (LAST_SYNC_FILE) or None: the next sync is a full one."""
+    last_sync_file = ctx.state_path(LAST_SYNC_FILE)
+    if os.path.exists(last_sync_file):
         try:
-            with open(LAST_SYNC_FILE, 'r') as f:
+            with open(last_sync_file, 'r') as f:
                 date_str = f.read().strip()
-                last_sync_date = datetime.datetime.strptime(date_str, '%Y-%m-%d').date()
-                print(f"Incremental sync from: {last_sync_date}")
+                return datetime.datetime.strptime(date_str, '%Y-%m-%d').date()
         except:
             pass
-    
-    if not last_sync_date:
+    return None
+
+def fetch_sync_records(ctx, timeline=None):
+    """
+    IMAP side of sync_emails(): new INBOX/Sent messages since the stored checkpoints,
+    merged by date into ctx.records. Touches no sheet and no local store.
+    `timeline` (MailTimeline) also receives the records while the scan runs (pipeline.py).
+    Returns {"sync_state", "last_sync_date"} (checkpoints to save after the writes) or {"error"}.
+    """
+    # Incremental sync: read last sync date from file
+    last_sync_date = read_last_sync_date(ctx)
+    if last_sync_date:
+        print(f"Incremental sync from: {last_sync_date}")
+    else:
         print("Full sync: parsing ALL emails...")
     
-    timeline = []
+    sync_state = load_sync_state(ctx.state_path(SYNC_STATE_FILE))
+    previous_state = json.loads(json.dumps(sync_state))
+    checkpoints = {}
+
+    def select(mailbox, folder):
+        uids, checkpoints[folder] = select_new_uids(mailbox, folder, sync_state, last_sync_date)
+        return uids
     
     try:
-        with MailBox('mail.21vek.tech', port=993).login(YANDEX_EMAIL, YANDEX_PASSWORD) as mailbox:
-            # INBOX
-            mailbox.folder.set('INBOX')
-            print("Scanning INBOX...")
-            if last_sync_date:
-                for msg in list(mailbox.fetch(AND(date_gte=last_sync_date))):
-                    timeline.append({'msg': msg, 'type': 'received'})
-            else:
-                for msg in list(mailbox.fetch()):
-                    timeline.append({'msg': msg, 'type': 'received'})
-
-            # SENT
-            sent_folder = None
-            for name in SENT_FOLDER_NAMES:
-                if mailbox.folder.exists(name):
-                    sent_folder = name
-                    break
-            
-            if sent_folder:
-                print(f"Scanning {sent_folder}...")
-                mailbox.folder.set(sent_folder)
-                if last_sync_date:
-                    for msg in list(mailbox.fetch(AND(date_gte=last_sync_date))):
-                        timeline.append({'msg': msg, 'type': 'sent'})
-                else:
-                    for msg in list(mailbox.fetch()):
-                        timeline.append({'msg': msg, 'type': 'sent'})
+        # INBOX and SENT, scanned in parallel
+        folders = find_scan_folders(ctx)
+        print(f"Scanning {', '.join(folder for folder, _ in folders)}...")
+        folder_records = scan_folders(ctx, folders, select, timeline)
+        sync_state.update(checkpoints)
             
     except Exception as e:
         return {"error": f"IMAP Error: {e}"}
         
-    # Sort by date
-    def get_aware_date(x):
-        d = x['msg'].date
-        if d.tzinfo is None:
-            d = d.replace(tzinfo=MSK_TZ)
-        return d.astimezone(MSK_TZ)
-        
-    timeline.sort(key=get_aware_date)
-    
-    print(f"Processing {len(timeline)} emails from timeline...")
-    processed_message_ids = set()
+    ctx.records = list(merge_timeline(*folder_records))
+    # No lower bound (None) after a full sync: it fetched the whole mailbox
+    ctx.records_checkpoints = (previous_state if previous_state or last_sync_date else None, sync_state)
+    return {"sync_state": sync_state, "last_sync_date": last_sync_date}
 
-    for item in timeline:
-        msg = item['msg']
-        email_type = item['type']
-        refs, msg_id = get_email_references(msg)
-        
-        if msg_id in processed_message_ids: continue
-        processed_message_ids.add(msg_id)
-        
+class SyncMatcher:
+    """
+    Matching step of apply_sync(): finds the thread of each MailRecord in the local
+    mirror (ctx.threads) and stages the result there and in `changes` / `sheet_rows`
+    (cell updates of existing rows) and `new_rows` (rows to append).
+    feed() takes records in date order, all at once (apply_sync) or batch by batch as
+    the scan delivers them (pipeline.py). Nothing is committed: rollback the store to
+    drop what was staged. `seconds` is the time spent matching.
+    """
+
+    def __init__(self, ctx, operator_emails, record_events):
+        self.threads = ctx.threads
+        self.operator_emails = operator_emails
+        # A full sync replays the whole mailbox history: no state transition events for it
+        self.record_events = record_events
+        self.changes = {}  # row_idx -> {col_idx: value}
+        self.sheet_rows = {}  # row_idx -> row as it is in the sheet (for plan_cell_updates)
+        self.new_rows = []
+        self.processed = set()
+        self.seconds = 0.0
+
+    def feed(self, records):
+        started = time.monotonic()
+        try:
+            for rec in records:
+                self.match(rec)
+        finally:
+            self.seconds += time.monotonic() - started
+
+    def match(self, rec):
+        email_type = rec.email_type
+        refs, msg_id = rec.refs, rec.msg_id
+    
+        if msg_id in self.processed: return
+        self.processed.add(msg_id)
+    
         parent_row_idx = None
-        
-        # A. Strict ID Check
-        for ref in refs:
-            if ref in id_map:
-                parent_row_idx = id_map[ref]
-                break
-        
+    
+        # A. Strict ID Check (thread index knows every message id seen in a thread)
+        parent_row_idx = self.threads.find_thread(refs)
+    
         # B. Fallback Subject Check
         if not parent_row_idx:
-            subj = clean_subject(msg.subject)
-            if subj and subj in subject_map:
-                parent_row_idx = subject_map[subj]
+            subj = clean_subject(rec.subject)
+            parent_row_idx = self.threads.find_by_subject(subj)
+            if parent_row_idx:
                 print(f"Matched by Subject: '{subj}' -> Row {parent_row_idx}")
 
         if parent_row_idx:
+            # Remember all ids of this message so later replies match by ID
+            self.threads.link(refs, self.threads.get(parent_row_idx)[0])
             # UPDATE EXISTING ROW - but only if this is a NEW message in the thread
-            existing_row = row_data.get(parent_row_idx, [])
+            existing_row = self.threads.get(parent_row_idx)
             # Use last_activity (column H, index 7) for comparison, not time (column D)
             existing_last_activity = existing_row[7] if len(existing_row) > 7 else ""
-            new_time = normalize_date(msg.date)
-            
+            new_time = normalize_date(rec.date)
+        
             # Skip if this is the same message (same timestamp)
             if existing_last_activity == new_time:
-                continue
-            
+                return
+        
             # Check if manually closed - if so, we force update to reopen
             is_closed = str(existing_last_activity).strip().lower() == 'закрыт'
-            
+        
             # Only update if the new message is actually newer OR if thread was closed
             if not is_closed and existing_last_activity and existing_last_activity >= new_time:
-                continue
-                
-            print(f"Updating Row {parent_row_idx} with new {email_type} email from {msg.from_}")
+                return
+            
+            print(f"Updating Row {parent_row_idx} with new {email_type} email from {rec.from_}")
             # Determine status based on whether sender is an operator
-            sender_email = extract_email(msg.from_).lower()
-            if sender_email in operator_emails:
+            sender_email = extract_email(rec.from_).lower()
+            if sender_email in self.operator_emails:
                 new_status = 'оператор ответил'
             else:
                 new_status = 'ответ не от оператора'
-            
+        
             # Note: D (time) is NOT updated - it's the original thread creation time
-            updates.append({'range': f'E{parent_row_idx}', 'values': [[new_status]]})
-            updates.append({'range': f'G{parent_row_idx}', 'values': [[msg.from_]]})
-            # Update last_activity (column H)
-            updates.append({'range': f'H{parent_row_idx}', 'values': [[new_time]]})
-            
-            # Update cached data to prevent duplicate updates in same run
-            if parent_row_idx in row_data:
+            # E = status, G = last_replyer, H = last_activity
+            self.sheet_rows.setdefault(parent_row_idx, list(existing_row))
+            self.changes.setdefault(parent_row_idx, {}).update({4: new_status, 6: rec.from_, 7: new_time})
+        
+            # Update local mirror to prevent duplicate updates in same run
+            if existing_row:
                 # Extend row if needed
-                while len(row_data[parent_row_idx]) <= 7:
-                    row_data[parent_row_idx].append("")
-                row_data[parent_row_idx][7] = new_time
+                while len(existing_row) <= 7:
+                    existing_row.append("")
+                previous_status = existing_row[4]
+                existing_row[4] = new_status
+                existing_row[6] = rec.from_
+                existing_row[7] = new_time
+                self.threads.put(parent_row_idx, existing_row)
+                if self.record_events and previous_status != new_status:
+                    self.threads.add_event('status_changed', parent_row_idx, existing_row, previous_status=previous_status)
+                elif self.record_events:
+                    # New activity (G/H), same status: readers still need the new row
+                    self.threads.add_event('thread_updated', parent_row_idx, existing_row)
         else:
             # NEW ROW
-            if msg_id in id_map: continue
+            if self.threads.find_by_id(msg_id): return
 
-            print(f"New Thread: {msg.subject[:30]}")
-            status = "ответа нет" if email_type == 'received' else "отправлено"
-            
+            print(f"New Thread: {rec.subject[:30]}")
+            status = OVERDUE_STATUS if email_type == 'received' else "отправлено"
+        
             row = [
                 msg_id,
-                msg.subject,
-                msg.from_,
-                normalize_date(msg.date),
+                rec.subject,
+                rec.from_,
+                normalize_date(rec.date),
                 status,
                 email_type,
-                msg.from_,
-                normalize_date(msg.date)  # last_activity
+                rec.from_,
+                normalize_date(rec.date)  # last_activity
             ]
-            new_rows.append(row)
-            
-            next_row_idx = len(all_values) + len(new_rows)
-            id_map[msg_id] = next_row_idx
-            subj = clean_subject(msg.subject)
-            if subj: subject_map[subj] = next_row_idx
+            self.new_rows.append(row)
+            if self.record_events:
+                self.threads.add_event('thread_new', self.threads.last_row() + 1, row)
+            self.threads.put(self.threads.last_row() + 1, row)
+            self.threads.link(refs, msg_id)
+
+def apply_sync(ctx, prepared, fetched, fetch_final=False, matcher=None):
+    """
+    Matches ctx.records against the local mirror and writes new/updated threads
+    (results of prepare_sync() and fetch_sync_records()), then saves the checkpoints
+    and the snapshot. Returns the sync_emails() result.
+    `matcher` (SyncMatcher) has already been fed ctx.records while they were fetched.
+    """
+    worksheet, operator_emails = prepared["worksheet"], prepared["operator_emails"]
+    sync_state, last_sync_date = fetched["sync_state"], fetched["last_sync_date"]
+    last_sync_file = ctx.state_path(LAST_SYNC_FILE)
+    threads = ctx.threads
+
+    if matcher is None:
+        print(f"Processing {len(ctx.records)} emails from timeline...")
+        matcher = SyncMatcher(ctx, operator_emails, last_sync_date is not None)
+        matcher.feed(ctx.records)
+    changes, sheet_rows, new_rows = matcher.changes, matcher.sheet_rows, matcher.new_rows
 
+    ctx.metrics.record('sync.match', matcher.seconds)
+    ctx.metrics.count('threads_new', len(new_rows))
+    ctx.metrics.count('threads_updated', len(changes))
 
     # Execute Writes
-    if new_rows:
-        print(f"Adding {len(new_rows)} new threads...")
-        worksheet.append_rows(new_rows)
-        
-    if updates:
-        print(f"Updating {len(updates)} cells...")
-        worksheet.batch_update(updates)
+    try:
+        with ctx.metrics.phase('sync.write'):
+            if new_rows:
+                print(f"Adding {len(new_rows)} new threads...")
+                worksheet.append_rows(new_rows)
+                
+            updates = plan_cell_updates(changes, sheet_rows)
+            if updates:
+                print(f"Updating {len(changes)} threads in {len(updates)} ranges...")
+                worksheet.batch_update(updates)
+    except Exception as e:
+        # Sheet state is unknown now: drop staged changes and reload next time
+        threads.rollback()
+        threads.invalidate()
+        return {"error": f"Failed to write to Google Sheets: {e}"}
+    threads.prune_events()
+    threads.commit()
     
 
 
-    print("Sync Done. Fetching final data...")
+    print("Sync Done.")
     try:
-        # Save current date for next incremental sync
-        with open(LAST_SYNC_FILE, 'w') as f:
+        # Save UID checkpoints and current date for next incremental sync
+        save_sync_state(sync_state, ctx.state_path(SYNC_STATE_FILE))
+        with open(last_sync_file, 'w') as f:
             f.write(datetime.date.today().strftime('%Y-%m-%d'))
-        
-        final_data = worksheet.get_all_records()
-        return {"status": "success", "data": final_data}
+
+        with ctx.metrics.phase('sync.snapshot'):
+            version = write_threads_snapshot(ctx)
+        result = {"status": "success", "new": len(new_rows), "updated": len(changes), "snapshot_version": version}
+        if fetch_final:
+            with ctx.metrics.phase('sync.final_read'):
+                result["data"] = worksheet.get_all_records()
+        return result
     except Exception as e:
-         return {"error": f"Failed to fetch final data: {e}"}
+         return {"error": f"Failed to save sync results: {e}"}
+
+def log_row_date(row):
+    """'YYYY-MM-DD' of an operator log row [id, sender, subject, time, ...] or None."""
+    if len(row) < 4 or not row[3]: return None
+    time_str = row[3]
+    try:
+        if ' ' in time_str:
+            dt = datetime.datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S')
+        else:
+            dt = datetime.datetime.strptime(time_str, '%Y-%m-%d')
+    except ValueError:
+        return None
+    return dt.strftime('%Y-%m-%d')
+
+def count_operator_emails(log_rows):
+    """{date_str: {operator_email: count}} for operator log rows."""
+    stats = {}
+    for row in log_rows:
+        if len(row) < 4: continue
+        # row[1] is Sender in our Loop below
+        sender = extract_email(row[1])
+        date_str = log_row_date(row)
+        if not sender or not date_str: continue
+        if date_str not in stats: stats[date_str] = {}
+        stats[date_str][sender] = stats[date_str].get(sender, 0) + 1
+    return stats
 
-def update_daily_stats(log_rows, stats_sheet_name="OperatorStats"):
+def get_stats_sheet(ctx, stats_sheet_name, create=True):
+    stats_ws = ctx.worksheet_by_title(GOOGLE_SHEET_URL, stats_sheet_name)
+    if not stats_ws and create:
+        print(f"Sheet '{stats_sheet_name}' not found. Creating...")
+        spreadsheet = ctx.spreadsheet(GOOGLE_SHEET_URL)
+        stats_ws = spreadsheet.add_worksheet(title=stats_sheet_name, rows=1000, cols=10)
+        stats_ws.append_row(["Date", "Operator", "Count"])
+    return stats_ws
+
+def update_daily_stats(ctx, log_rows, stats_sheet_name="OperatorStats"):
     """
-    Calculates stats from the log rows and updates the Stats sheet.
+    Recalculates stats from all log rows and updates the Stats sheet.
     log_rows: list of [id, sender, subject, time, ...] (raw values)
+    Returns ({(date, operator): (count, row_idx)}, last_row) as now in the sheet,
+    for OperatorStatsStore.reconcile(), or None on error.
     """
     try:
-        # 0. Prep Stats
-        stats = {} # { date_str: { operator_email: count } }
-        
-        for row in log_rows:
-            if len(row) < 4: continue
-            # row[1] is Sender in our Loop below
-            sender = extract_email(row[1]) 
-            time_str = row[3] 
-            
-            if not sender or not time_str: continue
-            
-            try:
-                if ' ' in time_str:
-                    dt = datetime.datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S')
-                else:
-                    dt = datetime.datetime.strptime(time_str, '%Y-%m-%d')
-                date_str = dt.strftime('%Y-%m-%d')
-                
-                if date_str not in stats: stats[date_str] = {}
-                stats[date_str][sender] = stats[date_str].get(sender, 0) + 1
-            except:
-                continue
+        stats = count_operator_emails(log_rows)
 
-        if not stats:
+        stats_ws = get_stats_sheet(ctx, stats_sheet_name, create=bool(stats))
+        if not stats_ws:
             print("No stats data to update.")
-            return
-
-        creds = get_credentials()
-        client = gspread.authorize(creds)
-        spreadsheet = client.open_by_url(GOOGLE_SHEET_URL)
-        
-        try:
-            stats_ws = spreadsheet.worksheet(stats_sheet_name)
-        except:
-            print(f"Sheet '{stats_sheet_name}' not found. Creating...")
-            stats_ws = spreadsheet.add_worksheet(title=stats_sheet_name, rows=1000, cols=10)
-            stats_ws.append_row(["Date", "Operator", "Count"])
+            return {}, 1
 
         existing_values = stats_ws.get_all_values()
         existing_map = {} # (date, operator) -> row_index
+        counts = {}
         
         for i, row in enumerate(existing_values):
             if i == 0: continue
             if len(row) >= 2:
                 # Key: (Date, Operator)
                 existing_map[(row[0], row[1])] = i + 1
+                try:
+                    counts[(row[0], row[1])] = (int(row[2]) if len(row) > 2 else 0, i + 1)
+                except ValueError:
+                    counts[(row[0], row[1])] = (0, i + 1)
         
-        updates = []
+        changes = {}
         new_rows = []
+        last_row = max(len(existing_values), 1)
         
         for date_str, ops in stats.items():
             for op, count in ops.items():
@@ -455,25 +1981,94 @@ def update_daily_stats(log_rows, stats_sheet_name="OperatorStats"):
                     row_idx = existing_map[(date_str, op)]
                     current_val = existing_values[row_idx-1][2] if len(existing_values[row_idx-1]) > 2 else "0"
                     if str(current_val) != str(count):
-                         updates.append({'range': f'C{row_idx}', 'values': [[count]]})
+                         changes[row_idx] = {2: count}
                 else:
                     new_rows.append([date_str, op, count])
+                    row_idx = last_row + len(new_rows)
+                counts[(date_str, op)] = (count, row_idx)
         
+        updates = plan_cell_updates(changes)
         if updates:
-            print(f"Updating {len(updates)} stats records...")
+            print(f"Updating {len(changes)} stats records...")
             stats_ws.batch_update(updates)
         if new_rows:
             print(f"Adding {len(new_rows)} new stats records...")
             stats_ws.append_rows(new_rows)
+        return counts, last_row + len(new_rows)
             
+    except Exception as e:
+        print(f"Error updating stats: {e}")
+        return None
+
+def apply_daily_stats_delta(ctx, store, new_log_rows, stats_sheet_name="OperatorStats"):
+    """
+    Adds the counts of `new_log_rows` to the stored counters and writes only the
+    touched (date, operator) cells: changed counts as one batch_update, new pairs as
+    one append_rows. On failure the store is invalidated so the next run recounts.
+    The A:B cells (date, operator) of the touched rows are read first: if any of them
+    no longer holds its pair (rows edited by hand), nothing is written and True is
+    returned, the caller then recounts from the whole log.
+    """
+    try:
+        stats = count_operator_emails(new_log_rows)
+        if not stats:
+            return
+        stats_ws = get_stats_sheet(ctx, stats_sheet_name)
+
+        changes = {}
+        keys = {}  # row_idx -> [date, operator] expected in A:B
+        new_rows = []
+        next_row = store.last_row() + 1
+        for date_str, ops in stats.items():
+            for op, delta in ops.items():
+                count, row_idx = store.get_count(date_str, op) or (0, None)
+                count += delta
+                if row_idx:
+                    changes[row_idx] = {2: count}
+                    keys[row_idx] = [date_str, op]
+                else:
+                    row_idx = next_row
+                    next_row += 1
+                    new_rows.append([date_str, op, count])
+                store.set_count(date_str, op, count, row_idx)
+        store.set_last_row(next_row - 1)
+
+        if keys:
+            row_idxs = sorted(keys)
+            found = stats_ws.batch_get([f'A{row_idx}:B{row_idx}' for row_idx in row_idxs])
+            if any((values[0] if values else []) != keys[row_idx] for row_idx, values in zip(row_idxs, found)):
+                store.rollback()
+                return True
+
+        try:
+            updates = plan_cell_updates(changes)
+            if updates:
+                print(f"Updating {len(changes)} stats records...")
+                stats_ws.batch_update(updates)
+            if new_rows:
+                print(f"Adding {len(new_rows)} new stats records...")
+                stats_ws.append_rows(new_rows)
+        except Exception:
+            store.rollback()
+            store.invalidate()
+            raise
+        store.commit()
+
     except Exception as e:
         print(f"Error updating stats: {e}")
 
-def log_operator_activity(log_gid):
+def log_operator_activity(ctx, log_gid):
     """
     Scans Inbox and Sent for operator emails (from GID 2115150025).
     Logs them to sheet `log_gid`.
     Aggregates stats to 'OperatorStats'.
+    Reuses ctx.records when sync_emails() already fetched them in this run and they
+    start where the last successful run left off (ctx.records_checkpoints vs the
+    store's covered checkpoints), otherwise scans the last 24 hours over IMAP, so
+    messages of a failed run are picked up by the next one.
+    Dedup and stats go through ctx.operator_stats: normally neither the log nor the
+    stats sheet is read, only the new rows are counted. A full recount from the
+    log runs when the store is stale (see OperatorStatsStore).
     """
     if not YANDEX_EMAIL or not YANDEX_PASSWORD:
         return {"error": "Yandex credentials missing"}
@@ -481,198 +2076,230 @@ def log_operator_activity(log_gid):
     print(f"Starting Operator Activity Log (Target GID: {log_gid})...")
     
     try:
-        creds = get_credentials()
-        client = gspread.authorize(creds)
-        
         # 1. Operators
-        operators = get_operator_emails(client)
+        operators = get_operator_emails(ctx)
         if not operators: return {"error": "No operators found"}
         
         # 2. Log Sheet
-        ws = get_log_sheet(client, log_gid)
+        ws = get_log_sheet(ctx, log_gid)
         
-        # 3. Read Existing
-        all_log_values = ws.get_all_values()
-        existing_ids = set()
-        if all_log_values:
+        # 3. Read Existing (only for a full recount)
+        store = ctx.operator_stats
+        full = store.needs_reconcile() or not get_stats_sheet(ctx, "OperatorStats", create=False)
+        all_log_values = None
+        if full:
+            print("Recounting operator stats from the whole log...")
+            all_log_values = ws.get_all_values()
+            existing_ids = set()
             for row in all_log_values[1:]:
                 if row: existing_ids.add(row[0])
+            is_logged = existing_ids.__contains__
+        else:
+            existing_ids = set()
+            is_logged = lambda msg_id: msg_id in existing_ids or store.is_logged(msg_id)
         
         # 4. Scan
         new_rows = []
         date_start = datetime.datetime.now(MSK_TZ) - datetime.timedelta(hours=24)
         
-        with MailBox('mail.21vek.tech', port=993).login(YANDEX_EMAIL, YANDEX_PASSWORD) as mailbox:
-            folders_to_scan = ['INBOX']
-            sent_folder = None
-            for name in SENT_FOLDER_NAMES:
-                if mailbox.folder.exists(name):
-                    sent_folder = name
-                    break
-            if sent_folder: folders_to_scan.append(sent_folder)
-            
-            for folder in folders_to_scan:
-                print(f"Scanning {folder} from {date_start.date()}...")
+        span = ctx.records_checkpoints if ctx.records is not None else None
+        if span and span[0] in (None, store.covered_checkpoints()):
+            print(f"Reusing {len(ctx.records)} messages fetched by sync...")
+            records = ctx.records
+        else:
+            if span:
+                print("Sync records don't cover the last operator log run, rescanning 24h...")
+            folders_to_scan = find_scan_folders(ctx)
+            search_date = date_start.date()
+
+            def select(mailbox, folder):
+                from imap_tools import AND
+                print(f"Scanning {folder} from {search_date}...")
                 mailbox.folder.set(folder)
-                search_date = date_start.date()
-                for msg in mailbox.fetch(AND(date_gte=search_date)):
-                     if msg.date < date_start.astimezone(msg.date.tzinfo): continue
-                     
-                     sender = extract_email(msg.from_)
-                     if sender not in operators: continue
-                     
-                     msg_id = msg.headers.get('message-id', [str(msg.uid)])[0].strip('<> ')
-                     if msg_id in existing_ids: continue
-                     
-                     # Add [ID, Sender, Subject, Time]
-                     new_rows.append([msg_id, msg.from_, msg.subject, normalize_date(msg.date)])
-                     existing_ids.add(msg_id)
+                return mailbox.uids(AND(date_gte=search_date))
+
+            records = [rec for folder_records in scan_folders(ctx, folders_to_scan, select)
+                       for rec in folder_records]
+        
+        for rec in records:
+            if rec.date < date_start: continue
+            
+            sender = extract_email(rec.from_)
+            if sender not in operators: continue
+            
+            if is_logged(rec.msg_id): continue
+            
+            # Add [ID, Sender, Subject, Time]
+            new_rows.append([rec.msg_id, rec.from_, rec.subject, normalize_date(rec.date)])
+            existing_ids.add(rec.msg_id)
         
         if new_rows:
             print(f"Adding {len(new_rows)} new operator emails...")
             ws.append_rows(new_rows)
-            # Add to memory for stats
-            if all_log_values: all_log_values.extend(new_rows)
-            else: all_log_values = [["ID", "Sender", "Subject", "Time"]] + new_rows
         else:
             print("No new operator emails found.")
+        ctx.metrics.count('operator_rows_added', len(new_rows))
+        if span:
+            # Everything up to the end of the sync fetch is in the log now
+            store.set_covered_checkpoints(span[1])
+            store.commit()
             
-        update_daily_stats(all_log_values[1:] if len(all_log_values)>1 else [], "OperatorStats")
+        with ctx.metrics.phase('operators.stats'):
+            log_rows = None
+            if full:
+                log_rows = all_log_values[1:] + new_rows
+            else:
+                for row in new_rows:
+                    store.mark_logged(row[0], log_row_date(row) or '')
+                store.prune_logged()
+                store.commit()
+                if apply_daily_stats_delta(ctx, store, new_rows, "OperatorStats"):
+                    print("OperatorStats rows were edited, recounting from the whole log...")
+                    log_rows = ws.get_all_values()[1:]
+            if log_rows is not None:
+                result = update_daily_stats(ctx, log_rows, "OperatorStats")
+                if result is not None:
+                    logged = {row[0]: log_row_date(row) or '' for row in log_rows if row and row[0]}
+                    store.reconcile(logged, *result)
         return {"status": "success", "new_count": len(new_rows)}
 
     except Exception as e:
         print(f"Error in log_operator_activity: {e}")
         return {"error": str(e)}
 
-def log_overdue_emails(target_gid):
+def log_overdue_emails(ctx, target_gid):
     """
     Logs overdue emails (>3 hours, status 'ответа нет') to the specified GID.
     Ignoring operator filtering (GID 2012399964).
+    New rows come from ctx.threads.overdue (deadline heap), already logged ids from
+    the local overdue_log index, so the main sheet is not read on a normal run.
+    Durations (col E) of still unanswered rows are rewritten once per
+    OVERDUE_DURATION_REFRESH_INTERVAL.
+    Before any write, column A of the log is read to check the indexed rows (rows
+    deleted or sorted by hand re-index it) and to find the real last row.
     """
     print(f"Logging overdue emails (>3h) to sheet GID {target_gid}...")
     
     try:
-        # Connect
-        creds = get_credentials()
-        client = gspread.authorize(creds)
-        
         # 1. Open Target Sheet (Log)
-        target_ws = get_log_sheet(client, target_gid)
+        target_ws = get_log_sheet(ctx, target_gid)
         
-        # 2. Open Main Sheet (Source)
-        try:
-            source_ws = client.open_by_url(GOOGLE_SHEET_URL).worksheet("Sheet1") 
-        except:
-             pass
+        # 2. Open Main Sheet (Source) via local mirror
+        source_ws = get_sheet(ctx)
+        threads = ctx.threads
+        threads.ensure_fresh(source_ws)
         
-        source_sheet = client.open_by_url(GOOGLE_SHEET_URL)
-        source_ws = None
-        for ws in source_sheet.worksheets():
-            if ws.id == 0:
-                source_ws = ws
-                break
-        if not source_ws: source_ws = source_sheet.sheet1
-        
-        # 3. Read Data
-        source_values = source_ws.get_all_values() 
-        
-        # 4. Read Existing Data from Target (Map ID -> Row Index)
-        target_values = target_ws.get_all_values()
-        target_map = {} # ID -> Row Index
-        if target_values:
-            for i, row in enumerate(target_values):
-                if i == 0: continue # Skip header
-                if row:
-                    target_map[row[0]] = i + 1
-            print(f"DEBUG: Loaded {len(target_map)} IDs from target sheet.")
+        # 3. Index of already logged IDs (full read of the target only when stale)
+        if threads.overdue_log_stale():
+            print("Loading overdue log index...")
+            threads.reset_overdue_log(target_ws.get_all_values())
 
         new_rows = []
-        updates = []
+        changes = {}  # row_idx -> {col_idx: value}
         now = datetime.datetime.now(MSK_TZ)
+        scheduler = threads.overdue
+        due = scheduler.pop_due(now)
+        refresh = time.time() - threads.overdue_refreshed_at() >= OVERDUE_DURATION_REFRESH_INTERVAL
+        next_row = threads.overdue_log_last_row() + 1
+        if due or refresh:
+            # Row indexes are written to: check them against column A first
+            ids = [row[0] if row else '' for row in target_ws.batch_get(['A2:A'])[0]]
+            if not threads.overdue_log_matches(ids):
+                print("Overdue log rows were moved, re-indexing from column A...")
+                threads.reset_overdue_log([['id']] + [[msg_id] for msg_id in ids])
+            next_row = len(ids) + 2
         
-        # 5. Iterate Source
-        for i, row in enumerate(source_values):
-            if i == 0: continue 
-            if len(row) < 5: continue
-            
-            msg_id = row[0]
-            subject = row[1]
-            sender = row[2]
+        # 4. Threads whose deadline has passed since the last run
+        for msg_id in due:
+            if threads.overdue_logged(msg_id): continue
+            row_idx = threads.find_by_id(msg_id)
+            row = threads.get(row_idx)
             time_str = row[3]
-            status = row[4].strip().lower()
-            
-            if status != 'ответа нет':
-                print(f"DEBUG: Msg {msg_id} skipped. Status: '{status}'")
-                continue
-                
-            try:
-                dt = datetime.datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S')
-                # Assume stored dates are MSK if no tzinfo, but we compare with aware 'now'
-                if dt.tzinfo is None:
-                    dt = dt.replace(tzinfo=MSK_TZ) 
-            except ValueError:
-                print(f"DEBUG: Msg {msg_id} date parse error: '{time_str}'")
-                continue
-            
-            diff = now - dt
-            print(f"DEBUG: Msg {msg_id} age: {diff}")
-            
-            # Check > 3 Hours
-            if diff > datetime.timedelta(hours=3):
-                duration_str = str(now - dt).split('.')[0]
-                
-                # Check Deduplication / Update
-                if msg_id in target_map:
-                    # UPDATE existing row duration (Col E)
-                    row_idx = target_map[msg_id]
-                    # print(f"DEBUG: Updating Row {row_idx} for ID {msg_id}")
-                    updates.append({
-                        'range': f'E{row_idx}',
-                        'values': [[duration_str]]
-                    })
-                else:
-                    # INSERT new row
-                    new_rows.append([
-                        msg_id,
-                        subject,
-                        sender,
-                        time_str,
-                        duration_str
-                    ])
-                    # Add to map to prevent dupes in same run
-                    # (Though we don't know the row index yet, but preventing double insert is enough)
-                    target_map[msg_id] = -1 
+            threads.add_event('overdue', row_idx, row, overdue_since=scheduler.overdue[msg_id].isoformat())
+            new_rows.append([
+                msg_id,
+                row[1],
+                row[2],
+                time_str,
+                str(now - (scheduler.overdue[msg_id] - OVERDUE_AFTER)).split('.')[0]
+            ])
+            threads.set_overdue_logged(msg_id, next_row)
+            next_row += 1
+        threads.set_overdue_log_last_row(next_row - 1)
+        
+        # 5. Coarse refresh of durations (Col E) of logged, still unanswered emails
+        if refresh:
+            logged_new = {r[0] for r in new_rows}
+            for msg_id, deadline in scheduler.overdue.items():
+                row_idx = threads.overdue_logged(msg_id)
+                if row_idx and msg_id not in logged_new:
+                    changes[row_idx] = {4: str(now - (deadline - OVERDUE_AFTER)).split('.')[0]}
+            threads.set_overdue_refreshed_at(time.time())
         
         # 6. Execute Writes
-        if new_rows:
-            print(f"Adding {len(new_rows)} new overdue emails...")
-            target_ws.append_rows(new_rows)
-            
-        if updates:
-            print(f"Updating duration for {len(updates)} existing overdue emails...")
-            target_ws.batch_update(updates)
+        try:
+            if new_rows:
+                print(f"Adding {len(new_rows)} new overdue emails...")
+                target_ws.append_rows(new_rows)
+                
+            updates = plan_cell_updates(changes)
+            if updates:
+                print(f"Updating duration for {len(changes)} existing overdue emails ({len(updates)} ranges)...")
+                target_ws.batch_update(updates)
+        except Exception:
+            threads.rollback()
+            threads.invalidate_overdue_log()
+            raise
+        threads.commit()
+        ctx.metrics.count('overdue_rows_added', len(new_rows))
+        ctx.metrics.count('overdue_durations_updated', len(changes))
             
-        if not new_rows and not updates:
+        if not new_rows and not changes:
             print("No changes for overdue emails.")
             
-        return {"status": "success", "count": len(new_rows), "updated": len(updates)}
+        return {"status": "success", "count": len(new_rows), "updated": len(changes)}
 
     except Exception as e:
         print(f"Error in log_overdue_emails: {e}")
         return {"error": str(e)}
 
-def get_archive_sheet(gid):
+def close_reminder(ctx, msg_id):
+    """
+    Closes the reminder of thread `msg_id` for the notification app: 'закрыт' in column H
+    of the main sheet, in the local mirror and in the snapshot, so read API clients see
+    it with their next request (used by `serve`, POST /threads/close).
+    A later message in the thread reopens it (see apply_sync).
+    """
+    try:
+        ws = get_sheet(ctx)
+        threads = ctx.threads
+        # Rows are written by index: re-verify the mirror like archive does
+        threads.ensure_fresh(ws, verify=True)
+        row_idx = threads.find_by_id(msg_id)
+        if not row_idx:
+            return {"error": f"Thread {msg_id} not found", "not_found": True}
+        row = threads.get(row_idx)
+        row += [''] * (8 - len(row))
+        if row[7] != 'закрыт':
+            try:
+                ws.batch_update([{'range': f'H{row_idx}', 'values': [['закрыт']]}])
+            except Exception:
+                threads.invalidate()
+                raise
+            row[7] = 'закрыт'
+            threads.put(row_idx, row)
+            threads.add_event('closed', row_idx, row)
+            threads.commit()
+        version = write_threads_snapshot(ctx)
+        print(f"Reminder closed: {msg_id} (row {row_idx}), snapshot v{version}")
+        return {"status": "success", "row": row_idx, "snapshot_version": version}
+    except Exception as e:
+        print(f"Error in close_reminder: {e}")
+        return {"error": str(e)}
+
+def get_archive_sheet(ctx, gid):
     """Get worksheet from archive spreadsheet by GID."""
-    creds = get_credentials()
-    client = gspread.authorize(creds)
-    sheet = client.open_by_url(ARCHIVE_SHEET_URL)
-    
-    for ws in sheet.worksheets():
-        if ws.id == gid:
-            return ws
-    
-    available = [f"{ws.title} (GID: {ws.id})" for ws in sheet.worksheets()]
-    raise ValueError(f"Worksheet GID {gid} not found. Available: {', '.join(available)}")
+    return ctx.worksheet(ARCHIVE_SHEET_URL, gid)
 
 def aggregate_to_stats(rows, stats_ws):
     """
@@ -704,7 +2331,7 @@ def aggregate_to_stats(rows, stats_ws):
             existing_map[r[0]] = i + 1
     
     # Update or insert
-    updates = []
+    changes = {}
     new_rows = []
     
     for ym, count in month_counts.items():
@@ -716,10 +2343,11 @@ def aggregate_to_stats(rows, stats_ws):
                 new_count = int(current) + count
             except:
                 new_count = count
-            updates.append({'range': f'B{row_idx}', 'values': [[new_count]]})
+            changes[row_idx] = {1: new_count}
         else:
             new_rows.append([ym, count])
     
+    updates = plan_cell_updates(changes)
     if updates:
         stats_ws.batch_update(updates)
     if new_rows:
@@ -727,7 +2355,75 @@ def aggregate_to_stats(rows, stats_ws):
     
     return sum(month_counts.values())
 
-def archive_inactive_threads():
+def import_archive_sheet(store, archive_ws):
+    """One-time copy of the archive sheet into the local store (history from before it existed)."""
+    values = archive_ws.get_all_values()
+    while values and not any(values[-1]):
+        values.pop()
+    imported = store.append([row for row in values[1:] if row and row[0]])
+    store.set_sheet_rows(max(len(values), 1))
+    store.set_imported()
+    if imported:
+        print(f"Imported {imported} rows from the archive sheet into {store.path}.")
+    return imported
+
+def trim_archive_sheet(store, archive_ws, max_rows=None):
+    """
+    Deletes the oldest rows of the archive sheet beyond `max_rows` (ARCHIVE_SHEET_MAX_ROWS).
+    They stay in the local store. Returns the number of deleted rows.
+    Skipped while the store is `fresh`: it trims on a later run, once the store has survived one.
+    Skipped under CI unless ARCHIVE_DIR_PERSISTENT: a CI cache is not a safe place for the
+    only copy of the deleted rows.
+    """
+    max_rows = ARCHIVE_SHEET_MAX_ROWS if max_rows is None else max_rows
+    if max_rows <= 0 or store.sheet_rows() - 1 <= max_rows:
+        return 0
+    if os.getenv('CI') and not ARCHIVE_DIR_PERSISTENT:
+        print("Running under CI without ARCHIVE_DIR_PERSISTENT=1, not trimming the archive sheet.")
+        return 0
+    if store.fresh:
+        print(f"Archive store {store.path} was created in this run, not trimming the archive sheet yet.")
+        return 0
+    # The local count may drift if the sheet is edited by hand: recount column A before deleting
+    store.set_sheet_rows(len(archive_ws.col_values(1)))
+    excess = store.sheet_rows() - 1 - max_rows
+    if excess <= 0:
+        return 0
+    delete_sheet_rows(archive_ws, range(2, excess + 2))
+    store.set_sheet_rows(store.sheet_rows() - excess)
+    return excess
+
+def rebuild_archive_stats(ctx):
+    """
+    Sets the month counts of the archive stats sheet from the local store
+    (one read, one batch write). Months missing in the store are left as they are.
+    """
+    try:
+        store = ctx.archive
+        stats_ws = get_archive_sheet(ctx, STATS_GID)
+        if not store.imported:
+            import_archive_sheet(store, get_archive_sheet(ctx, ARCHIVE_GID))
+        counts = store.month_counts()
+
+        existing = stats_ws.get_all_values()
+        current_rows = {}
+        changes = {}
+        for i, r in enumerate(existing[1:], start=2):
+            if r and r[0] in counts:
+                current_rows[i] = r
+                changes[i] = {1: counts.pop(r[0])}
+        updates = plan_cell_updates(changes, current_rows)
+        if updates:
+            stats_ws.batch_update(updates)
+        if counts:
+            stats_ws.append_rows([[ym, count] for ym, count in sorted(counts.items())])
+        print(f"Archive stats rebuilt: {len(updates)} ranges updated, {len(counts)} months added.")
+        return {"status": "success", "updated": len(updates), "added": len(counts)}
+    except Exception as e:
+        print(f"Error in rebuild_archive_stats: {e}")
+        return {"error": str(e)}
+
+def archive_inactive_threads(ctx):
     """
     Archives email threads with no activity for > INACTIVE_MONTHS.
     1. Read main sheet
@@ -735,34 +2431,25 @@ def archive_inactive_threads():
     3. Copy to archive sheet
     4. Aggregate to stats
     5. Delete from main sheet
+    Rows also go to the local ArchiveStore (ctx.archive), which keeps the full
+    history, so the archive sheet can be capped at ARCHIVE_SHEET_MAX_ROWS.
     """
     print(f">>> Archiving threads inactive for >{INACTIVE_MONTHS} months...")
     
     try:
-        creds = get_credentials()
-        client = gspread.authorize(creds)
-        
         # Open main sheet
-        main_sheet = client.open_by_url(GOOGLE_SHEET_URL)
-        main_ws = None
-        for ws in main_sheet.worksheets():
-            if ws.id == 0:
-                main_ws = ws
-                break
-        if not main_ws:
-            main_ws = main_sheet.sheet1
+        main_ws = get_sheet(ctx)
         
         # Open archive and stats sheets
-        archive_ws = get_archive_sheet(ARCHIVE_GID)
-        stats_ws = get_archive_sheet(STATS_GID)
+        archive_ws = get_archive_sheet(ctx, ARCHIVE_GID)
+        stats_ws = get_archive_sheet(ctx, STATS_GID)
         
-        # Read main data
-        all_values = main_ws.get_all_values()
-        if len(all_values) <= 1:
+        # Read main data (local mirror, re-verified since rows are deleted by index)
+        threads = ctx.threads
+        threads.ensure_fresh(main_ws, verify=True)
+        if threads.last_row() <= 1:
             return {"status": "success", "archived": 0, "message": "No data to archive"}
         
-        header = all_values[0]
-        
         # Find last_activity column (H = index 7)
         # Schema: id, theme, sender, time, status, type, last_replyer, last_activity
         LAST_ACTIVITY_COL = 7
@@ -773,10 +2460,7 @@ def archive_inactive_threads():
         rows_to_archive = []
         rows_to_delete = []  # 1-indexed row numbers
         
-        for i, row in enumerate(all_values):
-            if i == 0:
-                continue  # Skip header
-            
+        for row_idx, row in threads.rows():
             # Get last_activity or fallback to time (col D)
             last_activity_str = row[LAST_ACTIVITY_COL] if len(row) > LAST_ACTIVITY_COL else ""
             if not last_activity_str:
@@ -786,7 +2470,8 @@ def archive_inactive_threads():
                 continue
             
             try:
-                last_dt = datetime.datetime.strptime(last_activity_str, '%Y-%m-%d %H:%M:%S')
+                # Stored dates are MSK (see normalize_date)
+                last_dt = datetime.datetime.strptime(last_activity_str, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MSK_TZ)
             except ValueError:
                 continue
             
@@ -794,7 +2479,7 @@ def archive_inactive_threads():
                 # Add archived_at timestamp
                 archived_row = list(row) + [now.strftime('%Y-%m-%d %H:%M:%S')]
                 rows_to_archive.append(archived_row)
-                rows_to_delete.append(i + 1)  # 1-indexed
+                rows_to_delete.append(row_idx)  # 1-indexed
         
         if not rows_to_archive:
             print("No inactive threads found.")
@@ -802,63 +2487,263 @@ def archive_inactive_threads():
         
         print(f"Found {len(rows_to_archive)} inactive threads to archive...")
         
-        # 1. Copy to archive
+        # 1. Copy to the local store (first, so a failed sheet write loses nothing) and to the archive sheet
+        store = ctx.archive
+        if not store.imported:
+            import_archive_sheet(store, archive_ws)
+        stored = store.append(rows_to_archive)
         archive_ws.append_rows(rows_to_archive)
-        print(f"Copied {len(rows_to_archive)} rows to archive.")
+        store.set_sheet_rows(store.sheet_rows() + len(rows_to_archive))
+        print(f"Copied {len(rows_to_archive)} rows to archive ({stored} new in {store.path}).")
         
         # 2. Aggregate to stats
         aggregated = aggregate_to_stats(rows_to_archive, stats_ws)
         print(f"Aggregated {aggregated} emails to stats.")
         
-        # 3. Delete from main (from bottom to top to preserve indices)
-        rows_to_delete.sort(reverse=True)
-        for row_idx in rows_to_delete:
-            main_ws.delete_rows(row_idx)
-        print(f"Deleted {len(rows_to_delete)} rows from main sheet.")
+        # 3. Delete from main (one batchUpdate, ranges bottom-up to preserve indices)
+        try:
+            ranges_count = delete_sheet_rows(main_ws, rows_to_delete)
+        except Exception:
+            threads.invalidate()
+            raise
+        for row_idx, row in zip(rows_to_delete, rows_to_archive):
+            threads.add_event('archived', row_idx, row[:-1])
+        threads.delete_rows(rows_to_delete)
+        threads.commit()
+        write_threads_snapshot(ctx)
+        print(f"Deleted {len(rows_to_delete)} rows ({ranges_count} ranges) from main sheet.")
+        ctx.metrics.count('threads_archived', len(rows_to_archive))
+
+        # 4. Keep the archive sheet bounded, older rows stay in the local store
+        trimmed = trim_archive_sheet(store, archive_ws)
+        if trimmed:
+            print(f"Trimmed {trimmed} oldest rows from the archive sheet.")
         
         return {
             "status": "success",
             "archived": len(rows_to_archive),
             "aggregated": aggregated,
-            "deleted": len(rows_to_delete)
+            "deleted": len(rows_to_delete),
+            "trimmed": trimmed
         }
         
     except Exception as e:
         print(f"Error in archive_inactive_threads: {e}")
         return {"error": str(e)}
 
-if __name__ == "__main__":
-    print(">>> Running full sync (Inbox + Sent Log)...")
-    
-    # 1. Sync Inbox
-    result = sync_emails()
+def run_daemon(archive=False):
+    """
+    Long-running mode (python parser.py --daemon [--archive]).
+    Keeps one IMAP session and one Sheets client alive:
+    - INBOX changes are pushed via IMAP IDLE; after each IDLE wait a cheap
+      STATUS check on INBOX and Sent decides whether sync_emails() must run
+    - new operator emails are logged right after each sync from the fetched records;
+      operator log (full 24h rescan), overdue and archive (with --archive)
+      also run on DAEMON_JOB_INTERVALS timers
+    Reconnects with exponential backoff if the IMAP session drops.
+    Each cycle (sync and due jobs, without the IDLE wait) is one run: metrics are reset
+    when it starts and the run report / Prometheus textfile are rewritten when it ends.
+    """
+    if not YANDEX_EMAIL or not YANDEX_PASSWORD:
+        print("Daemon Error: Yandex credentials missing in .env")
+        return
+
+    jobs = {
+        'operators': lambda ctx: log_operator_activity(ctx, OPERATOR_LOG_GID),
+        'overdue': lambda ctx: log_overdue_emails(ctx, OVERDUE_LOG_GID),
+    }
+    if archive:
+        jobs['archive'] = lambda ctx: archive_inactive_threads(ctx)
+    next_run = {name: 0 for name in jobs}
+    retry_delay = DAEMON_RETRY_MIN
+    ctx = RunContext(worksheet_ttl=DAEMON_WORKSHEET_TTL)
+
+    while True:
+        try:
+            mailbox = ctx.mailbox
+            print(">>> Daemon: IMAP session opened, waiting for mail...")
+            sent_folder = find_sent_folder(mailbox)
+            need_sync = True
+            while True:
+                ctx.metrics.reset()
+                if need_sync:
+                    with ctx.metrics.phase('sync'):
+                        result = sync_emails(ctx)
+                    if "error" in result:
+                        print(f"Inbox Sync Error: {result['error']}")
+                    elif ctx.records:
+                        with ctx.metrics.phase('operators'):
+                            log_operator_activity(ctx, OPERATOR_LOG_GID)
+
+                # Timer jobs rescan IMAP themselves instead of reusing the last sync batch
+                ctx.records = None
+                for name, job in jobs.items():
+                    if time.monotonic() >= next_run[name]:
+                        with ctx.metrics.phase(name):
+                            job_result = job(ctx)
+                        if "error" in job_result:
+                            print(f"Daemon job '{name}' error: {job_result['error']}")
+                        next_run[name] = time.monotonic() + DAEMON_JOB_INTERVALS[name]
+
+                retry_delay = DAEMON_RETRY_MIN
+                ctx.metrics.write()
+                mailbox.folder.set('INBOX')
+                mailbox.idle.wait(timeout=DAEMON_IDLE_TIMEOUT)
+                need_sync = has_new_messages(ctx, mailbox, 'INBOX') or \
+                    bool(sent_folder and has_new_messages(ctx, mailbox, sent_folder))
+        except KeyboardInterrupt:
+            ctx.close_mailbox()
+            print(">>> Daemon stopped.")
+            return
+        except Exception as e:
+            print(f"Daemon Error: {e}. Reconnecting in {retry_delay}s...")
+            ctx.close_mailbox()
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, DAEMON_RETRY_MAX)
+
+def run_sync(ctx):
+    return report_sync(sync_emails(ctx))
+
+def report_sync(result):
     if "error" in result:
         print(f"Inbox Sync Error: {result['error']}")
     else:
-        print("Inbox Sync Success.")
+        print(f"Inbox Sync Success. New: {result.get('new', 0)}, Updated: {result.get('updated', 0)}, "
+              f"snapshot v{result.get('snapshot_version')}")
+    return result
 
-    # 2. Log Operator Activity (Sent + Inbox)
-    # Log GID: 1286665239
-    log_result = log_operator_activity(1286665239)
-    if "error" in log_result:
-        print(f"Operator Log Error: {log_result['error']}")
+def run_operators(ctx):
+    # Reuses the records of a preceding sync in the same run, otherwise scans IMAP (24h)
+    result = log_operator_activity(ctx, OPERATOR_LOG_GID)
+    if "error" in result:
+        print(f"Operator Log Error: {result['error']}")
     else:
-        print(f"Operator Log Success. New: {log_result.get('new_count', 0)}")
-        
-    # 3. Log Overdue Emails (>3h)
-    # GID: 148916183
-    overdue_result = log_overdue_emails(148916183)
-    if "error" in overdue_result:
-        print(f"Overdue Log Error: {overdue_result['error']}")
+        print(f"Operator Log Success. New: {result.get('new_count', 0)}")
+    return result
+
+def run_overdue(ctx):
+    # Sheets + local thread store only, never opens IMAP
+    result = log_overdue_emails(ctx, OVERDUE_LOG_GID)
+    if "error" in result:
+        print(f"Overdue Log Error: {result['error']}")
+    else:
+        print(f"Overdue Log Success. Count: {result.get('count', 0)}")
+    return result
+
+def run_archive(ctx):
+    result = archive_inactive_threads(ctx)
+    if "error" in result:
+        print(f"Archive Error: {result['error']}")
     else:
-        print(f"Overdue Log Success. Count: {overdue_result.get('count', 0)}")
-
-    # 4. Archive Inactive Threads (>3 months)
-    # Run with: python parser.py --archive
-    import sys
-    if "--archive" in sys.argv:
-        archive_result = archive_inactive_threads()
-        if "error" in archive_result:
-            print(f"Archive Error: {archive_result['error']}")
+        print(f"Archive Success. Archived: {result.get('archived', 0)}, Deleted: {result.get('deleted', 0)}")
+    return result
+
+def run_rebuild_archive_stats(ctx):
+    result = rebuild_archive_stats(ctx)
+    if "error" in result:
+        print(f"Archive Stats Error: {result['error']}")
+    return result
+
+def lookup_archived(msg_ids, state_dir=None):
+    """Prints archived rows from the local ArchiveStore (no network)."""
+    path = os.path.join(state_dir, ARCHIVE_DIR) if state_dir else ARCHIVE_DIR
+    if not os.path.isdir(path):
+        print(f"No local archive in {path}")
+        return
+    store = ArchiveStore(path)
+    for msg_id in msg_ids:
+        row = store.get(msg_id.strip('<>'))
+        print(json.dumps(row, ensure_ascii=False) if row else f"{msg_id}: not in the archive")
+
+JOBS = {
+    'sync': run_sync,
+    'operators': run_operators,
+    'overdue': run_overdue,
+    'archive': run_archive,
+    'archive-stats': run_rebuild_archive_stats,
+}
+
+def run_jobs(names):
+    """Runs jobs in order with one RunContext, then writes the run report."""
+    ctx = RunContext()
+    for name in names:
+        with ctx.metrics.phase(name):
+            JOBS[name](ctx)
+    finish_run(ctx)
+
+def finish_run(ctx):
+    """Closes IMAP sessions, prints Sheets API totals and writes the run report."""
+    ctx.close_mailbox()
+    print(f"Sheets API: {ctx.sheets_stats}")
+    report = ctx.metrics.write()
+    print(f"Run took {report['duration_seconds']:.1f}s, report: {METRICS_REPORT_FILE}, {METRICS_PROM_FILE}")
+
+def parse_args(argv):
+    import argparse
+
+    # Old flag style: no subcommand = all, --daemon / --plan = subcommands (-h stays top-level help)
+    if not argv or (argv[0].startswith('-') and argv[0] not in ('-h', '--help')):
+        if '--plan' in argv:
+            argv = ['plan'] + [a for a in argv if a != '--plan']
+        elif '--daemon' in argv:
+            argv = ['daemon'] + [a for a in argv if a != '--daemon']
         else:
-            print(f"Archive Success. Archived: {archive_result.get('archived', 0)}, Deleted: {archive_result.get('deleted', 0)}")
+            argv = ['all'] + argv
+
+    ap = argparse.ArgumentParser(prog='parser.py', description="Yandex Mail -> Google Sheets parser.")
+    sub = ap.add_subparsers(dest='command', required=True)
+    sub.add_parser('sync', help='sync new INBOX/Sent mail into the main sheet')
+    sub.add_parser('operators', help='log operator emails of the last 24h and update OperatorStats')
+    sub.add_parser('overdue', help='log unanswered threads older than 3h (no IMAP)')
+    p = sub.add_parser('archive', help=f'archive threads inactive for {INACTIVE_MONTHS} months')
+    p.add_argument('--rebuild-stats', action='store_true',
+                   help='then recount the archive stats sheet from the local archive store')
+    p = sub.add_parser('lookup', help='print archived threads by message id (local archive store)')
+    p.add_argument('msg_ids', nargs='+', metavar='MESSAGE_ID')
+    p = sub.add_parser('all', help='sync + operators + overdue (the scheduled run)')
+    p.add_argument('--archive', action='store_true', help='also archive inactive threads')
+    p.add_argument('--pipeline', action='store_true',
+                   help='overlap Sheets reads with the IMAP scan and operator logging with sync writes (pipeline.py)')
+    p = sub.add_parser('daemon', help='long-running mode with IMAP IDLE')
+    p.add_argument('--archive', action='store_true', help='also run the archive job daily')
+    p = sub.add_parser('serve', help='local HTTP read API, event stream and reminder closes (see read_api.py)')
+    p.add_argument('--host', help='address to listen on (READ_API_HOST, default 127.0.0.1)')
+    p.add_argument('--port', type=int, help='port (READ_API_PORT, default 8765)')
+    p = sub.add_parser('plan', help='dry run: print planned sheet changes as JSON')
+    p.add_argument('--archive', action='store_true', help=argparse.SUPPRESS)  # archive is always planned
+    p.add_argument('--plan-cache', metavar='DIR', help='record IMAP/Sheets inputs here, replay them later')
+    p.add_argument('--plan-out', metavar='FILE', help='write the plan to FILE instead of stdout')
+    return ap.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.command == 'plan':
+        # Dry run: compute the sheet diff without writing (see dry_run.py)
+        from dry_run import run_plan
+        run_plan(cache_dir=args.plan_cache, out_file=args.plan_out)
+    elif args.command == 'daemon':
+        run_daemon(archive=args.archive)
+    elif args.command == 'all' and args.pipeline:
+        print(">>> Running full sync (Inbox + Sent Log), pipelined...")
+        from pipeline import run_pipeline
+        run_pipeline(archive=args.archive)
+    elif args.command == 'all':
+        print(">>> Running full sync (Inbox + Sent Log)...")
+        run_jobs(['sync', 'operators', 'overdue'] + (['archive'] if args.archive else []))
+    elif args.command == 'archive':
+        run_jobs(['archive'] + (['archive-stats'] if args.rebuild_stats else []))
+    elif args.command == 'lookup':
+        lookup_archived(args.msg_ids)
+    elif args.command == 'serve':
+        from read_api import serve
+        # Reminder closes run on one worker thread of the server, which owns this context
+        ctx = RunContext(worksheet_ttl=DAEMON_WORKSHEET_TTL)
+        serve(THREADS_SNAPSHOT_FILE, args.host, args.port, events_db=THREADS_DB_FILE,
+              close_reminder=lambda msg_id: close_reminder(ctx, msg_id))
+    else:
+        run_jobs([args.command])
+
+if __name__ == "__main__":
+    # Helper modules (dry_run) `import parser`: reuse this module instead of loading it twice
+    sys.modules.setdefault('parser', sys.modules[__name__])
+    main()
@@ -0,0 +1,128 @@
+"""
+Pipelined scheduled run: python parser.py all --pipeline [--archive]
+
+Runs the same jobs as `parser.py all`, but overlaps their I/O on an asyncio loop.
+The blocking gspread / imap_tools calls run in executors, one per lane:
+
+    sheets:    prepare_sync ── match ─ match ─ ... ─┐ apply_sync ── overdue ── (archive)
+    imap:      fetch_sync_records (chunk, chunk, ...) ┘─┐
+    operators:                                          └─ log_operator_activity
+
+- The Sheets reads of sync (operator list, main sheet check/download) run while
+  IMAP logs in and scans INBOX/Sent.
+- Matching runs on the sheets lane while the scan goes on: fetched chunks go through
+  a MailTimeline, which hands out records in date order once no folder can still
+  deliver an older one (a reply needs the message that opened its thread). If a
+  folder does deliver one after all, the staged matches are rolled back and
+  apply_sync() matches the whole scan again.
+- Operator logging (its Sheets reads/writes) runs while sync writes the main sheet.
+  It only needs the fetched records.
+- Overdue and archive follow the sync writes, because they read the thread mirror.
+
+Each lane is a single thread, so every local SQLite store is used only by the
+thread that opened it; the RunContext caches both Sheets lanes use (worksheets,
+operator list) are filled under its lock. Sheets requests are counted per thread,
+so each phase reports its own lane's requests. Phases of different lanes overlap
+in the run report, so their seconds add up to more than the run duration.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import parser
+from parser import RunContext
+
+
+def timed(ctx, name, func, *args):
+    """func(*args) inside metrics phase `name` (runs in an executor thread)."""
+    def run():
+        with ctx.metrics.phase(name):
+            return func(*args)
+    return run
+
+
+async def sync_emails(ctx, on, sheets, imap, scanned):
+    """
+    parser.sync_emails() on the lanes: prepare_sync || fetch_sync_records, fetched records
+    are matched on the sheets lane as they arrive, then apply_sync writes.
+    `scanned` (Future) is resolved as soon as the IMAP scan is over.
+    """
+    loop = asyncio.get_running_loop()
+    arrived = asyncio.Event()
+    timeline = parser.MailTimeline(notify=lambda: loop.call_soon_threadsafe(arrived.set))
+    try:
+        prepare = on(sheets, 'sync.prepare', parser.prepare_sync, ctx)
+        fetch = on(imap, 'sync.fetch', parser.fetch_sync_records, ctx, timeline)
+        fetch.add_done_callback(lambda _: arrived.set())
+
+        prepared = await prepare
+        if "error" not in prepared:
+            record_events = parser.read_last_sync_date(ctx) is not None
+            matcher = parser.SyncMatcher(ctx, prepared["operator_emails"], record_events)
+            while not fetch.done():
+                await arrived.wait()
+                arrived.clear()
+                records = timeline.take()
+                if records and not timeline.out_of_order:
+                    await loop.run_in_executor(sheets, matcher.feed, records)
+        fetched = await fetch
+    finally:
+        if not scanned.done():
+            scanned.set_result(None)
+
+    if "error" in prepared:
+        return prepared
+    if "error" in fetched or timeline.out_of_order:
+        # Drop the staged matches: nothing to write, or apply_sync() rematches in date order
+        await loop.run_in_executor(sheets, ctx.threads.rollback)
+        if "error" in fetched:
+            return fetched
+        print("Fetched records came out of date order, matching the whole scan again...")
+        matcher = None
+    else:
+        records = timeline.take()
+        if records:
+            await loop.run_in_executor(sheets, matcher.feed, records)
+    return await on(sheets, 'sync.apply', parser.apply_sync, ctx, prepared, fetched, False, matcher)
+
+
+async def run_jobs(ctx, archive=False):
+    loop = asyncio.get_running_loop()
+    sheets = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sheets')
+    imap = ThreadPoolExecutor(max_workers=1, thread_name_prefix='imap')
+    operators = ThreadPoolExecutor(max_workers=1, thread_name_prefix='operators')
+
+    def on(executor, name, func, *args):
+        return loop.run_in_executor(executor, timed(ctx, name, func, *args))
+
+    try:
+        started = time.monotonic()
+        if not parser.YANDEX_EMAIL or not parser.YANDEX_PASSWORD:
+            sync = {"error": "Yandex credentials missing in .env"}
+            logged = on(operators, 'operators', parser.run_operators, ctx)
+        else:
+            print(f"Connecting to IMAP for {parser.YANDEX_EMAIL}...")
+            # 1. Sheets reads || IMAP scan, matched as it arrives, then the sync writes
+            scanned = loop.create_future()
+            syncing = asyncio.ensure_future(sync_emails(ctx, on, sheets, imap, scanned))
+            # 2. ... || operator log (reuses ctx.records, or scans IMAP itself if the fetch failed)
+            await scanned
+            logged = on(operators, 'operators', parser.run_operators, ctx)
+            sync = await syncing
+        parser.report_sync(sync)
+        ctx.metrics.record('sync', time.monotonic() - started)
+
+        # 3. Jobs that read the thread mirror after the sync
+        await on(sheets, 'overdue', parser.run_overdue, ctx)
+        if archive:
+            await on(sheets, 'archive', parser.run_archive, ctx)
+        await logged
+    finally:
+        for executor in (sheets, imap, operators):
+            executor.shutdown(wait=True)
+
+
+def run_pipeline(archive=False):
+    ctx = RunContext()
+    asyncio.run(run_jobs(ctx, archive))
+    parser.finish_run(ctx)
@@ -0,0 +1,278 @@
+"""
+Local HTTP read API for the notification app: serves the threads table from the
+snapshot that parser.py writes after every sync/archive (THREADS_SNAPSHOT_FILE),
+so clients poll this process instead of the Google Sheets API.
+
+    GET /threads            whole table; ETag is the snapshot version,
+                            If-None-Match with the current ETag -> 304
+    GET /threads?since=N    only rows changed after version N and keys of deleted rows
+                            ("full": true with the whole table if N is too old)
+    GET /events             Server-Sent Events: thread_new, status_changed, thread_updated, overdue,
+                            archived, closed
+                            (staged by parser.py in the `events` table of .threads.db);
+                            resumes after Last-Event-ID or ?since=<event id>
+    GET /health             {"status": "ok", "version": N}
+    POST /threads/close     {"id": "<thread id>"}: the app closes a reminder through the parser
+                            ('закрыт' in column H, see parser.close_reminder), so the sheet,
+                            the mirror and the snapshot change together
+
+Writes (POST) need "Authorization: Bearer <READ_API_TOKEN>" when the token is set. Without
+a token they are served only on a loopback address: bound to the network, the server
+refuses them, so nobody on the LAN can close reminders.
+
+Rows are {"key", "row", "version", "values"}: key is the thread id (see
+parser.snapshot_keys), row the 1-based sheet row, values the A:H cells.
+
+Run: python parser.py serve [--host 127.0.0.1] [--port 8765]
+"""
+import hmac
+import ipaddress
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+READ_API_HOST = os.getenv('READ_API_HOST', '127.0.0.1')  # 0.0.0.0 to serve the office network (set READ_API_TOKEN for writes)
+READ_API_TOKEN = os.getenv('READ_API_TOKEN', '')  # shared secret for POST routes
+READ_API_PORT = int(os.getenv('READ_API_PORT', '8765'))
+EVENTS_POLL_INTERVAL = 1.0  # seconds between checks for new events per stream
+EVENTS_HEARTBEAT_INTERVAL = 15  # seconds between keep-alive comments on an idle stream
+
+
+class SnapshotReader:
+    """Loads the snapshot file and re-reads it only when its mtime/size changes."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stat = None
+        self.snapshot = None
+        self.rows = []  # [{"key", "row", "version", "values"}] in sheet order
+
+    def load(self):
+        """Current snapshot or None if the parser has not written one yet."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            if self._stat != (st.st_mtime_ns, st.st_size):
+                with open(self.path, encoding='utf-8') as f:
+                    snapshot = json.load(f)
+                header = snapshot.get('header', [])
+                self.rows = [
+                    {'key': key, 'row': row_idx, 'version': version,
+                     'values': [record.get(name, '') for name in header]}
+                    for record, (key, row_idx, version) in zip(snapshot['records'], snapshot['rows'])
+                ]
+                self.snapshot = snapshot
+                self._stat = (st.st_mtime_ns, st.st_size)
+            return self.snapshot
+
+    def _current(self):
+        # load() replaces both under the lock: read them together so version and rows match
+        with self._lock:
+            return self.snapshot, self.rows
+
+    def full(self):
+        snapshot, rows = self._current()
+        return {
+            'version': snapshot['version'],
+            'generated_at': snapshot['generated_at'],
+            'header': snapshot['header'],
+            'full': True,
+            'rows': rows,
+            'deleted': [],
+        }
+
+    def delta(self, since):
+        """Rows changed after `since`, or the full table if the snapshot cannot tell."""
+        snapshot, rows = self._current()
+        if since < snapshot.get('min_since', 0) or since > snapshot['version']:
+            return self.full()
+        return {
+            'version': snapshot['version'],
+            'generated_at': snapshot['generated_at'],
+            'header': snapshot['header'],
+            'full': False,
+            'since': since,
+            'rows': [row for row in rows if row['version'] > since],
+            'deleted': [key for key, version in snapshot.get('deleted', {}).items() if version > since],
+        }
+
+
+class EventReader:
+    """Read-only access to the events table of the thread store (the parser writes it)."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def _query(self, sql, params=()):
+        if not os.path.exists(self.db_path):
+            return []
+        db = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, timeout=5)
+        try:
+            return db.execute(sql, params).fetchall()
+        except sqlite3.OperationalError:
+            # No events table yet (store created by an older parser) or locked for too long
+            return []
+        finally:
+            db.close()
+
+    def last_id(self):
+        rows = self._query("SELECT MAX(id) FROM events")
+        return (rows[0][0] or 0) if rows else 0
+
+    def since(self, event_id, limit=500):
+        """[(id, type, data dict)] after `event_id`, oldest first."""
+        return [(row_id, event_type, dict(json.loads(data), at=at)) for row_id, at, event_type, data in self._query(
+            "SELECT id, at, type, data FROM events WHERE id > ? ORDER BY id LIMIT ?", (event_id, limit))]
+
+
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def make_handler(reader, events=None, close_reminder=None, token=''):
+    class ReadAPIHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/events':
+                return self.stream_events(url)
+            snapshot = reader.load()
+            if url.path == '/health':
+                return self.send_json(200, {'status': 'ok', 'version': snapshot['version'] if snapshot else None})
+            if url.path != '/threads':
+                return self.send_json(404, {'error': 'not found'})
+            if snapshot is None:
+                return self.send_json(503, {'error': 'no snapshot yet, run parser.py sync first'})
+
+            etag = f'"{snapshot["version"]}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+
+            since = parse_qs(url.query).get('since')
+            if since:
+                try:
+                    body = reader.delta(int(since[0]))
+                except ValueError:
+                    return self.send_json(400, {'error': 'since must be an integer version'})
+            else:
+                body = reader.full()
+            # The file may have been reloaded since the If-None-Match check: tag what is sent
+            self.send_json(200, body, f'"{body["version"]}"')
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/threads/close' or close_reminder is None:
+                return self.send_json(404, {'error': 'not found'})
+            if token and not hmac.compare_digest(self.headers.get('Authorization', ''), f'Bearer {token}'):
+                return self.send_json(401, {'error': 'missing or wrong READ_API_TOKEN'})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+                msg_id = request['id']
+            except (ValueError, KeyError, TypeError):
+                return self.send_json(400, {'error': 'body must be {"id": "<thread id>"}'})
+            result = close_reminder(msg_id)
+            if 'error' in result:
+                if result.get('not_found'):
+                    return self.send_json(404, {'error': result['error'], 'not_found': True})
+                return self.send_json(502, {'error': result['error']})
+            self.send_json(200, result)
+
+        def stream_events(self, url):
+            if events is None:
+                return self.send_json(404, {'error': 'event stream is not enabled'})
+            start = self.headers.get('Last-Event-ID') or (parse_qs(url.query).get('since') or [None])[0]
+            try:
+                last = int(start) if start else events.last_id()
+            except ValueError:
+                return self.send_json(400, {'error': 'Last-Event-ID / since must be an integer event id'})
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            try:
+                self.wfile.write(b'retry: 5000\n\n')
+                self.wfile.flush()
+                idle_since = time.monotonic()
+                while True:
+                    batch = events.since(last)
+                    for event_id, event_type, data in batch:
+                        self.wfile.write(f"id: {event_id}\nevent: {event_type}\n"
+                                         f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8'))
+                        last = event_id
+                    if batch:
+                        idle_since = time.monotonic()
+                    elif time.monotonic() - idle_since >= EVENTS_HEARTBEAT_INTERVAL:
+                        self.wfile.write(b': ping\n\n')
+                        idle_since = time.monotonic()
+                    self.wfile.flush()
+                    if not batch:
+                        time.sleep(EVENTS_POLL_INTERVAL)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # client went away
+
+        def send_json(self, status, body, etag=None):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('Cache-Control', 'no-cache')
+            if etag:
+                self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            # Clients poll every few seconds: no per-request log lines
+            pass
+
+    return ReadAPIHandler
+
+
+def make_server(snapshot_path, host=None, port=None, events_db=None, close_reminder=None, token=None):
+    """
+    events_db: path of the thread store (.threads.db) to stream events from, None disables /events.
+    close_reminder(msg_id) -> result dict: handles POST /threads/close, None disables it. Calls run
+    one at a time on a single worker thread, so the callable may keep thread-bound state (SQLite).
+    token (default READ_API_TOKEN) is required for POST; without one POST is disabled unless
+    `host` is a loopback address.
+    """
+    host = host or READ_API_HOST
+    token = READ_API_TOKEN if token is None else token
+    if close_reminder is not None and not token and not is_loopback(host):
+        print(f"POST /threads/close disabled: {host} is not a loopback address and READ_API_TOKEN is not set")
+        close_reminder = None
+    close = None
+    if close_reminder is not None:
+        writes = ThreadPoolExecutor(max_workers=1, thread_name_prefix='read-api-writes')
+        close = lambda msg_id: writes.submit(close_reminder, msg_id).result()
+    handler = make_handler(SnapshotReader(snapshot_path), EventReader(events_db) if events_db else None, close, token)
+    server = ThreadingHTTPServer((host, READ_API_PORT if port is None else port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(snapshot_path, host=None, port=None, events_db=None, close_reminder=None):
+    server = make_server(snapshot_path, host, port, events_db, close_reminder)
+    print(f"Read API on http://{server.server_address[0]}:{server.server_address[1]}/threads ({snapshot_path})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nRead API stopped.")
+    finally:
+        server.server_close()
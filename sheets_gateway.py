@@ -0,0 +1,113 @@
+"""
+SheetsGateway: the gspread HTTP client used by parser.RunContext.
+Kept out of parser.py so gspread/requests are imported only by jobs that talk to Sheets.
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import gspread
+import requests
+
+# Sheets API budgets (per minute, per user) and retry policy for SheetsGateway
+SHEETS_READS_PER_MINUTE = int(os.getenv('SHEETS_READS_PER_MINUTE', '60'))
+SHEETS_WRITES_PER_MINUTE = int(os.getenv('SHEETS_WRITES_PER_MINUTE', '60'))
+SHEETS_MAX_RETRIES = 6
+SHEETS_BACKOFF_BASE = 1  # seconds, doubled on every retry
+SHEETS_BACKOFF_MAX = 64
+
+
+class SheetsGateway(gspread.HTTPClient):
+    """
+    gspread HTTP client through which every Sheets API request goes.
+    - GET requests count as reads, everything else as writes; each kind is metered
+      against its per-minute budget (sliding window) and waits when it is used up
+    - 429 (rejected before it was applied) is always retried; 408 / 5xx and network
+      errors only for requests that are safe to repeat (see idempotent()), since the
+      server may have applied the first attempt. Retries use exponential backoff with
+      full jitter (Retry-After is honoured when present)
+    Counters (and seconds spent in requests per kind) are kept in `stats`.
+    Budgets and counters are shared safely by threads (pipeline.py runs jobs concurrently);
+    `thread_stats` counts the reads/writes of the calling thread only.
+    """
+
+    # POST endpoints that set/read values and can be repeated; values:append and the
+    # spreadsheet batchUpdate (row deletes, new sheets) would be applied twice
+    IDEMPOTENT_POSTS = ('values:batchGet', 'values:batchGetByDataFilter', 'values:batchUpdate', 'values:batchClear')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.budgets = {'reads': SHEETS_READS_PER_MINUTE, 'writes': SHEETS_WRITES_PER_MINUTE}
+        self._windows = {'reads': deque(), 'writes': deque()}
+        self.stats = {'reads': 0, 'writes': 0, 'throttled': 0, 'throttle_wait': 0.0, 'retried': 0,
+                      'reads_seconds': 0.0, 'writes_seconds': 0.0}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def thread_stats(self):
+        stats = getattr(self._local, 'stats', None)
+        if stats is None:
+            stats = self._local.stats = {'reads': 0, 'writes': 0}
+        return stats
+
+    def _acquire(self, kind):
+        window = self._windows[kind]
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while window and now - window[0] >= 60:
+                    window.popleft()
+                if len(window) < self.budgets[kind]:
+                    window.append(now)
+                    self.stats[kind] += 1
+                    break
+                wait = 60 - (now - window[0])
+                self.stats['throttled'] += 1
+                self.stats['throttle_wait'] += wait
+            print(f"Sheets {kind} budget ({self.budgets[kind]}/min) used up, waiting {wait:.1f}s...")
+            time.sleep(wait)
+        self.thread_stats[kind] += 1
+
+    @classmethod
+    def idempotent(cls, method, endpoint):
+        method = method.lower()
+        if method in ('get', 'put'):
+            return True
+        return method == 'post' and endpoint.split('?')[0].endswith(cls.IDEMPOTENT_POSTS)
+
+    def request(self, method, endpoint, *args, **kwargs):
+        kind = 'reads' if method.lower() == 'get' else 'writes'
+        repeatable = self.idempotent(method, endpoint)
+        for attempt in range(SHEETS_MAX_RETRIES + 1):
+            self._acquire(kind)
+            started = time.monotonic()
+            try:
+                return super().request(method, endpoint, *args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                code = e.response.status_code
+                retry = code == 429 or (repeatable and (code == 408 or code >= 500))
+                if attempt == SHEETS_MAX_RETRIES or not retry:
+                    raise
+                reason = f"HTTP {code}"
+                retry_after = e.response.headers.get('Retry-After', '')
+            except requests.exceptions.RequestException as e:
+                # A connect timeout never reached the server, anything else may have
+                if attempt == SHEETS_MAX_RETRIES or not (repeatable or isinstance(e, requests.exceptions.ConnectTimeout)):
+                    raise
+                reason = type(e).__name__
+                retry_after = ''
+            finally:
+                with self._lock:
+                    self.stats[kind + '_seconds'] += time.monotonic() - started
+
+            if retry_after.isdigit():
+                delay = float(retry_after)
+            else:
+                delay = random.uniform(0, min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * 2 ** attempt))
+            with self._lock:
+                self.stats['retried'] += 1
+            print(f"Sheets API {reason}, retry {attempt + 1}/{SHEETS_MAX_RETRIES} in {delay:.1f}s...")
+            time.sleep(delay)